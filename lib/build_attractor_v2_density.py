@@ -1,4 +1,4 @@
-import time, sys
+import time, sys, os, json, hashlib, shutil, itertools
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -10,6 +10,9 @@ from matplotlib.colors import ListedColormap
 ### saved along with the simulation output
 attractor_params = {}
 
+### Where voxelized density grids are cached (see build_3d_array_cached)
+density_cache_dir = os.path.expanduser('~/.cache/grav_sim/density_grids')
+
 ### Material densities in kg/m^3
 attractor_params['rho_gold'] = 19300.0
 attractor_params['rho_silicon'] = 2532.59
@@ -53,6 +56,28 @@ attractor_params['total_height'] = \
                         + 2*attractor_params['black_height']*attractor_params['include_black']
 
 
+### Integer labels for the materials that can appear in a voxel. Label
+### grids are stored as uint8 and converted to densities (or masses)
+### through material_density_table, indexed by these labels
+material_names = ['vacuum', 'gold', 'silicon', 'black']
+label_vacuum = 0
+label_gold = 1
+label_silicon = 2
+label_black = 3
+
+
+def material_density_table(params=None):
+    '''Density [kg/m^3] of each material label, such that 
+       material_density_table()[labels] recovers a density grid.'''
+
+    if params is None:
+        params = attractor_params
+
+    return np.array([0.0, params['rho_gold'], params['rho_silicon'], \
+                     params['rho_black']])
+
+
+
 def density_symmetric(x, y, z):
     '''Function to return the density at the desired point (x,y,z)
        based on the above defined properties of the attractor.
@@ -120,33 +145,409 @@ def density_symmetric(x, y, z):
         return 0.0
 
 
+def material_label_vec(x, y, z, params=None):
+    '''Vectorized version of density_symmetric, returning material
+       labels instead of densities. Accepts arrays (or anything 
+       broadcastable against each other, e.g. xx[:,None,None], 
+       yy[None,:,None], zz[None,None,:]) and classifies every point in a
+       single NumPy pass. The classification is identical to 
+       density_symmetric, including the precedence of the various 
+       boolean flags and the exclusive edges. The attractor properties
+       default to attractor_params.'''
 
-def build_3d_array(x_range=(-199.5e-6, 0e-6), dx=1.0e-6, \
-                    y_range=(-249.5e-6, 250e-6), dy=1.0e-6, \
-                    z_range=(-4.5e-6, 5e-6), dz=1.0e-6, \
-                    verbose=False, manualadjust=False):
-    '''Build a 3D array of unit cells with coordinates defining
-       the center of each unit cell. Grid values are the densities
-       of those unit cells, assumed to be entirely one material.
+    if params is None:
+        params = attractor_params
 
-       Default arguments setup 1 um unit cells, spanning most of the
-       attractor and a little empty space to either side. Endpoints
-       in the {x,y,z}_range arguments need to be chosen carefully.'''
+    x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), \
+                                  np.asarray(y, dtype=float), \
+                                  np.asarray(z, dtype=float))
 
-    start = time.time() ### A timer
+    black_h = params['black_height']
+    black_bool = params['include_black']
+    h = params['height']
+    wtot = params['total_width']
+
+    wg = params['width_goldfinger']
+    ws = params['width_siliconfinger']
+    wo = params['width_outersilicon']
+    l = params['finger_length']
+    b = params['silicon_bridge']
+    b_bool = params['include_bridge']
+
+    ax = np.abs(x)
+    ay = np.abs(y)
+    az = np.abs(z)
+
+    ### Points outside the device (or inside the excluded core when only
+    ### the black layers are requested) are left as vacuum
+    inside = (x < 0) & (ay < 0.5 * wtot) & (az < 0.5 * h + (black_h*black_bool))
+    if params['just_black']:
+        inside &= ~(az < 0.5 * h)
+
+    ### Same boolean flags as the scalar function, evaluated everywhere
+    central_finger = ay < 0.5 * wg
+    back_bar = (ax < (l + b*b_bool + wg)) & (ax > (l + b*b_bool))
+    bridge = bool(b_bool) & (x < 0) & (ax < b)
+    outer = ay > (0.5 * wtot - wo)
+    silicon_bulk = ax > (l + wg + b*b_bool)
+    black = az > 0.5*h
+
+    ### Periodic finger structure, assuming n_finger is odd
+    extra_y_unit = (ay - 0.5 * wg) % (wg + ws)
+
+    ### np.select picks the first matching condition, which reproduces
+    ### the order of the early returns in density_symmetric
+    conditions = [~inside, \
+                  black, \
+                  (central_finger & ~bridge) | (back_bar & ~outer), \
+                  bridge | outer | silicon_bulk, \
+                  extra_y_unit > ws, \
+                  extra_y_unit < ws]
+    choices = [label_vacuum, label_black, label_gold, label_silicon, \
+               label_gold, label_silicon]
+
+    return np.select(conditions, choices, default=label_vacuum).astype(np.uint8)
+
+
+
+def density_symmetric_vec(x, y, z):
+    '''Vectorized version of density_symmetric, see material_label_vec
+       for the accepted inputs.'''
+
+    return material_density_table()[material_label_vec(x, y, z)]
+
+
+
+def attractor_boxes(depth=200.0e-6, params=None):
+    '''Describe the attractor as a union of non-overlapping, axis-aligned
+       rectangular boxes of uniform material. This is the same geometry 
+       as density_symmetric (including the central gold finger running 
+       all the way back through the bulk), but exact rather than sampled
+       at voxel centers. The attractor has no back face in x, so the 
+       boxes are truncated at x = -depth, which should match the start
+       of x_range used with build_3d_array.
+
+       OUTPUTS: boxes, array of shape (Nbox, 7), with rows
+                    [xmin, xmax, ymin, ymax, zmin, zmax, label]
+    '''
+
+    if params is None:
+        params = attractor_params
+
+    black_h = params['black_height']
+    black_bool = params['include_black']
+    h = params['height']
+    wtot = params['total_width']
+
+    wg = params['width_goldfinger']
+    ws = params['width_siliconfinger']
+    wo = params['width_outersilicon']
+    l = params['finger_length']
+    b = params['silicon_bridge'] * params['include_bridge']
+    n_finger = params['n_goldfinger']
+
+    ### Some x and y boundaries used repeatedly below
+    x_fingers = -(l + b)
+    x_bar = -(l + b + wg)
+    y_inner = 0.5 * wtot - wo
+
+    ### Rectangles in the x-y plane for the central layer, with columns 
+    ### [xmin, xmax, ymin, ymax, label]. Only y >= 0 is listed here, the
+    ### other half is mirrored at the end
+    rects = []
+    if b > 0:
+        rects.append([-b, 0.0, 0.0, 0.5 * wtot, label_silicon])
+    rects.append([-depth, -b, 0.0, 0.5 * wg, label_gold])
+    rects.append([-depth, -b, y_inner, 0.5 * wtot, label_silicon])
+    rects.append([x_bar, x_fingers, 0.5 * wg, y_inner, label_gold])
+    rects.append([-depth, x_bar, 0.5 * wg, y_inner, label_silicon])
+
+    ### Alternating silicon and gold fingers moving out from the central
+    ### gold finger, assuming n_finger is odd
+    ylow = 0.5 * wg
+    for finger in range(int(n_finger // 2)):
+        rects.append([x_fingers, -b, ylow, ylow + ws, label_silicon])
+        rects.append([x_fingers, -b, ylow + ws, ylow + ws + wg, label_gold])
+        ylow += ws + wg
+
+    rects = np.array(rects)
+    rects = rects[(rects[:,1] > rects[:,0]) & (rects[:,3] > rects[:,2])]
+
+    ### Mirror into y < 0 (the central rectangles straddling y = 0 are
+    ### instead extended)
+    mirrored = rects.copy()
+    mirrored[:,2], mirrored[:,3] = -rects[:,3], -rects[:,2]
+    straddle = rects[:,2] == 0.0
+    rects[straddle,2] = mirrored[straddle,2]
+    rects = np.concatenate((rects, mirrored[~straddle]))
+
+    boxes = []
+    if not params['just_black']:
+        for rect in rects:
+            boxes.append([rect[0], rect[1], rect[2], rect[3], -0.5 * h, 0.5 * h, rect[4]])
+
+    if black_bool:
+        for sign in [-1.0, 1.0]:
+            zlims = sorted([sign * 0.5 * h, sign * (0.5 * h + black_h)])
+            boxes.append([-depth, 0.0, -0.5 * wtot, 0.5 * wtot, zlims[0], zlims[1], label_black])
+
+    return np.array(boxes).reshape(-1, 7)
+
+
+
+def clip_boxes(boxes, x_lim=(-np.inf, np.inf), y_lim=(-np.inf, np.inf), \
+               z_lim=(-np.inf, np.inf)):
+    '''Intersect a list of boxes from attractor_boxes with the region
+       x_lim x y_lim x z_lim, dropping any that end up empty. Useful to 
+       select e.g. a single period of the fingers.'''
+
+    boxes = np.array(boxes, dtype=float)
+    for axis, lims in enumerate([x_lim, y_lim, z_lim]):
+        boxes[:,2*axis] = np.maximum(boxes[:,2*axis], lims[0])
+        boxes[:,2*axis+1] = np.minimum(boxes[:,2*axis+1], lims[1])
+
+    keep = (boxes[:,1] > boxes[:,0]) & (boxes[:,3] > boxes[:,2]) \
+                & (boxes[:,5] > boxes[:,4])
+
+    return boxes[keep]
+
+
+
+def grid_point_masses(xx, yy, zz, label_grid, drop_vacuum=True, cell_volume=None):
+    '''Flatten a label grid from build_label_array (or a sub-selection of
+       it) into the point-mass list format of adaptive_point_masses, so
+       that both can be used interchangeably by the simulation scripts.
+       The cell volume is taken from the grid spacing unless given, which
+       is needed for slabs only one voxel thick.
+
+           OUTPUTS: points, array of shape (N, 3) of voxel centers
+                    volumes, array of shape (N,) of voxel volumes
+                    labels, uint8 array of shape (N,) of material labels
+    '''
+
+    xg, yg, zg = np.meshgrid(xx, yy, zz, indexing='ij')
+    points = np.column_stack((xg.ravel(), yg.ravel(), zg.ravel()))
+    labels = np.asarray(label_grid, dtype=np.uint8).ravel()
+
+    if cell_volume is None:
+        cell_volume = np.abs(xx[1] - xx[0]) * np.abs(yy[1] - yy[0]) * np.abs(zz[1] - zz[0])
+    volumes = np.full(len(points), cell_volume)
+
+    if drop_vacuum:
+        keep = labels != label_vacuum
+        points, volumes, labels = points[keep], volumes[keep], labels[keep]
+
+    return points, volumes, labels
+
+
+
+def _split_cells(cells, split):
+    '''Octree step: halve each flagged cell along every axis that is at
+       least half as long as its longest one.'''
+
+    keep, cells = cells[~split], cells[split]
+
+    extents = cells[:,1::2] - cells[:,0::2]
+    longest = np.max(extents, axis=1)
+    for axis in range(3):
+        halve = extents[:,axis] >= 0.5 * longest
+        mid = 0.5 * (cells[halve,2*axis] + cells[halve,2*axis+1])
+
+        lower, upper = cells[halve].copy(), cells[halve].copy()
+        lower[:,2*axis+1] = mid
+        upper[:,2*axis] = mid
+
+        cells = np.concatenate((cells[~halve], lower, upper))
+        extents = np.concatenate((extents[~halve], extents[halve], extents[halve]))
+        longest = np.concatenate((longest[~halve], longest[halve], longest[halve]))
+
+    return np.concatenate((keep, cells))
+
+
+
+def _cell_contents(cells, boxes, chunk_size=20000):
+    '''Intersect cells with boxes, merging the pieces of each cell by
+       material. Returns the volume of each material in each cell, with
+       shape (Ncell, n_materials), and the first moment of that volume
+       (i.e. volume times centroid), with shape (Ncell, n_materials, 3).'''
+
+    onehot = boxes[:,6].astype(int)[:,None] == np.arange(len(material_names))[None,:]
+
+    volumes = np.zeros((len(cells), len(material_names)))
+    moments = np.zeros((len(cells), len(material_names), 3))
+    for start in range(0, len(cells), chunk_size):
+        chunk = cells[start:start+chunk_size]
+        inter_lo = np.maximum(chunk[:,None,0:6:2], boxes[None,:,0:6:2])
+        inter_hi = np.minimum(chunk[:,None,1:6:2], boxes[None,:,1:6:2])
+        inter_vol = np.prod(np.maximum(inter_hi - inter_lo, 0.0), axis=2)
+        inter_mom = inter_vol[:,:,None] * 0.5 * (inter_lo + inter_hi)
+
+        volumes[start:start+chunk_size] = inter_vol @ onehot
+        moments[start:start+chunk_size] = np.einsum('cbi,bk->cki', inter_mom, onehot)
+
+    return volumes, moments
+
+
+
+def adaptive_point_masses(boxes=None, eta=0.5, interface_eta=0.1, min_size=0.1e-6, \
+                          max_size=16.0e-6, standoff=1.0e-6, x_front=None, \
+                          length_scale=None, lambda_eta=1.0, cutoff=10.0, \
+                          max_cells=2000000, chunk_size=20000):
+    '''Adaptive alternative to build_label_array. Rather than one uniform
+       dxyz over the whole 200um deep attractor, the bounding box of the
+       attractor is covered by an octree of cubic cells which are refined
+       until their size is below eta times their distance from the bead, 
+       so cells end up fine near the bead-facing surface at x = x_front
+       and coarse deep in the bulk. As the bead travels along y, only the
+       distance in x enters the criterion. For kernels with a length
+       scale, like the Yukawa lambda, cells within cutoff*length_scale of
+       the front face are also refined until their size is below 
+       lambda_eta*length_scale, for each of the length scales given.
+
+       Each leaf cell becomes one point mass per material it contains, at
+       the centroid of that material within the cell and with its exact
+       volume, so the mass of each material is exact. A cube has no 
+       quadrupole moment, so the error of a point mass for a filled cell
+       scales as (size / distance)^4, but only as (size / distance)^2 for
+       cells split by a material interface (finger edges, the platinum
+       black layers, the front face itself). Those are thus refined
+       further, until their size is below interface_eta times their
+       distance.
+
+           INPUTS: boxes, array of shape (Nbox, 7) from attractor_boxes
+                       (possibly clipped), default attractor_boxes()
+                   eta, maximum ratio of cell size to distance
+                   interface_eta, same for cells with more than one
+                       material, or partly empty
+                   min_size, max_size, bounds on the cell size [m]
+                   standoff, smallest separation between the bead
+                       surface and the front face, used as the distance
+                       of cells touching the front face [m]
+                   x_front, x position of the bead-facing surface,
+                       default is the largest x of the boxes
+                   length_scale, smallest length scale of the kernels
+                       the point masses will be used with, or None, or a
+                       list of them (e.g. every Yukawa lambda), each of
+                       which refines the cells within its own cutoff
+                   lambda_eta, maximum ratio of cell size to length_scale
+                   cutoff, depth in units of length_scale over which
+                       cells are refined to that scale
+                   max_cells, refinement stops if exceeded
+                   chunk_size, number of cells intersected at once
+
+           OUTPUTS: points, array of shape (N, 3) of point-mass positions
+                    volumes, array of shape (N,) of their volumes
+                    labels, uint8 array of shape (N,) of material labels
+    '''
+
+    if boxes is None:
+        boxes = attractor_boxes()
+    boxes = np.atleast_2d(boxes)
+    if x_front is None:
+        x_front = np.max(boxes[:,1])
+
+    ### Start from cubic cells of size max_size covering the bounding box,
+    ### aligned with the front face. Halving keeps them cubic
+    lo = np.min(boxes[:,0:6:2], axis=0)
+    hi = np.max(boxes[:,1:6:2], axis=0)
+    lo[0] = x_front - max_size * np.ceil((x_front - lo[0]) / max_size)
+    starts = [np.arange(lo[axis], hi[axis], max_size) for axis in range(3)]
+    sx, sy, sz = [arr.ravel() for arr in np.meshgrid(*starts, indexing='ij')]
+    cells = np.column_stack((sx, sx + max_size, sy, sy + max_size, sz, sz + max_size))
+
+    while True:
+        ### Drop empty cells, and flag the ones split by an interface
+        volumes, moments = _cell_contents(cells, boxes, chunk_size)
+        filled = np.sum(volumes, axis=1)
+        occupied = filled > 0
+        cells, volumes, moments, filled = cells[occupied], volumes[occupied], \
+                                          moments[occupied], filled[occupied]
+
+        cell_volume = np.prod(cells[:,1::2] - cells[:,0::2], axis=1)
+        mixed = (np.count_nonzero(volumes, axis=1) > 1) \
+                    | (filled < (1.0 - 1e-9) * cell_volume)
+
+        size = np.max(cells[:,1::2] - cells[:,0::2], axis=1)
+        dist = np.maximum(x_front - cells[:,1], 0.0) + standoff
+        split = (size > eta * dist) | (mixed & (size > interface_eta * dist))
+        for scale in np.atleast_1d(length_scale if length_scale is not None else []):
+            split |= (size > lambda_eta * scale) & (dist - standoff < cutoff * scale)
+        split &= 0.5 * size >= min_size
+
+        if not np.any(split) or len(cells) >= max_cells:
+            break
+        cells = _split_cells(cells, split)
+
+    cell_ind, labels = np.nonzero(volumes)
+    volumes = volumes[cell_ind,labels]
+    points = moments[cell_ind,labels] / volumes[:,None]
+
+    return points, volumes, labels.astype(np.uint8)
+
+
+
+def grid_coordinates(x_range=(-199.5e-6, 0e-6), dx=1.0e-6, \
+                     y_range=(-249.5e-6, 250e-6), dy=1.0e-6, \
+                     z_range=(-4.5e-6, 5e-6), dz=1.0e-6, \
+                     manualadjust=False):
+    '''The x, y, and z arrays of voxel centers used by build_label_array,
+       without classifying the grid itself.'''
 
-    ### Build the x, y, and z arrays, and a zero array for the output
     xx = np.arange(x_range[0], x_range[1], dx)
     yy = np.arange(y_range[0], y_range[1], dy)
     zz = np.arange(z_range[0], z_range[1], dz)
     if manualadjust: zz = np.append(zz, [-6.5e-6,6.5e-6])
-    rho_grid = np.zeros((len(xx), len(yy), len(zz)))
 
-    ### Shitty for loop over the values chosen
-    for i, x in enumerate(xx):
-        for j, y in enumerate(yy):
-            for k, z in enumerate(zz):
-                rho_grid[i,j,k] = density_symmetric(x,y,z)
+    return xx, yy, zz
+
+
+
+def mirror_symmetric(coords, rtol=1e-9):
+    '''Whether voxel (or bead) coordinates along an axis are mirror
+       symmetric about 0. The attractor only depends on |y| and |z| (see
+       material_label_vec), for any attractor_params, so a grid with
+       symmetric y or z coordinates has the same symmetry.'''
+
+    coords = np.sort(np.ravel(coords))
+    if not len(coords):
+        return False
+    return np.allclose(coords, -coords[::-1], rtol=0.0, \
+                       atol=rtol * np.max(np.abs(coords)))
+
+
+
+def mirror_fold_weights(coords, rtol=1e-9):
+    '''Weights folding voxels (or point masses) at coordinates that are
+       mirror symmetric about 0 onto the non-negative half: 2 for positive
+       coordinates, 1 on the plane at 0, and 0 for the negative half, which
+       can then be dropped. For a bead on the mirror plane, the folded
+       masses give the same forces along the plane, and the force across
+       it vanishes.'''
+
+    coords = np.asarray(coords, dtype=float)
+    on_plane = np.abs(coords) <= rtol * np.max(np.abs(coords), initial=0.0)
+    return np.where(on_plane, 1.0, np.where(coords > 0, 2.0, 0.0))
+
+
+
+def build_label_array(x_range=(-199.5e-6, 0e-6), dx=1.0e-6, \
+                      y_range=(-249.5e-6, 250e-6), dy=1.0e-6, \
+                      z_range=(-4.5e-6, 5e-6), dz=1.0e-6, \
+                      verbose=False, manualadjust=False):
+    '''Same as build_3d_array, but returns a compact uint8 grid of
+       material labels in place of the float64 density grid. Densities
+       (or point masses) come from indexing material_density_table 
+       with the labels, so the grid is 8x smaller and independent of
+       the material densities.'''
+
+    start = time.time() ### A timer
+
+    ### Build the x, y, and z arrays, and classify the full grid in one
+    ### vectorized pass
+    xx, yy, zz = grid_coordinates(x_range, dx, y_range, dy, z_range, dz, \
+                                  manualadjust=manualadjust)
+    label_grid = material_label_vec(xx[:,None,None], yy[None,:,None], \
+                                    zz[None,None,:])
     stop = time.time() ### stop the timer
     deltat = stop - start
 
@@ -155,10 +556,410 @@ def build_3d_array(x_range=(-199.5e-6, 0e-6), dx=1.0e-6, \
         print('With {:d} xpts, {:d} ypts, and {:d} zpts: {:0.5f} second runtime'\
                 .format(len(xx), len(yy), len(zz), deltat))
 
+    return xx, yy, zz, label_grid
+
+
+
+def iter_label_slabs(xx, yy, zz, max_voxels=None, axis=0, params=None):
+    '''Generator over slabs of the label grid spanned by the coordinate 
+       arrays xx, yy and zz (e.g. from grid_coordinates), classifying
+       each slab only when it's needed. Slabs are cut along x (axis=0)
+       or y (axis=1), and hold at most max_voxels voxels (but always at
+       least one plane), so the full grid is never held in memory. The
+       attractor properties default to attractor_params, but should be
+       passed explicitly from parallel workers, which re-import this
+       module with the default values.
+
+           OUTPUTS: yields tuples (xx_slab, yy_slab, zz_slab, labels_slab)
+    '''
+
+    coords = [np.asarray(xx), np.asarray(yy), np.asarray(zz)]
+    plane = np.prod([len(coord) for ind, coord in enumerate(coords) if ind != axis])
+    step = len(coords[axis])
+    if max_voxels is not None:
+        step = int(max(1, max_voxels // plane))
+
+    for start in range(0, len(coords[axis]), step):
+        slab = list(coords)
+        slab[axis] = coords[axis][start:start+step]
+        labels = material_label_vec(slab[0][:,None,None], slab[1][None,:,None], \
+                                    slab[2][None,None,:], params=params)
+        yield slab[0], slab[1], slab[2], labels
+
+
+
+def iter_point_mass_slabs(xx, yy, zz, max_voxels=None, axis=0, drop_vacuum=True, \
+                          params=None):
+    '''Same as iter_label_slabs, but yielding each slab in the point-mass
+       format of grid_point_masses, i.e. tuples (points, volumes, labels).
+       Since forces are sums over point masses, they can be accumulated
+       slab by slab with bounded memory, however fine the grid.'''
+
+    cell_volume = np.abs(xx[1] - xx[0]) * np.abs(yy[1] - yy[0]) * np.abs(zz[1] - zz[0])
+    for xx_s, yy_s, zz_s, labels in iter_label_slabs(xx, yy, zz, max_voxels, axis, params):
+        yield grid_point_masses(xx_s, yy_s, zz_s, labels, drop_vacuum=drop_vacuum, \
+                                cell_volume=cell_volume)
+
+
+
+def build_mass_pyramid(xx, yy, zz, label_grid, label_weights=None, spacing=None, \
+                       n_levels=None, order=1):
+    '''Multi-resolution version of a label grid. Level 0 holds the voxels
+       themselves, and each following level sums 2x2x2 blocks of the one
+       below (padding odd axes with empty voxels), keeping track of the
+       centroid of each material within each block, and with order=2 of
+       its second moments as well. Far from the bead, a whole block can
+       then stand in for its voxels, see pyramid_point_masses.
+
+           INPUTS: xx, yy, zz, label_grid, as from build_label_array
+                       (or a contiguous sub-selection or slab of it, as
+                       blocks are located by index)
+                   label_weights, weight of a voxel of each label, e.g.
+                       material_density_table() * cell_volume for masses.
+                       Default is the cell volume (0 for vacuum), which
+                       gives the per-material basis at unit density
+                   spacing, optional (dx, dy, dz), needed if any of the
+                       coordinate arrays has a single entry
+                   n_levels, maximum number of levels, by default the
+                       blocks are coarsened down to a single one
+                   order, 1 for the weights and centroids only, or 2 to
+                       also keep the second moments, at about 3x the memory
+
+           OUTPUTS: pyramid, list of levels from finest to coarsest, each
+                       a dictionary with
+                    'weights', shape (nx, ny, nz, n_materials), summed
+                        over the voxels of each block
+                    'moments', shape (nx, ny, nz, n_materials, 3), the
+                        weights times the centroids
+                    'second', shape (nx, ny, nz, n_materials, 3, 3), the
+                        weights times the mean of x_i * x_j over each block,
+                        for order=2 and all but the first level
+                    'origin', lower corner of the first block
+                    'size', block edge lengths
+    '''
+
+    n_mat = len(material_names)
+    if spacing is None:
+        spacing = [np.abs(coord[1] - coord[0]) for coord in (xx, yy, zz)]
+    spacing = np.array(spacing, dtype=float)
+    if label_weights is None:
+        label_weights = np.full(n_mat, np.prod(spacing))
+        label_weights[label_vacuum] = 0.0
+
+    label_grid = np.asarray(label_grid)
+    weights = np.zeros(label_grid.shape + (n_mat,))
+    for mat_ind in range(n_mat):
+        weights[...,mat_ind] = np.where(label_grid == mat_ind, label_weights[mat_ind], 0.0)
+
+    centers = np.stack(np.meshgrid(xx, yy, zz, indexing='ij'), axis=-1)
+    moments = weights[...,None] * centers[...,None,:]
+
+    origin = np.array([xx[0], yy[0], zz[0]]) - 0.5 * spacing
+    pyramid = [{'weights': weights, 'moments': moments, 'origin': origin, 'size': spacing}]
+
+    ### The second moments of the voxels themselves are those of uniform
+    ### cubes, only summed in blocks of the next level, so that they're
+    ### never held for the full grid
+    second = None
+    voxel_second = np.diag(spacing**2 / 12.0)
+
+    while max(weights.shape[:3]) > 1 and (n_levels is None or len(pyramid) < n_levels):
+        pad = [(0, n % 2) for n in weights.shape[:3]]
+        nx, ny, nz = [(n + 1) // 2 for n in weights.shape[:3]]
+        if order == 2 and second is None:
+            blocks = np.pad(weights, pad + [(0, 0)]).reshape(nx, 2, ny, 2, nz, 2, n_mat)
+            block_centers = np.pad(centers, pad + [(0, 0)]).reshape(nx, 2, ny, 2, nz, 2, 3)
+            second = np.zeros((nx, ny, nz, n_mat, 3, 3))
+            for ix, iy, iz in itertools.product(range(2), repeat=3):
+                cent = block_centers[:,ix,:,iy,:,iz]
+                second += blocks[:,ix,:,iy,:,iz][...,None,None] \
+                            * (cent[...,None,:,None] * cent[...,None,None,:] + voxel_second)
+        elif second is not None:
+            second = np.pad(second, pad + [(0, 0), (0, 0), (0, 0)])
+            second = second.reshape(nx, 2, ny, 2, nz, 2, n_mat, 3, 3).sum(axis=(1, 3, 5))
+
+        weights = np.pad(weights, pad + [(0, 0)])
+        moments = np.pad(moments, pad + [(0, 0), (0, 0)])
+        weights = weights.reshape(nx, 2, ny, 2, nz, 2, n_mat).sum(axis=(1, 3, 5))
+        moments = moments.reshape(nx, 2, ny, 2, nz, 2, n_mat, 3).sum(axis=(1, 3, 5))
+
+        pyramid.append({'weights': weights, 'moments': moments, 'origin': origin, \
+                        'size': 2.0 * pyramid[-1]['size']})
+        if second is not None:
+            pyramid[-1]['second'] = second
+
+    return pyramid
+
+
+
+def pyramid_point_masses(pyramid, position, theta=0.5, length_scale=None, cutoff=None):
+    '''Point masses seen from a bead at the given position, using the
+       coarsest blocks of a pyramid from build_mass_pyramid that are
+       smaller than theta times their distance from the bead center.
+       Starting from the coarsest level, blocks failing the criterion are
+       replaced by their children, down to the voxels themselves. Each
+       block contributes one point per material, at that material's
+       centroid, so the error of a block relative to its own contribution
+       scales as theta^2, while the number of points goes from the full
+       grid to roughly the number of voxels within a few 1/theta voxels
+       of the bead plus a logarithmic number of blocks.
+
+       If the pyramid has second moments (order=2), each block is instead
+       split into six points per material, on either side of the centroid
+       along the principal axes of the material's distribution within the
+       block, which reproduce its second moments (quadrupole) exactly, so
+       that the error goes as theta^3.
+
+       For a kernel that also varies over a length_scale (e.g. a Yukawa
+       lambda), blocks need to be smaller than theta times that as well,
+       and blocks farther than cutoff from the bead, where the kernel is
+       negligible, are left out altogether.
+
+           OUTPUTS: points, array of shape (N, 3)
+                    weights, array of shape (N,), same units as the
+                        label_weights of the pyramid (volumes by default)
+                    labels, uint8 array of shape (N,) of material labels
+    '''
+
+    position = np.asarray(position, dtype=float)
+    offsets = np.indices((2, 2, 2)).reshape(3, -1).T
+
+    idx = np.indices(pyramid[-1]['weights'].shape[:3]).reshape(3, -1).T
+    points, weights, labels = [], [], []
+    for level in range(len(pyramid) - 1, -1, -1):
+        lev = pyramid[level]
+
+        ### Skip empty blocks
+        block_weights = lev['weights'][tuple(idx.T)]
+        idx, block_weights = idx[np.any(block_weights > 0, axis=1)], \
+                             block_weights[np.any(block_weights > 0, axis=1)]
+
+        lo = lev['origin'] + idx * lev['size']
+        gaps = np.maximum(np.maximum(lo - position, position - lo - lev['size']), 0.0)
+        dist = np.sqrt(np.sum(gaps**2, axis=1))
+
+        if cutoff is not None:
+            idx, block_weights, dist = idx[dist <= cutoff], block_weights[dist <= cutoff], \
+                                       dist[dist <= cutoff]
+
+        accept = np.ones(len(idx), dtype=bool)
+        if level > 0:
+            accept = np.max(lev['size']) < theta * dist
+            if length_scale is not None:
+                accept &= np.max(lev['size']) < theta * length_scale
+
+        block_ind, mat_ind = np.nonzero(block_weights[accept])
+        acc_weights = block_weights[accept][block_ind,mat_ind]
+        acc_moments = lev['moments'][tuple(idx[accept].T)][block_ind,mat_ind]
+        centroids = acc_moments / acc_weights[:,None]
+        if level > 0 and 'second' in lev:
+            ### Points at +/- sqrt(3 * variance) along each principal axis,
+            ### with a sixth of the weight each
+            acc_second = lev['second'][tuple(idx[accept].T)][block_ind,mat_ind]
+            cov = acc_second / acc_weights[:,None,None] \
+                    - centroids[:,:,None] * centroids[:,None,:]
+            variances, axes = np.linalg.eigh(cov)
+            spread = axes * np.sqrt(3.0 * np.maximum(variances, 0.0))[:,None,:]
+            spread = np.concatenate((spread, -spread), axis=2)
+            centroids = (centroids[:,:,None] + spread).transpose(0, 2, 1).reshape(-1, 3)
+            acc_weights = np.repeat(acc_weights / 6.0, 6)
+            mat_ind = np.repeat(mat_ind, 6)
+        points.append(centroids)
+        weights.append(acc_weights)
+        labels.append(mat_ind)
+
+        ### Refine the rest, keeping only children that exist at the finer
+        ### level (the coarse ones can include padding)
+        if level > 0:
+            children = (2 * idx[~accept])[:,None,:] + offsets[None,:,:]
+            children = children.reshape(-1, 3)
+            shape = np.array(pyramid[level-1]['weights'].shape[:3])
+            idx = children[np.all(children < shape, axis=1)]
+
+    return np.concatenate(points), np.concatenate(weights), \
+                np.concatenate(labels).astype(np.uint8)
+
+
+
+def build_3d_array(x_range=(-199.5e-6, 0e-6), dx=1.0e-6, \
+                    y_range=(-249.5e-6, 250e-6), dy=1.0e-6, \
+                    z_range=(-4.5e-6, 5e-6), dz=1.0e-6, \
+                    verbose=False, manualadjust=False):
+    '''Build a 3D array of unit cells with coordinates defining
+       the center of each unit cell. Grid values are the densities
+       of those unit cells, assumed to be entirely one material.
+
+       Default arguments setup 1 um unit cells, spanning most of the
+       attractor and a little empty space to either side. Endpoints
+       in the {x,y,z}_range arguments need to be chosen carefully.'''
+
+    xx, yy, zz, label_grid = build_label_array(x_range=x_range, dx=dx, \
+                                               y_range=y_range, dy=dy, \
+                                               z_range=z_range, dz=dz, \
+                                               verbose=verbose, \
+                                               manualadjust=manualadjust)
+    rho_grid = material_density_table()[label_grid]
+
     return xx, yy, zz, rho_grid
 
 
 
+def density_cache_key(x_range, dx, y_range, dy, z_range, dz, \
+                      manualadjust=False, params=None):
+    '''Content hash identifying a voxelized density grid. Built from
+       the attractor parameters along with everything passed to
+       build_3d_array that changes the output grid, so two calls with
+       the same geometry always map to the same key.'''
+
+    if params is None:
+        params = attractor_params
+
+    ### repr() keeps the full float precision, and sorting the keys makes
+    ### the hash independent of the order the dictionary was built in
+    payload = {'attractor_params': {key: repr(params[key]) for key in sorted(params)}, \
+               'x_range': [repr(float(val)) for val in x_range], 'dx': repr(float(dx)), \
+               'y_range': [repr(float(val)) for val in y_range], 'dy': repr(float(dy)), \
+               'z_range': [repr(float(val)) for val in z_range], 'dz': repr(float(dz)), \
+               'manualadjust': bool(manualadjust)}
+
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+
+def build_3d_array_cached(x_range=(-199.5e-6, 0e-6), dx=1.0e-6, \
+                          y_range=(-249.5e-6, 250e-6), dy=1.0e-6, \
+                          z_range=(-4.5e-6, 5e-6), dz=1.0e-6, \
+                          verbose=False, manualadjust=False, \
+                          cache_dir=None, mmap_mode='r', \
+                          max_bytes=5.0e9, max_age=30*86400.0, \
+                          labels=False):
+    '''Drop-in replacement for build_3d_array that keeps an on-disk
+       cache of the voxelized grids, keyed by density_cache_key. On a
+       hit, the arrays are memory-mapped from .npy files rather than
+       re-voxelized, so repeated sweeps and joblib workers only pay for
+       the pages they actually touch.
+
+       INPUTS: same as build_3d_array, plus
+
+           cache_dir, directory holding the cache. Defaults to the
+               module-level density_cache_dir
+
+           mmap_mode, passed to np.load. Use None to read the arrays
+               fully into memory
+
+           max_bytes, max_age, limits (bytes, seconds) enforced by 
+               evict_density_cache after a new grid is written. Either
+               can be None to disable that limit
+
+           labels, boolean to return the uint8 material label grid 
+               (see build_label_array) instead of the density grid
+
+       OUTPUTS: xx, yy, zz, rho_grid (or label_grid), as for 
+           build_3d_array (or build_label_array)'''
+
+    if cache_dir is None:
+        cache_dir = density_cache_dir
+
+    key = density_cache_key(x_range, dx, y_range, dy, z_range, dz, \
+                            manualadjust=manualadjust)
+    entry = os.path.join(cache_dir, key)
+    names = ['xx', 'yy', 'zz', 'labels' if labels else 'rho']
+    cached_names = ['xx', 'yy', 'zz', 'rho', 'labels']
+
+    def complete(path):
+        return all(os.path.isfile(os.path.join(path, name + '.npy')) for name in cached_names)
+
+    if not complete(entry):
+        xx, yy, zz, label_grid = build_label_array(x_range=x_range, dx=dx, \
+                                                   y_range=y_range, dy=dy, \
+                                                   z_range=z_range, dz=dz, \
+                                                   verbose=verbose, \
+                                                   manualadjust=manualadjust)
+        rho_grid = material_density_table()[label_grid]
+
+        ### Write into a private directory and rename it into place, so
+        ### parallel workers building the same grid never see a partial
+        ### entry. Whoever renames second just throws their copy away
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_entry = entry + '.tmp{:d}'.format(os.getpid())
+        os.makedirs(tmp_entry, exist_ok=True)
+        for name, arr in zip(cached_names, [xx, yy, zz, rho_grid, label_grid]):
+            np.save(os.path.join(tmp_entry, name + '.npy'), arr)
+        with open(os.path.join(tmp_entry, 'attractor_params.json'), 'w') as f:
+            json.dump({key: repr(val) for key, val in attractor_params.items()}, f, indent=1)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            ### The entry exists. If another worker published it in the
+            ### meantime, it's a hit, and otherwise it was written before
+            ### label grids were cached, so it's moved aside (readers with
+            ### it open keep their files) and replaced
+            if not complete(entry):
+                stale_entry = entry + '.tmp{:d}stale'.format(os.getpid())
+                try:
+                    os.rename(entry, stale_entry)
+                    shutil.rmtree(stale_entry, ignore_errors=True)
+                    os.rename(tmp_entry, entry)
+                except OSError:
+                    pass
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        evict_density_cache(cache_dir=cache_dir, max_bytes=max_bytes, \
+                            max_age=max_age, keep=[key])
+
+    elif verbose:
+        print()
+        print('Loaded cached density grid: {:s}'.format(entry))
+
+    ### Touch the entry so age-based eviction is least-recently-used
+    os.utime(entry)
+
+    return tuple(np.load(os.path.join(entry, name + '.npy'), mmap_mode=mmap_mode) \
+                 for name in names)
+
+
+
+def evict_density_cache(cache_dir=None, max_bytes=5.0e9, max_age=30*86400.0, \
+                        keep=()):
+    '''Remove cached density grids older than max_age seconds (since
+       last use), then the least recently used ones until the cache is
+       smaller than max_bytes. Keys listed in keep are never removed.
+       Returns the list of evicted keys.'''
+
+    if cache_dir is None:
+        cache_dir = density_cache_dir
+    if not os.path.isdir(cache_dir):
+        return []
+
+    entries = []
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, key)
+        if '.tmp' in key or not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, fil)) for fil in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, key, path))
+
+    ### Oldest first
+    entries.sort()
+    now = time.time()
+    total = sum(entry[1] for entry in entries)
+
+    evicted = []
+    for mtime, size, key, path in entries:
+        if key in keep:
+            continue
+        too_old = (max_age is not None) and (now - mtime > max_age)
+        too_big = (max_bytes is not None) and (total > max_bytes)
+        if not (too_old or too_big):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        evicted.append(key)
+
+    return evicted
+
+
+
 
 def plot_xy_density(zpos=0.0, x_range=(-599.5e-6, 10.0e-6), dx=1.0e-6, \
                     y_range=(-249.5e-6, 250e-6), dy=1.0e-6, \
@@ -200,17 +1001,12 @@ def plot_xy_density(zpos=0.0, x_range=(-599.5e-6, 10.0e-6), dx=1.0e-6, \
     ### Build the x and y arrays for plotting
     xx = np.arange(x_range[0], x_range[1], dx)
     yy = np.arange(y_range[0], y_range[1], dy)
-    rho_grid = np.zeros((len(xx), len(yy)))
 
     if cmap == "twocolor":
         _cmap = ListedColormap(['grey','gold'])
     else: _cmap = cmap
 
-    ### Shitty slow for loops. The density function is hard to vectorize
-    ### given the somewhat complex structure of the attractor
-    for i, x in enumerate(xx):
-        for j, y in enumerate(yy):
-            rho_grid[i,j] = density_symmetric(x, y, zpos)
+    rho_grid = density_symmetric_vec(xx[:,None], yy[None,:], zpos)
 
     ### Some timing
     stop = time.time()
@@ -12,6 +12,7 @@ import scipy, sys, time, os, itertools
 
 import build_attractor_v2_density as density
 import bead_util as bu
+import force_kernels
 
 from numba import jit
 from datetime import date
@@ -64,6 +65,50 @@ include_edge = True
 ### physical space that you want).
 dxyz = (1)*1e-6
 
+### 'uniform' sums over the voxel grid with spacing dxyz, while 'adaptive'
+### uses the point masses of an octree that is only fine near the front
+### face and material interfaces (see density.adaptive_point_masses)
+voxelization = 'uniform'
+
+### Memory budget in bytes for the 'uniform' voxels, or None. If set, the
+### grid is never built, and the kernel is accumulated over x-slabs of
+### voxels generated on the fly, shared between the ncore threads
+memory_budget = None
+
+### Opening angle for far-field coarsening of the 'uniform' voxels, or None.
+### If set, each position sums the coarsest 2x2x2 blocks of a mass pyramid
+### that are smaller than pyramid_theta times their distance from the bead
+### (see density.pyramid_point_masses). The hard shell edges make the table
+### more sensitive to this than the forces are: 0.1 gives errors at the
+### percent level, comparable to the discretization error of 1um voxels
+pyramid_theta = None
+
+### 'numpy' sorts the voxels by distance for each position, while 'numba'
+### uses _shell_sums_fused, a single compiled loop over the voxels that
+### adds each one to the shells it falls in. It releases the GIL, so the
+### ncore threads run in parallel, and is cached on disk after the first
+### compilation
+kernel_backend = 'numpy'
+
+### Whether to use the mirror symmetry of the attractor in y and z, if the
+### voxel grid has it (see density.mirror_symmetric). The table is then only
+### computed at the positions with y >= 0 and mirrored to the others (see
+### force_kernels.unfold_mirror), and for beads at z = 0, the z components
+### are exactly 0 and the uniform voxels are folded onto z >= 0. The shell
+### tables themselves aren't exactly mirror symmetric, as the voxels at
+### distances on the shell edges fall on either side of them by rounding,
+### so mirroring changes the default tables by up to 0.45%, and it's off
+use_symmetry = False
+
+### Adaptive sampling of the bead positions along y. If position_tolerance
+### is set, the table is first computed at every position_step-th position,
+### and then at more of them wherever the cubic spline through the ones
+### computed so far is off by more than position_tolerance relative to the
+### peak of the table (see force_kernels.adaptive_position_curves). The rest
+### are sampled from the spline, so the table still covers all of yposvec
+position_tolerance = None
+position_step = 16
+
 def shell_sum(pos, xx, yy, zz, m, r, rb):
 	"""Sum m_i * sep_i * r'_i over attractor points within the shell r-rb < r' < r+rb.
 
@@ -88,18 +133,62 @@ def outersum(pos, xx, yy, zz, m, r, rb, rho_bead):
 	return pi * rho_bead * r * (result[0] - result[1] * (r**2 - rb**2))
 
 
-def _kernel_at_pos(pos, xx, yy, zz, m, r_vals, rb, rho_bead):
+@jit(nopython=True, nogil=True, cache=True)
+def _shell_sums_fused(pos, points, masses, r_vals, rb, rho_bead):
+	"""Same as the shell slicing in _kernel_at_pos, for flat point masses.
+
+	Each point adds its terms to every shell with r - rb <= r' <= r + rb,
+	found by binary search in the (sorted) r_vals, so that nothing is sorted
+	or allocated per point.
+	"""
+	linsum  = np.zeros((len(r_vals), 3))
+	quadsum = np.zeros((len(r_vals), 3))
+	for pt in range(len(points)):
+		sep = pos - points[pt]
+		rp  = np.sqrt(sep[0]**2 + sep[1]**2 + sep[2]**2)
+		### One extra shell on either side, with the exact test below, so
+		### that rounding matches the sorted version
+		lo = max(np.searchsorted(r_vals, rp - rb) - 1, 0)
+		hi = min(np.searchsorted(r_vals, rp + rb) + 1, len(r_vals))
+		for j in range(lo, hi):
+			if r_vals[j] - rb <= rp and rp <= r_vals[j] + rb:
+				for k in range(3):
+					linsum[j, k]  += masses[pt] * sep[k] / rp
+					quadsum[j, k] += masses[pt] * sep[k] / rp**3
+
+	out = np.zeros((len(r_vals), 3))
+	for j in range(len(r_vals)):
+		r = r_vals[j]
+		for k in range(3):
+			out[j, k] = pi * rho_bead * r * (linsum[j, k] - quadsum[j, k] * (r**2 - rb**2))
+	return out
+
+
+def _kernel_at_pos(pos, xx, yy, zz, m, r_vals, rb, rho_bead, mass_table=None, points=None,
+                   pyramid=None, theta=0.5):
 	"""Compute outersum at all r_vals for a single position.
 
 	Builds the full separation arrays once, sorts by distance, then uses
 	searchsorted for O(log N) shell slicing per r — avoids re-scanning the
-	full attractor for every r value.
+	full attractor for every r value. If mass_table is given, m is a
+	material label grid and masses are looked up after sorting. If points
+	is given, it replaces the xx, yy, zz grid and m is one mass per point.
+	If pyramid is given, the points and masses are taken from it instead.
 	"""
-	Xsep, Ysep, Zsep = np.meshgrid(pos[0] - xx, pos[1] - yy, pos[2] - zz, indexing='ij')
+	if pyramid is not None:
+		points, m, _ = density.pyramid_point_masses(pyramid, pos, theta=theta)
+	if kernel_backend == 'numba':
+		return _shell_sums_fused(np.asarray(pos, dtype=float), points, m, r_vals, rb, rho_bead)
+	if points is not None:
+		Xsep, Ysep, Zsep = np.asarray(pos)[:, None] - points.T
+	else:
+		Xsep, Ysep, Zsep = np.meshgrid(pos[0] - xx, pos[1] - yy, pos[2] - zz, indexing='ij')
 	r_prime  = np.sqrt(Xsep**2 + Ysep**2 + Zsep**2).ravel()
 	sort_idx = np.argsort(r_prime)
 	r_s = r_prime[sort_idx]
 	m_s = m.ravel()[sort_idx]
+	if mass_table is not None:
+		m_s = mass_table[m_s]
 	x_s = Xsep.ravel()[sort_idx]
 	y_s = Ysep.ravel()[sort_idx]
 	z_s = Zsep.ravel()[sort_idx]
@@ -119,22 +208,41 @@ def _kernel_at_pos(pos, xx, yy, zz, m, r_vals, rb, rho_bead):
 	return out
 
 
-def compute_kernel_table(pos_list, r_vals, rb, xx, yy, zz, m, rho_bead):
+def compute_kernel_table(pos_list, r_vals, rb, xx, yy, zz, m, rho_bead, mass_table=None,
+                         points=None, pyramid=None, theta=0.5):
 	"""Compute outersum at every (position, r) pair, parallelized over positions.
 
 	pos_list : array-like, shape (N, 3) — bead positions [x, y, z]
 	r_vals   : 1D array of shell radii to evaluate
 	rb       : bead radius
 	xx, yy, zz : 1D coordinate arrays from build_3d_array
-	m        : 3D mass array (rho * cell_volume)
+	m        : 3D mass array (rho * cell_volume), or a uint8 material label
+	           array from build_label_array when mass_table is given
 	rho_bead : bead material density
+	mass_table : optional per-label voxel mass, e.g.
+	           density.material_density_table() * cell_volume
+	points   : optional (N_pts, 3) array of point-mass positions, e.g. from
+	           density.adaptive_point_masses, used in place of the xx, yy, zz
+	           grid (pass None for those). m is then an (N_pts,) array of
+	           masses, or of labels when mass_table is given
+	pyramid  : optional mass pyramid from density.build_mass_pyramid, with
+	           masses as label_weights, used in place of the grid or points
+	           (pass None for those), and coarsened away from each position
+	           with opening angle theta
 
 	Returns array of shape (N, len(r_vals), 3) — outersum x/y/z at each (pos, r).
 	"""
 	pos_list = np.asarray(pos_list)
 	r_vals   = np.asarray(r_vals)
+	if kernel_backend == 'numba' and pyramid is None:
+		### The fused loop takes flat point masses
+		if points is None:
+			points = np.stack(np.meshgrid(xx, yy, zz, indexing='ij'), axis=-1).reshape(-1, 3)
+		m = np.ravel(m) if mass_table is None else mass_table[np.ravel(m)]
+		mass_table = None
 	rows = Parallel(n_jobs=ncore, prefer='threads')(
-		delayed(_kernel_at_pos)(pos, xx, yy, zz, m, r_vals, rb, rho_bead)
+		delayed(_kernel_at_pos)(pos, xx, yy, zz, m, r_vals, rb, rho_bead, mass_table, points,
+		                        pyramid, theta)
 		for pos in pos_list
 	)
 	return np.array(rows)
@@ -161,29 +269,60 @@ def main():
 		+ 2 * density.attractor_params['black_height'] * density.attractor_params['include_black']
 	)
 
-	x_range = (-200e-6 + dxyz/2, 0.0)
-	y_range = (-density.attractor_params['total_width']/2 + dxyz/2,
-	            density.attractor_params['total_width']/2)
-	z_range = (-density.attractor_params['total_height']/2 + dxyz/2,
-	            density.attractor_params['total_height']/2)
-	xx, yy, zz, rho = density.build_3d_array(
-		x_range=x_range, dx=dxyz,
-		y_range=y_range, dy=dxyz,
-		z_range=z_range, dz=dxyz,
-		verbose=True,
-	)
-	m = rho * dxyz**3
-
 	### Bead and position parameters — mirrors save_force_curve_periodic_parallel
 	rbeads   = np.array([4.99e-6])
 	seps     = np.array([5.0e-6])   # single sep for timing test
 	heights  = [0.0]
 	rho_bead = 1850.0
 
+	x_range = (-200e-6 + dxyz/2, 0.0)
+	if voxelization == 'adaptive':
+		### Point masses refined for the closest separation, used in place
+		### of the grid, over the x range that the grid would span
+		x_lim = (x_range[0] - dxyz/2, x_range[1])
+		points, volumes, point_labels = density.adaptive_point_masses(
+			density.clip_boxes(density.attractor_boxes(depth=-x_lim[0]), x_lim=x_lim),
+			standoff=np.min(seps),
+		)
+		xx, yy, zz = None, None, None
+		masses = density.material_density_table()[point_labels] * volumes
+		mass_table = None
+	else:
+		y_range = (-density.attractor_params['total_width']/2 + dxyz/2,
+		            density.attractor_params['total_width']/2)
+		z_range = (-density.attractor_params['total_height']/2 + dxyz/2,
+		            density.attractor_params['total_height']/2)
+		if memory_budget is None:
+			xx, yy, zz, masses = density.build_3d_array_cached(
+				x_range=x_range, dx=dxyz,
+				y_range=y_range, dy=dxyz,
+				z_range=z_range, dz=dxyz,
+				verbose=True, labels=True,
+			)
+		else:
+			xx, yy, zz = density.grid_coordinates(
+				x_range=x_range, dx=dxyz,
+				y_range=y_range, dy=dxyz,
+				z_range=z_range, dz=dxyz,
+			)
+			masses = None
+		points = None
+		mass_table = density.material_density_table() * dxyz**3
+
+	use_pyramid = voxelization != 'adaptive' and pyramid_theta is not None
+
+	### Mirror symmetries of the uniform grid. The adaptive octree isn't
+	### symmetric itself, so it's summed as is
+	y_mirror = use_symmetry and voxelization != 'adaptive' and density.mirror_symmetric(yy)
+	z_mirror = use_symmetry and voxelization != 'adaptive' and density.mirror_symmetric(zz)
+	if use_pyramid and masses is not None:
+		pyramid = density.build_mass_pyramid(xx, yy, zz, masses, label_weights=mass_table)
+
 	travel  = 500.0e-6
 	Npoints = 1000
 	bead_dx = travel / Npoints
 	yposvec = np.linspace(-travel + bead_dx, travel - bead_dx, 2*Npoints - 1)
+	y_start = force_kernels.mirror_half_start(yposvec) if y_mirror else 0
 
 	r_vals = np.arange(dr, 250e-6 + dr, dr)
 
@@ -197,11 +336,65 @@ def main():
 		full_path = os.path.join(results_path, filename)
 
 		pos_list = np.column_stack([
-			np.full(len(yposvec), sep + rbead),
-			yposvec,
-			np.full(len(yposvec), height),
+			np.full(len(yposvec) - y_start, sep + rbead),
+			yposvec[y_start:],
+			np.full(len(yposvec) - y_start, height),
 		])
-		table = compute_kernel_table(pos_list, r_vals, rbead, xx, yy, zz, m, rho_bead)
+
+		### At z = 0, voxels at -z give the same terms as those at z, up to
+		### the sign of the z component, so they're folded onto z >= 0
+		z_fold = z_mirror and height == 0 and not use_pyramid
+
+		def kernel_table(positions):
+			"""Table at any of the positions in pos_list, shape (N, len(r_vals), 3)."""
+			if use_pyramid and masses is not None:
+				table = compute_kernel_table(positions, r_vals, rbead, None, None, None, None,
+				                             rho_bead, pyramid=pyramid, theta=pyramid_theta)
+			elif use_pyramid:
+				### Same as below, with a pyramid for each slab
+				max_voxels = int(memory_budget // (ncore * force_kernels.point_mass_bytes))
+				table = np.zeros((len(positions), len(r_vals), 3))
+				for slab in density.iter_label_slabs(xx, yy, zz, max_voxels=max_voxels):
+					slab_pyramid = density.build_mass_pyramid(*slab, label_weights=mass_table,
+					                                          spacing=(dxyz, dxyz, dxyz))
+					table += compute_kernel_table(positions, r_vals, rbead, None, None, None, None,
+					                              rho_bead, pyramid=slab_pyramid, theta=pyramid_theta)
+			elif masses is None:
+				### Shell sums are additive over voxels, so accumulate them slab
+				### by slab, with one slab per thread in memory at a time
+				max_voxels = int(memory_budget // (ncore * force_kernels.point_mass_bytes))
+				table = np.zeros((len(positions), len(r_vals), 3))
+				for slab_points, _, slab_labels in density.iter_point_mass_slabs(
+						xx, yy, zz, max_voxels=max_voxels):
+					if z_fold:
+						weights = density.mirror_fold_weights(slab_points[:, 2])
+						keep = weights > 0
+						table += compute_kernel_table(positions, r_vals, rbead, None, None, None,
+						                              mass_table[slab_labels[keep]] * weights[keep],
+						                              rho_bead, points=slab_points[keep])
+						continue
+					table += compute_kernel_table(positions, r_vals, rbead, None, None, None,
+					                              slab_labels, rho_bead, mass_table=mass_table,
+					                              points=slab_points)
+			elif z_fold:
+				weights = density.mirror_fold_weights(zz)
+				keep = weights > 0
+				table = compute_kernel_table(positions, r_vals, rbead, xx, yy, zz[keep],
+				                             mass_table[masses[:, :, keep]] * weights[keep], rho_bead)
+			else:
+				table = compute_kernel_table(positions, r_vals, rbead, xx, yy, zz, masses, rho_bead,
+				                             mass_table=mass_table, points=points)
+			return table
+
+		if position_tolerance is None:
+			table = kernel_table(pos_list)
+		else:
+			table = force_kernels.adaptive_position_curves(
+				lambda inds: kernel_table(pos_list[inds]), pos_list[:, 1], position_tolerance,
+				start_step=position_step, pos_axis=0, term_axis=None,
+			)
+		table = force_kernels.unfold_mirror(table, len(yposvec), z_mirror and height == 0,
+		                                    pos_axis=0, comp_axis=-1)
 
 		payload = {
 			'table':            table,       # shape (N_ypos, N_r, 3)
@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 import dill as pickle
 
 import bead_util as bu
+import collect_util
 
 
 #parent = str( Path(os.path.abspath(__file__)).parents[1] )
@@ -34,6 +35,13 @@ def rbead_cond(rbead):
     else:
         return True
 
+### Values of the Yukawa lambda to collect the curves at. None takes every
+### value found in the simulation output. Files that don't have one of them
+### (e.g. from the adaptive lambda grid of the simulation, which refines
+### differently for each file) are splined to it, see
+### collect_util.lambda_spline
+out_lambdas = None
+
 test_filename = os.path.join(out_path, 'test.p')
 bu.make_all_pardirs(test_filename)
 
@@ -44,6 +52,7 @@ raw_filenames, _ = bu.find_all_fnames(raw_path, ext='.p', skip_subdirectories=Tr
 seps = []
 heights = []
 posvec = []
+lambdas = set()
 nfiles = len(raw_filenames)
 for fil_ind, fil in enumerate(raw_filenames):
     ### Display percent completion
@@ -74,20 +83,21 @@ for fil_ind, fil in enumerate(raw_filenames):
     ### parameters, i.e. the yukawa lambdas and bead positions
     if not len(posvec):
         posvec = sim_out['posvec']
-        lambdas = list(sim_out[rbead][sep][height].keys())
         attractor_params = sim_out['attractor_params']
         rhobead = sim_out['rhobead']
+        materials = sim_out.get('materials', [])
     else:
         assert np.sum(posvec - sim_out['posvec']) == 0.0
 
     seps.append(sep)
     heights.append(height)
+    lambdas.update(sim_out[rbead][sep][height].keys())
 
 
 
 ### Select unique values of simulation parameters and construct
 ### sorted arrays of those values
-lambdas = np.sort(np.array(lambdas))
+lambdas = np.sort(np.array(list(lambdas) if out_lambdas is None else out_lambdas))
 
 seps = np.sort(np.unique(seps))
 heights = np.sort(np.unique(heights))
@@ -99,6 +109,12 @@ grid_check = np.zeros((len(seps), len(heights)))
 Goutarr = np.zeros((len(seps), len(posvec), len(heights), 3))
 yukoutarr = np.zeros((len(lambdas), len(seps), len(posvec), len(heights), 3))
 
+### If the simulation saved per-material curves, collect those as well so
+### that other density assignments can be built with
+### collect_util.recombine_materials
+Gbasisarr = np.zeros((len(materials), len(seps), len(posvec), len(heights), 3))
+yukbasisarr = np.zeros((len(lambdas), len(materials), len(seps), len(posvec), len(heights), 3))
+
 for fil_ind, fil in enumerate(raw_filenames):
 
     bu.progress_bar(fil_ind, nfiles, suffix='collecting sim data')
@@ -129,10 +145,32 @@ for fil_ind, fil in enumerate(raw_filenames):
     heightind = np.argmin( np.abs(heights - height) )
     grid_check[sepind, heightind] += 1.0
 
+    ### Yukawa curves at each of lambdas, with shape (len(lambdas), 3, N),
+    ### splined from the values in the file if it doesn't have all of them
+    file_lambdas = list(dat.keys())
+    yukdat = np.array([dat[lamb][3:] for lamb in file_lambdas])
+    if len(materials):
+        basis = sim_out['basis']
+        yukbasis = np.array([basis[lamb][:,3:] for lamb in file_lambdas])
+    if all(lamb in dat for lamb in lambdas):
+        lambinds = [file_lambdas.index(lamb) for lamb in lambdas]
+        yukdat = yukdat[lambinds]
+        if len(materials):
+            yukbasis = yukbasis[lambinds]
+    else:
+        yukdat = collect_util.lambda_spline(file_lambdas, yukdat)(lambdas)
+        if len(materials):
+            yukbasis = collect_util.lambda_spline(file_lambdas, yukbasis, \
+                                                  peak_axes=(2, 3))(lambdas)
+
     for ind in [0,1,2]:
-        Goutarr[sepind,:,heightind,ind] = dat[lambdas[0]][ind]
-        for lambind, lamb in enumerate(lambdas):
-            yukoutarr[lambind,sepind,:,heightind,ind] = dat[lamb][ind+3]
+        Goutarr[sepind,:,heightind,ind] = dat[file_lambdas[0]][ind]
+        yukoutarr[:,sepind,:,heightind,ind] = yukdat[:,ind]
+
+    if len(materials):
+        for ind in [0,1,2]:
+            Gbasisarr[:,sepind,:,heightind,ind] = basis[file_lambdas[0]][:,ind]
+            yukbasisarr[:,:,sepind,:,heightind,ind] = yukbasis[:,:,ind]
 
 print(rbead)
 print("Done!")
@@ -151,6 +189,8 @@ if missing_values:
 else:
     print("Saving all that good, good data")
 
+### The collected curves for any lambda in range, through
+### collect_util.load_yukawa_curves(out_path)
 try:
     pickle.dump(attractor_params, open(os.path.join(out_path, 'attractor_params.p'), 'wb'))
     np.save(os.path.join(out_path, 'rbead_rhobead.npy'), [rbead, rhobead])
@@ -161,6 +201,10 @@ try:
     np.save(os.path.join(out_path, 'xpos.npy'), seps + rbead)
     np.save(os.path.join(out_path, 'ypos.npy'), posvec)
     np.save(os.path.join(out_path, 'zpos.npy'), heights)
+    if len(materials):
+        np.save(os.path.join(out_path, 'basis_materials.npy'), materials)
+        np.save(os.path.join(out_path, 'Gravbasis.npy'), Gbasisarr)
+        np.save(os.path.join(out_path, 'yukbasis.npy'), yukbasisarr)
 
 except Exception:
     print("Couldn't save the data.")
@@ -74,8 +74,10 @@ for fil_ind, fil in enumerate(raw_filenames):
     if not len(posvec):
         posvec = sim_out['posvec']
         attractor_params = sim_out['attractor_params']
-        r0s = list(sim_out[rbead][sep][height].keys())
+        r0s = sim_out['r0s'] if 'r0s' in sim_out \
+                else list(sim_out[rbead][sep][height].keys())
         rhobead = sim_out['rhobead']
+        materials = sim_out.get('materials', [])
     else:
         assert np.sum(posvec - sim_out['posvec']) == 0.0
 
@@ -93,13 +95,18 @@ heights = np.sort(np.unique(heights))
 
 grid_check = np.zeros((len(seps), len(heights)))
 
-### Build up the 3D array of Newtonian and Yukawa-modified forces
-### for each of the positions simulated
+### Build up the 3D array of Newtonian and power-law forces for each of
+### the positions simulated. The power laws are collected per unit r0**dim,
+### with the first axis running over dim = 1 to 4, and scaled to each of
+### r0s on access (see collect_util.R0Scaling and load_powerlaw_curves)
 Goutarr = np.zeros((len(seps), len(posvec), len(heights), 3))
-dim1arr = np.zeros((len(r0s), len(seps), len(posvec), len(heights), 3))
-dim2arr = np.zeros((len(r0s), len(seps), len(posvec), len(heights), 3))
-dim3arr = np.zeros((len(r0s), len(seps), len(posvec), len(heights), 3))
-dim4arr = np.zeros((len(r0s), len(seps), len(posvec), len(heights), 3))
+dimarr = np.zeros((4, len(seps), len(posvec), len(heights), 3))
+
+### If the simulation saved per-material curves, collect those as well so
+### that other density assignments can be built with
+### collect_util.recombine_materials
+Gbasisarr = np.zeros((len(materials), len(seps), len(posvec), len(heights), 3))
+dimbasisarr = np.zeros((4, len(materials), len(seps), len(posvec), len(heights), 3))
 
 for fil_ind, fil in enumerate(raw_filenames):
 
@@ -131,14 +138,26 @@ for fil_ind, fil in enumerate(raw_filenames):
     heightind = np.argmin( np.abs(heights - height) )
     grid_check[sepind, heightind] += 1.0
 
-    ### This is the only major difference from Chas's code, since each r0 value has 3 dimensions of analysis saved in the same array.
+    ### This is the only major difference from Chas's code, since the Newtonian
+    ### term and the 4 power laws are saved in the same tuple, per unit
+    ### r0**dim. Older output saved them scaled, once for each r0
+    basis = sim_out.get('basis')
+    r0_scales = np.ones(5)
+    if isinstance(dat, dict):
+        r0_scales = r0s[0]**np.arange(5)
+        dat = dat[r0s[0]]
+        basis = basis[r0s[0]] if basis is not None else None
+
     for ind in [0,1,2]:
-        Goutarr[sepind,:,heightind,ind] = dat[r0s[0]][ind]
-        for r0ind, r0 in enumerate(r0s):
-            dim1arr[r0ind,sepind,:,heightind,ind] = dat[r0][ind+3]
-            dim2arr[r0ind,sepind,:,heightind,ind] = dat[r0][ind+6]
-            dim3arr[r0ind,sepind,:,heightind,ind] = dat[r0][ind+9]
-            dim4arr[r0ind,sepind,:,heightind,ind] = dat[r0][ind+12]
+        Goutarr[sepind,:,heightind,ind] = dat[ind]
+        for dim in range(4):
+            dimarr[dim,sepind,:,heightind,ind] = dat[ind+3*(dim+1)] / r0_scales[dim+1]
+
+    if len(materials):
+        for ind in [0,1,2]:
+            Gbasisarr[:,sepind,:,heightind,ind] = basis[:,ind]
+            for dim in range(4):
+                dimbasisarr[dim,:,sepind,:,heightind,ind] = basis[:,ind+3*(dim+1)] / r0_scales[dim+1]
 
 print(rbead)
 print("Done!")
@@ -162,14 +181,18 @@ try:
     np.save(os.path.join(out_path, 'rbead_rhobead.npy'), [rbead, rhobead])
     # np.save(os.path.join(out_path, 'rbead.npy'), [rbead])
     np.save(os.path.join(out_path, 'Gravdata.npy'), Goutarr)
-    np.save(os.path.join(out_path, 'Dim1data.npy'), dim1arr)
-    np.save(os.path.join(out_path, 'Dim2data.npy'), dim2arr)
-    np.save(os.path.join(out_path, 'Dim3data.npy'), dim3arr)
-    np.save(os.path.join(out_path, 'Dim4data.npy'), dim4arr)
+    for dim in range(4):
+        np.save(os.path.join(out_path, 'Dim{:d}data_base.npy'.format(dim+1)), dimarr[dim])
     np.save(os.path.join(out_path, 'xpos.npy'), seps + rbead)
     np.save(os.path.join(out_path, 'ypos.npy'), posvec)
     np.save(os.path.join(out_path, 'zpos.npy'), heights)
     np.save(os.path.join(out_path, 'r0s.npy'), r0s)
+    if len(materials):
+        np.save(os.path.join(out_path, 'basis_materials.npy'), materials)
+        np.save(os.path.join(out_path, 'Gravbasis.npy'), Gbasisarr)
+        for dim in range(4):
+            np.save(os.path.join(out_path, 'Dim{:d}basis_base.npy'.format(dim+1)), \
+                    dimbasisarr[dim])
 
 except Exception:
     print("Couldn't save the data.")
@@ -0,0 +1,182 @@
+import os
+
+import numpy as np
+import scipy.interpolate as interp
+
+
+def material_density_vector(materials, densities):
+    '''Turn a density assignment into an array matching the order of
+       the materials axis of a saved per-material basis.
+
+           INPUTS: materials, list of material names, as saved by the
+                       simulation scripts ('vacuum', 'gold', ...)
+                   densities, either an array with one density per
+                       material, a dictionary {material: density}, or
+                       an attractor_params dictionary with 'rho_<name>'
+                       entries. Vacuum and any missing material get 0
+
+           OUTPUTS: array of densities [kg/m^3], one per material
+    '''
+
+    if not isinstance(densities, dict):
+        densities = np.asarray(densities, dtype=float)
+        assert len(densities) == len(materials)
+        return densities
+
+    out = np.zeros(len(materials))
+    for mat_ind, material in enumerate(materials):
+        if material in densities:
+            out[mat_ind] = densities[material]
+        elif 'rho_' + material in densities:
+            out[mat_ind] = densities['rho_' + material]
+
+    return out
+
+
+
+def recombine_materials(basis, materials, densities, axis=0):
+    '''Builds force curves for an arbitrary assignment of material
+       densities from the per-material (unit density) force curves that
+       the simulation scripts save when material_basis=True. Since the
+       force is linear in density, this is just a weighted sum.
+
+           INPUTS: basis, array of per-material force curves, e.g. the
+                       Gravbasis.npy or yukbasis.npy from collect_results
+                   materials, list of material names along the material
+                       axis (basis_materials.npy)
+                   densities, see material_density_vector
+                   axis, index of the material axis in basis. For
+                       Gravbasis this is 0, for yukbasis it's 1
+
+           OUTPUTS: array with the material axis summed out, i.e. the
+                       same shape as Gravdata.npy or yukdata.npy
+    '''
+
+    weights = material_density_vector(materials, densities)
+    basis = np.moveaxis(np.asarray(basis), axis, -1)
+
+    return basis @ weights
+
+
+
+class R0Scaling(object):
+    '''Power-law force curves for each of a set of r0 values, from the
+       r0-independent curves per unit r0**dim that the multidimension
+       scripts save, scaling them only when they're accessed. Indexing
+       works as for the arrays of shape (len(r0s), ...) of the full curves,
+       e.g. curves[r0ind], curves[r0ind, sepind] or curves[:, sepind], and
+       curves.at(r0) gives the curves for any value of r0, so the full
+       arrays are only ever built by np.asarray(curves).
+
+           INPUTS: base, array of curves per unit r0**dim, e.g. the
+                       Dim1data_base.npy from collect_results_multidimension
+                   r0s, array of r0 values along the first axis
+                   dim, power of r0 the curves scale with
+    '''
+
+    def __init__(self, base, r0s, dim):
+        self.base = np.asarray(base)
+        self.r0s = np.asarray(r0s, dtype=float)
+        self.dim = dim
+        self.shape = (len(self.r0s),) + self.base.shape
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return len(self.r0s)
+
+    def at(self, r0):
+        return r0**self.dim * self.base
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) and key[0] is Ellipsis:
+            key = (slice(None),) + key
+        scales = self.r0s[key[0] if len(key) else slice(None)]**self.dim
+        return np.multiply.outer(scales, self.base[key[1:]])
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+
+def load_powerlaw_curves(path, dim, basis=False):
+    '''Power-law curves saved by collect_results_multidimension, as an
+       R0Scaling of the curves per unit r0**dim, or, for older output, the
+       full DimNdata.npy (or DimNbasis.npy) arrays.
+
+           INPUTS: path, directory with the collected output
+                   dim, power law, from 1 to 4
+                   basis, whether to load the per-material curves, with
+                       the material axis first after the r0 axis
+
+           OUTPUTS: R0Scaling, or array of shape (len(r0s), ...)
+    '''
+
+    suffix = 'basis' if basis else 'data'
+    base_filename = os.path.join(path, 'Dim{:d}{:s}_base.npy'.format(dim, suffix))
+    if not os.path.exists(base_filename):
+        return np.load(os.path.join(path, 'Dim{:d}{:s}.npy'.format(dim, suffix)))
+
+    return R0Scaling(np.load(base_filename), np.load(os.path.join(path, 'r0s.npy')), dim)
+
+
+
+def lambda_spline(lambdas, curves, axis=0, peak_axes=None):
+    '''Interpolating function over the Yukawa lambda of force curves given
+       at a set of lambdas, e.g. the accepted values of the adaptive lambda
+       grid of the simulation. The curves fall by many orders of magnitude
+       towards small lambda, at rates that differ between separations, so
+       they're splined in log(lambda) after dividing out their largest
+       magnitude over peak_axes at each lambda, which is itself splined in
+       log-log.
+
+           INPUTS: lambdas, array of lambda values, in any order
+                   curves, array of force curves with the lambda axis at
+                       index axis, e.g. yukdata.npy from collect_results
+                   axis, index of the lambda axis in curves
+                   peak_axes, axes of curves over which the largest
+                       magnitude is taken, e.g. the positions and
+                       components of each separation and height. None
+                       takes all the axes but the lambda axis
+
+           OUTPUTS: function of lambda (a single value or an array) giving
+                        the curves, with the lambda axis at index axis for
+                        an array
+    '''
+
+    lambdas = np.asarray(lambdas, dtype=float)
+    order = np.argsort(lambdas)
+    loglam = np.log(lambdas[order])
+    curves = np.asarray(curves, dtype=float)
+    if peak_axes is None:
+        peak_axes = [ax for ax in range(curves.ndim) if ax != axis % curves.ndim]
+    peak_axes = tuple(ax % curves.ndim + (ax % curves.ndim < axis % curves.ndim) \
+                      for ax in peak_axes)
+    curves = np.moveaxis(curves, axis, 0)[order]
+
+    ### All-zero curves (e.g. underflowed for lambda much smaller than the
+    ### separation) get the smallest positive peak
+    peaks = np.max(np.abs(curves), axis=peak_axes, keepdims=True)
+    peaks = np.maximum(peaks, np.finfo(float).tiny)
+    peak_spline = interp.CubicSpline(loglam, np.log(peaks))
+    shape_spline = interp.CubicSpline(loglam, curves / peaks)
+
+    def curves_at(lam):
+        loglam_q = np.log(np.asarray(lam, dtype=float))
+        out = np.exp(peak_spline(loglam_q)) * shape_spline(loglam_q)
+        return np.moveaxis(out, 0, axis) if out.ndim == curves.ndim else out
+
+    return curves_at
+
+
+
+def load_yukawa_curves(path, basis=False):
+    '''Yukawa curves saved by collect_results, as lambda_spline of
+       yukdata.npy (or yukbasis.npy, for the per-material curves, with the
+       material axis first after the lambda axis) over lambdas.npy, with
+       the peaks taken for each separation and height (and material).'''
+
+    curves = np.load(os.path.join(path, 'yukbasis.npy' if basis else 'yukdata.npy'))
+    return lambda_spline(np.load(os.path.join(path, 'lambdas.npy')), curves, \
+                         peak_axes=(-3, -1))
@@ -0,0 +1,199 @@
+import itertools, functools
+
+import numpy as np
+import scipy.fft
+import scipy.interpolate as interp
+
+import build_attractor_v2_density as density
+import force_kernels
+
+
+def _lattice_steps(bead_axes, spacing):
+    '''Number of bead positions per voxel spacing along each axis, for bead
+       coordinates that are uniformly spaced by an integer fraction of the
+       voxel spacing (or that are a single value).'''
+
+    steps = []
+    for axis, coord in enumerate(bead_axes):
+        if len(coord) == 1:
+            steps.append(1)
+            continue
+        bead_step = coord[1] - coord[0]
+        ratio = spacing[axis] / bead_step
+        step = int(round(ratio))
+        if step < 1 or np.abs(ratio - step) > 1e-6 * step \
+                or not np.allclose(np.diff(coord), bead_step, rtol=1e-6, atol=0.0):
+            raise ValueError('Bead coordinates along axis {:d} need a uniform '.format(axis) \
+                             + 'spacing equal to the voxel spacing divided by an integer')
+        steps.append(step)
+
+    return steps
+
+
+
+def fft_force_basis(xx, yy, zz, labels, radials, bead_x, bead_y, bead_z, spacing=None, \
+                    n_materials=len(density.material_names), workers=None):
+    '''Forces from a grid of voxels on a bead at every point of a lattice of
+       bead positions at once. The force at a bead center c is the sum over
+       voxels v of m(v) * K(c - v), with K the radial force factor times the
+       unit vector (see force_kernels), so with the beads on a lattice with
+       the voxel spacing it's a discrete convolution, done here with
+       zero-padded FFTs. Bead coordinates spaced by a fraction 1/k of the
+       voxel spacing are split into k interleaved lattices, each offset
+       from the voxel grid by a constant, and axes along which there's a
+       single bead coordinate are summed over directly rather than
+       transformed.
+
+       The FFTs have errors of order 1e-16 relative to the largest term of
+       the kernel, so values many orders of magnitude below the peak of a
+       force curve (e.g. far from the attractor, for small Yukawa lambda)
+       are only good to that absolute level.
+
+           INPUTS: xx, yy, zz, labels, as from build_label_array (or a
+                       contiguous sub-selection or slab of it)
+                   radials, list of radial force factors, functions of r
+                   bead_x, bead_y, bead_z, uniformly spaced bead center
+                       coordinates along each axis (or single values), with
+                       spacings of the voxel spacing divided by an integer
+                   spacing, optional (dx, dy, dz), needed if any of the
+                       voxel coordinate arrays has a single entry
+                   workers, number of threads for scipy.fft
+
+           OUTPUTS: forces, array of shape (len(radials), n_materials, 3,
+                        len(bead_x), len(bead_y), len(bead_z)), per unit
+                        density of each material
+    '''
+
+    bead_axes = [np.atleast_1d(np.asarray(coord, dtype=float)) for coord in (bead_x, bead_y, bead_z)]
+    if spacing is None:
+        spacing = [np.abs(coord[1] - coord[0]) for coord in (xx, yy, zz)]
+    spacing = np.array(spacing, dtype=float)
+    vox_start = np.array([xx[0], yy[0], zz[0]])
+    n_vox = np.array(labels.shape)
+
+    steps = _lattice_steps(bead_axes, spacing)
+    n_bead = np.array([-(-len(coord) // step) for coord, step in zip(bead_axes, steps)])
+
+    ### Axes with more than one bead position per interleaved lattice are
+    ### convolved, the others are contracted
+    fft_axes = [axis for axis in range(3) if n_bead[axis] > 1]
+    sum_axes = tuple(axis for axis in range(3) if n_bead[axis] == 1)
+    fft_shape = [scipy.fft.next_fast_len(int(n_vox[axis] + n_bead[axis] - 1), real=True) \
+                 for axis in fft_axes]
+
+    def transform(arr):
+        if not fft_axes:
+            return arr
+        return scipy.fft.rfftn(arr, s=fft_shape, axes=fft_axes, workers=workers)
+
+    ### Transformed voxel volumes of each material present
+    cell_volume = np.prod(spacing)
+    materials = [mat_ind for mat_ind in range(n_materials) \
+                 if mat_ind != density.label_vacuum and np.any(labels == mat_ind)]
+    volume_fts = {mat_ind: transform(np.where(labels == mat_ind, cell_volume, 0.0)) \
+                  for mat_ind in materials}
+
+    forces = np.zeros((len(radials), n_materials, 3) + tuple(len(coord) for coord in bead_axes))
+    for phase in itertools.product(*[range(step) for step in steps]):
+        sub_axes = [coord[start::step] for coord, start, step in zip(bead_axes, phase, steps)]
+        if any(len(sub) == 0 for sub in sub_axes):
+            continue
+
+        ### Separations for each offset between bead and voxel indices. Along
+        ### convolved axes, entry p is bead index minus voxel index plus
+        ### n_vox - 1, and along contracted ones it's the voxel index
+        offsets = []
+        for axis in range(3):
+            if axis in fft_axes:
+                inds = np.arange(-(n_vox[axis] - 1), len(sub_axes[axis]))
+            else:
+                inds = -np.arange(n_vox[axis])
+            offsets.append(sub_axes[axis][0] - vox_start[axis] + inds * spacing[axis])
+        sep = np.meshgrid(*offsets, indexing='ij')
+        full_sep = np.sqrt(sep[0]**2 + sep[1]**2 + sep[2]**2)
+
+        ### The convolution at bead index i sits at index i + n_vox - 1
+        crop = tuple(slice(n_vox[axis] - 1, n_vox[axis] - 1 + len(sub_axes[axis])) \
+                     if axis in fft_axes else slice(None) for axis in range(3))
+        out = tuple(slice(start, None, step) for start, step in zip(phase, steps))
+
+        for rad_ind, radial in enumerate(radials):
+            proj = radial(full_sep) / full_sep
+            for comp in range(3):
+                kernel_ft = transform(proj * sep[comp])
+                for mat_ind in materials:
+                    field = np.sum(volume_fts[mat_ind] * kernel_ft, axis=sum_axes, keepdims=True)
+                    if fft_axes:
+                        field = scipy.fft.irfftn(field, s=fft_shape, axes=fft_axes, \
+                                                 workers=workers)
+                    forces[(rad_ind, mat_ind, comp) + out] = field[crop]
+
+    return forces
+
+
+
+def unit_force_fields(xx, yy, zz, labels, rho_bead, lambdas, bead_x, bead_y, bead_z, \
+                      spacing=None, n_materials=len(density.material_names), workers=None):
+    '''Newtonian and Yukawa force fields from the "unit" radial factors of
+       force_kernels, which don't depend on the bead radius, over a lattice
+       of bead centers (with the same requirements as in fft_force_basis).
+       bead_force_curves turns them into the forces on a bead of any radius,
+       so they only need to be computed once for all bead sizes. Each value
+       of bead_x gets its own transforms, as for small lambda the fields
+       drop by many orders of magnitude along x, and the FFT errors are
+       relative to the largest term of each transform.
+
+           OUTPUTS: fields, array of shape (1 + len(lambdas), n_materials,
+                        3, len(bead_x), len(bead_y), len(bead_z)), with the
+                        Newtonian term first
+    '''
+
+    radials = [functools.partial(force_kernels.newton_unit_radial, rho_bead=rho_bead)] \
+                + [functools.partial(force_kernels.yukawa_unit_radial, rho_bead=rho_bead, \
+                                     yuklambda=yuklambda) for yuklambda in lambdas]
+
+    return np.concatenate([fft_force_basis(xx, yy, zz, labels, radials, [x_val], bead_y, bead_z, \
+                                           spacing=spacing, n_materials=n_materials, \
+                                           workers=workers) \
+                           for x_val in np.atleast_1d(bead_x)], axis=3)
+
+
+
+def bead_force_curves(fields, bead_axes, lambdas, rbead, x, y, z):
+    '''Forces on a bead of radius rbead from the fields of unit_force_fields,
+       computed on the lattice bead_axes = (bead_x, bead_y, bead_z), at the
+       bead centers with coordinates x, y and z. Along lattice axes with a
+       single entry, the coordinates have to be that entry, and otherwise
+       the fields are interpolated with cubic splines. The Yukawa fields
+       decay as exp(-x / lambda) away from the front face of the attractor,
+       which is taken out before interpolating along x.
+
+           OUTPUTS: forces, array of shape (1 + len(lambdas), n_materials,
+                        3, len(x), len(y), len(z))
+    '''
+
+    lambdas = np.asarray(lambdas, dtype=float)
+    queries = [np.atleast_1d(np.asarray(coord, dtype=float)) for coord in (x, y, z)]
+    bead_x = np.asarray(bead_axes[0], dtype=float)
+
+    ### Decay lengths, with no rescaling of the Newtonian field
+    decay = np.concatenate(([np.inf], lambdas))
+    if (bead_x[-1] - bead_x[0]) / np.min(lambdas, initial=np.inf) > 700.0:
+        raise ValueError('The x lattice spans too many lambdas to take out the decay')
+
+    curves = fields * np.exp((bead_x[None,:] - bead_x[0]) / decay[:,None])[:,None,None,:,None,None]
+    for axis in range(3):
+        lattice, query = np.asarray(bead_axes[axis], dtype=float), queries[axis]
+        if len(lattice) == 1:
+            if not np.allclose(query, lattice[0], rtol=1e-9, atol=0.0):
+                raise ValueError('Coordinates along axis {:d} have to be '.format(axis) \
+                                 + 'the single lattice value')
+            curves = np.repeat(curves, len(query), axis=3+axis)
+            continue
+        curves = interp.CubicSpline(lattice, curves, axis=3+axis)(query)
+
+    factors = np.concatenate(([force_kernels.newton_bead_factor(rbead)], \
+                              force_kernels.yukawa_bead_factor(rbead, lambdas)))
+    factors = factors[:,None] * np.exp(-(queries[0][None,:] - bead_x[0]) / decay[:,None])
+
+    return curves * factors[:,None,None,:,None,None]
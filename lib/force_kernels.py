@@ -0,0 +1,523 @@
+import math
+import functools
+
+import numpy as np
+import scipy.interpolate as interp
+
+### Numba is only needed for backend='numba' in point_mass_force_basis
+try:
+    import numba
+except ImportError:
+    numba = None
+
+### Functions also called from the fused kernel of the numba backend
+_jitable = numba.extending.register_jitable if numba is not None else (lambda func: func)
+
+
+### Same value as used in the simulation scripts
+G = 6.67e-11       # m^3 / (kg s^2)
+
+
+### Rough number of bytes of temporaries held per point mass and bead
+### position while summing forces (separations, distances and weighted
+### terms), used to turn a memory budget into a number of point masses
+point_mass_bytes = 128
+
+
+### Sphere-integrated radial force factors. For a point mass m at
+### separation vector d = (bead center - point mass), |d| = r, the force
+### on the bead is
+###
+###         F = m * radial(r) * d / r
+###
+### with the functions below reproducing the expressions used in the
+### simulation scripts (refer to the non-existent LaTeX document in
+### ../documents/ for the derivations).
+###
+### Where the bead radius enters through a dimensionless ratio, the factors
+### share the sphere factors below, which switch to series where the closed
+### forms lose digits to cancellation: the Yukawa one, for lambda much larger
+### than the bead, and the dim = 1 and 3 power laws, for r much larger than
+### the bead. The coefficients are highest order first, for _horner
+
+### exp(-2a) (1 + a) + a - 1 = sum over n >= 3 of (-2)**(n-1) (n-2) / n! a**n,
+### with 20 terms good to 1e-16 for a < 0.5
+_yukawa_series_max = 0.5
+_yukawa_series = tuple((-2.)**(n - 1) * (n - 2) / math.factorial(n) for n in range(22, 2, -1))
+
+### Power laws in x = rbead / r, with 9 terms good to 1e-15 for x < 0.1:
+###     [(1 + x^2) atanh(x) - x] / x^3 = sum over k >= 1 of 4k / (4k^2 - 1) x^(2k - 2)
+###     [x (1 + x^2) / (1 - x^2)^2 - atanh(x)] / x^3
+###                                    = sum over k >= 1 of 4k (k + 1) / (2k + 1) x^(2k - 2)
+_powerlaw_series_max = 0.1
+_dim1_series = tuple(4. * k / (4. * k**2 - 1.) for k in range(9, 0, -1))
+_dim3_series = tuple(4. * k * (k + 1) / (2. * k + 1.) for k in range(9, 0, -1))
+
+
+
+@_jitable
+def _horner(coeffs, y):
+    '''Polynomial in y with the coefficients highest order first, for
+       scalars or arrays, updating a single array in place.'''
+
+    total = 0.0 * y
+    for coeff in coeffs:
+        total *= y
+        total += coeff
+    return total
+
+
+
+@_jitable
+def _powerlaw_shape(x, dim, series):
+    '''Dimensionless power-law factor h(x), with x = rbead / r, from the
+       closed forms, or for dim = 1 and 3, from the series if series is
+       set. Only arithmetic and np.arctanh, mostly in place, so that it's
+       quick for arrays and is also compiled by numba for the fused kernel.
+       1 - x^2 is taken as (1 - x) (1 + x), which keeps its relative
+       accuracy close to the bead.'''
+
+    if dim == 0:
+        return 4. / 3. + 0. * x
+    y = x * x
+    if dim == 1:
+        if series:
+            shape = _horner(_dim1_series, y)
+            shape *= 2. * x
+            return shape
+        shape = np.arctanh(x)
+        shape *= 1. + y
+        shape -= x
+        shape /= y
+        shape *= 2.
+        return shape
+    q = (1. - x) * (1. + x)
+    if dim == 2:
+        shape = 4. * y
+        shape /= q
+        return shape
+    if dim == 3:
+        if series:
+            shape = _horner(_dim3_series, y)
+            shape *= 2. * x * y
+            return shape
+        shape = 1. + y
+        shape *= x
+        shape /= q * q
+        shape -= np.arctanh(x)
+        shape *= 2.
+        return shape
+    shape = 5. - y
+    shape *= 4. / 3. * y * y
+    shape /= q * q * q
+    return shape
+
+
+
+def powerlaw_shape(x, dim):
+    '''Dimensionless factor h of the power laws, such that the sphere
+       factor of powerlaw_radial is rbead**(3 - dim) * h(rbead / r). For
+       dim = 1 and 3, the closed forms lose digits to cancellation for
+       small x, going as 8x/3 and 16x**3/3, so their series are used for
+       x < 0.1.'''
+
+    x = np.asarray(x, dtype=float)
+    if dim not in (1, 3):
+        return _powerlaw_shape(x, dim, False)[()]
+
+    shape = np.asarray(_powerlaw_shape(x, dim, False))
+    np.copyto(shape, _powerlaw_shape(x, dim, True), where=x < _powerlaw_series_max)
+    return shape[()]
+
+
+
+def yukawa_sphere_factor(rbead, yuklambda):
+    '''Position independent factor of the Yukawa term,
+           exp(-2a) (1 + a) + a - 1,    a = rbead / yuklambda,
+       which goes as 2a**3 / 3 for small a, where it is summed as a series
+       instead, since the closed form loses digits to cancellation.'''
+
+    a = np.asarray(rbead / yuklambda, dtype=float)
+    closed = np.exp(-2. * a) * (1. + a) + a - 1.
+    return np.where(a < _yukawa_series_max, a**3 * _horner(_yukawa_series, a), closed)[()]
+
+
+
+def newton_radial(r, rbead, rho_bead):
+    '''Newtonian term, i.e. a point mass equal to the bead mass.'''
+
+    prefac = -1.0 * ((2. * G * rho_bead * np.pi) / (3. * r**2))
+    return prefac * 2. * rbead**3
+
+
+
+def yukawa_radial(r, rbead, rho_bead, yuklambda):
+    '''Yukawa modification with length scale yuklambda (and alpha = 1).'''
+
+    func = yukawa_sphere_factor(rbead, yuklambda)
+    s = r - rbead
+
+    prefac = -1.0 * ((2. * G * rho_bead * np.pi) / (3. * r**2))
+    yukterm = 3 * yuklambda**2 * (r + yuklambda) * func * np.exp( - s / yuklambda )
+
+    return prefac * yukterm
+
+
+
+### The Newtonian and Yukawa factors above separate into a function of the
+### bead radius (and lambda) times a function of r alone, the "unit" radial
+### factors below, so that a force field computed with the latter serves
+### for any bead size. The Yukawa one carries exp(-r/lambda), which is
+### multiplied back by exp(rbead/lambda) in yukawa_bead_factor.
+
+def newton_unit_radial(r, rho_bead):
+    '''newton_radial for rbead**3 = 1, see newton_bead_factor.'''
+
+    prefac = -1.0 * ((2. * G * rho_bead * np.pi) / (3. * r**2))
+    return prefac * 2.
+
+
+
+def newton_bead_factor(rbead):
+    '''Ratio of newton_radial to newton_unit_radial.'''
+
+    return rbead**3
+
+
+
+def yukawa_unit_radial(r, rho_bead, yuklambda):
+    '''yukawa_radial without its dependence on the bead radius, see
+       yukawa_bead_factor.'''
+
+    prefac = -1.0 * ((2. * G * rho_bead * np.pi) / (3. * r**2))
+    return prefac * 3 * yuklambda**2 * (r + yuklambda) * np.exp( - r / yuklambda )
+
+
+
+def yukawa_bead_factor(rbead, yuklambda):
+    '''Ratio of yukawa_radial to yukawa_unit_radial.'''
+
+    return yukawa_sphere_factor(rbead, yuklambda) * np.exp(rbead / yuklambda)
+
+
+
+def radial_opening(radial):
+    '''How coarse the blocks of voxels summing into a radial force factor,
+       bound with functools.partial, can be (see density.pyramid_point_masses).
+       Returns a factor on the opening angle, and the length scale over
+       which the factor varies apart from r itself, i.e. the Yukawa lambda,
+       or None. The power laws beyond the Newtonian term are steep enough
+       near the bead that they need about a third of the angle for the same
+       accuracy.'''
+
+    if isinstance(radial, functools.partial) \
+            and radial.func in (yukawa_radial, yukawa_unit_radial):
+        return 1.0, radial.keywords['yuklambda']
+    if isinstance(radial, functools.partial) and radial.func is powerlaw_radial \
+            and radial.keywords['dim'] > 0:
+        return 1.0 / 3.0, None
+    return 1.0, None
+
+
+
+def powerlaw_radial(r, rbead, rho_bead, dim):
+    '''Power-law modifications, following the gravfac and dim1fac ...
+       dim4fac factors of the multidimension simulation, through
+       powerlaw_shape. dim = 0 gives the Newtonian term, and the result
+       for dim > 0 still needs to be multiplied by r0**dim.'''
+
+    if dim not in (0, 1, 2, 3, 4):
+        raise ValueError('Only dim = 0, 1, 2, 3 and 4 are implemented')
+
+    prefac = -1.0 * G * rho_bead * np.pi * rbead**(3 - dim)
+
+    return prefac * powerlaw_shape(rbead / r, dim) / np.square(r)
+
+
+
+def kernel_plugins(names, rbead, rho_bead, lambdas=(), dims=(1, 2, 3, 4)):
+    '''Radial force factors of a list of kernel plugins, bound to a bead of
+       radius rbead and density rho_bead, so that the engines can evaluate
+       all of them in a single pass over the voxels and bead positions.
+       'newton' is the Newtonian term, 'yukawa' the Yukawa term for each of
+       lambdas, and 'powerlaw' the power-law modifications for each of dims,
+       per unit r0**dim.
+
+           INPUTS: names, list of plugin names
+                   rbead, rho_bead, bead radius and density
+                   lambdas, Yukawa lengths for the 'yukawa' plugin
+                   dims, power-law dimensions for the 'powerlaw' plugin
+
+           OUTPUTS: kernels, list of (name, parameter, radial) for every
+                        term, with the parameter the Yukawa lambda, the
+                        power-law dimension, or None for 'newton'
+    '''
+
+    kernels = []
+    for name in names:
+        if name == 'newton':
+            kernels.append((name, None, functools.partial(newton_radial, rbead=rbead, \
+                                                          rho_bead=rho_bead)))
+        elif name == 'yukawa':
+            kernels += [(name, yuklambda, functools.partial(yukawa_radial, rbead=rbead, \
+                                                            rho_bead=rho_bead, \
+                                                            yuklambda=yuklambda)) \
+                        for yuklambda in lambdas]
+        elif name == 'powerlaw':
+            kernels += [(name, dim, functools.partial(powerlaw_radial, rbead=rbead, \
+                                                      rho_bead=rho_bead, dim=dim)) \
+                        for dim in dims]
+        else:
+            raise ValueError("Unknown kernel plugin '{}'".format(name))
+
+    return kernels
+
+
+
+def point_mass_force_basis(positions, points, volumes, labels, radials, n_materials, \
+                           max_bytes=2**28, backend='numpy'):
+    '''Force on the bead at each of the positions from a set of point
+       masses, for each of the radial force factors above (with their
+       parameters bound, e.g. by functools.partial), per unit density of
+       each material. Positions are evaluated in batches against all of
+       the points at once, with the batch size chosen so that the
+       temporaries take at most max_bytes, and the sums over the points of
+       each material are done as a single matrix product per component.
+
+           INPUTS: positions, array of shape (N, 3) of bead centers
+                   points, volumes, labels, point masses as from
+                       density.grid_point_masses
+                   radials, list of functions of r
+                   n_materials, number of material labels
+                   backend, 'numpy', or 'numba' for the fused loop of
+                       _fused_force_basis, which needs no temporaries
+                       (and ignores max_bytes)
+
+           OUTPUTS: forces, array of shape (len(radials), n_materials, 3, N)
+    '''
+
+    positions = np.atleast_2d(positions)
+    if backend == 'numba':
+        if numba is None:
+            raise ImportError('numba is needed for the numba backend')
+        kinds, params, rbead, rho_bead = _radial_codes(radials)
+        funcs = np.array([yukawa_sphere_factor(rbead, param) if kind == 1 else 0.0 \
+                          for kind, param in zip(kinds, params)])
+        return _fused_force_basis(np.ascontiguousarray(positions, dtype=float), \
+                                  np.ascontiguousarray(points, dtype=float), \
+                                  np.ascontiguousarray(volumes, dtype=float), \
+                                  np.ascontiguousarray(labels, dtype=np.int64), \
+                                  kinds, params, funcs, rbead, rho_bead, n_materials)
+
+    ### Volumes scattered into one column per material, so that the sum
+    ### over points with a given label is a matrix product
+    volume_matrix = np.zeros((len(points), n_materials))
+    volume_matrix[np.arange(len(points)), labels] = volumes
+
+    batch_size = max(1, int(max_bytes // (point_mass_bytes * max(len(points), 1))))
+
+    forces = np.zeros((len(radials), n_materials, 3, len(positions)))
+    for start in range(0, len(positions), batch_size):
+        stop = start + batch_size
+        sep = positions[start:stop,None,:] - points[None,:,:]
+        full_sep = np.sqrt(np.sum(sep**2, axis=-1))
+
+        for rad_ind, radial in enumerate(radials):
+            proj = radial(full_sep) / full_sep
+            for comp in range(3):
+                forces[rad_ind,:,comp,start:stop] = ((proj * sep[...,comp]) @ volume_matrix).T
+
+    return forces
+
+
+
+### For an attractor that is mirror symmetric in y (see density.mirror_symmetric),
+### the x and z forces at -y are those at y, and the y force changes sign. With
+### bead positions along y that are symmetric about 0, only the ones from
+### mirror_half_start on need to be computed
+
+def mirror_half_start(ypos):
+    '''Index of the first of the non-negative bead positions along y, if
+       they're sorted and mirror symmetric about 0, and otherwise 0, i.e.
+       all of them are needed.'''
+
+    ypos = np.asarray(ypos, dtype=float)
+    if len(ypos) < 2 or np.any(np.diff(ypos) <= 0) \
+            or not np.allclose(ypos, -ypos[::-1], rtol=0.0, atol=1e-9 * np.max(np.abs(ypos))):
+        return 0
+    return len(ypos) // 2
+
+
+
+def unfold_mirror(forces, n_positions, zero_z=False, pos_axis=-1, comp_axis=-2):
+    '''Forces at all n_positions bead positions along y from those at the
+       positions from mirror_half_start on, along pos_axis, with the x, y
+       and z components along comp_axis. With zero_z (for a bead at z = 0
+       of an attractor that is mirror symmetric in z), the z force is set
+       to exactly 0.'''
+
+    forces = np.moveaxis(forces, (comp_axis, pos_axis), (-2, -1))
+    n_mirror = n_positions - forces.shape[-1]
+    parity = np.array([1.0, -1.0, 1.0])[:,None]
+    forces = np.concatenate((parity * forces[...,::-1][...,:n_mirror], forces), axis=-1)
+    if zero_z:
+        forces[...,2,:] = 0.0
+
+    return np.moveaxis(forces, (-2, -1), (comp_axis, pos_axis))
+
+
+
+def mirror_average(forces, pos_axis=-1, comp_axis=-2):
+    '''Average of forces at bead positions along y that are mirror symmetric
+       about 0 (along pos_axis) with their mirror images, i.e. the forces
+       of the mirror symmetric average of the masses they come from, with
+       the x, y and z components along comp_axis.'''
+
+    forces = np.moveaxis(forces, (comp_axis, pos_axis), (-2, -1))
+    parity = np.array([1.0, -1.0, 1.0])[:,None]
+    forces = 0.5 * (forces + parity * forces[...,::-1])
+
+    return np.moveaxis(forces, (-2, -1), (comp_axis, pos_axis))
+
+
+
+### Smooth force curves (e.g. at large separations) are well described by a
+### cubic spline through a fraction of the bead positions along y, while
+### the sharp features in front of the finger edges at small separations
+### need most of them. adaptive_position_curves only computes the positions
+### where the spline through those computed so far isn't good enough
+
+def adaptive_position_curves(curves_at, ypos, tolerance, start_step=16, pos_axis=-1, \
+                             term_axis=0):
+    '''Force curves at all of the bead positions ypos along y, from those
+       at a subset of them, refined where needed. They're first computed at
+       every start_step-th position and the last one. Each interval between
+       computed positions is then split at its middle position, as long as
+       the cubic spline through the positions computed so far misses the
+       curves there by more than tolerance relative to their peak, and the
+       rest of the positions are sampled from the final spline.
+
+           INPUTS: curves_at, function of an array of indices into ypos
+                       returning the curves at those positions, along
+                       pos_axis
+                   ypos, sorted bead positions along y
+                   tolerance, largest interpolation error relative to the
+                       peak of the curves
+                   start_step, step in positions of the starting subset
+                   term_axis, axis of the curves (e.g. of the radial force
+                       factors) along which each entry is compared to its
+                       own peak, or None for a single peak
+
+           OUTPUTS: curves, as from curves_at(np.arange(len(ypos)))
+    '''
+
+    ypos = np.asarray(ypos, dtype=float)
+    n_pos = len(ypos)
+    if n_pos <= 2:
+        return curves_at(np.arange(n_pos))
+
+    ### Curves with the terms first and the positions last
+    def standard(curves):
+        if term_axis is None:
+            return np.moveaxis(curves, pos_axis, -1)[None]
+        return np.moveaxis(curves, (term_axis, pos_axis), (0, -1))
+
+    inds = np.unique(np.append(np.arange(0, n_pos, start_step), n_pos - 1))
+    curves = standard(curves_at(inds))
+    intervals = [(lo, hi) for lo, hi in zip(inds[:-1], inds[1:]) if hi - lo > 1]
+    while len(intervals):
+        spline = interp.CubicSpline(ypos[inds], curves, axis=-1)
+        mids = np.array([(lo + hi) // 2 for lo, hi in intervals])
+        actual = standard(curves_at(mids))
+
+        order = np.argsort(np.concatenate((inds, mids)))
+        inds = np.concatenate((inds, mids))[order]
+        curves = np.concatenate((curves, actual), axis=-1)[...,order]
+
+        peaks = np.maximum(np.max(np.abs(curves).reshape(len(curves), -1), axis=1), \
+                           np.finfo(float).tiny)
+        errors = np.abs(spline(ypos[mids]) - actual) / peaks.reshape((-1,) + (1,) * (curves.ndim - 1))
+        errors = np.max(errors.reshape(-1, len(mids)), axis=0)
+        intervals = [new_interval for (lo, hi), mid, error in zip(intervals, mids, errors) \
+                     if error > tolerance for new_interval in ((lo, mid), (mid, hi)) \
+                     if new_interval[1] - new_interval[0] > 1]
+
+    forces = interp.CubicSpline(ypos[inds], curves, axis=-1)(ypos)
+    forces[...,inds] = curves
+    if term_axis is None:
+        return np.moveaxis(forces[0], -1, pos_axis)
+    return np.moveaxis(forces, (0, -1), (term_axis, pos_axis))
+
+
+
+### Integer codes of the radial factors for the compiled kernel
+_radial_kinds = {newton_radial: 0, yukawa_radial: 1, powerlaw_radial: 2}
+
+def _radial_codes(radials):
+    '''Kind codes and parameters (yuklambda or dim) of radial factors given
+       as functools.partial of the functions above, which must share the
+       same rbead and rho_bead.'''
+
+    kinds, params = [], []
+    for radial in radials:
+        if not isinstance(radial, functools.partial) or radial.func not in _radial_kinds:
+            raise ValueError('The numba backend needs functools.partial of ' \
+                             + 'newton_radial, yukawa_radial or powerlaw_radial')
+        kinds.append(_radial_kinds[radial.func])
+        params.append(radial.keywords.get('yuklambda', radial.keywords.get('dim', 0)))
+
+    bead = {(radial.keywords['rbead'], radial.keywords['rho_bead']) for radial in radials}
+    if len(bead) != 1:
+        raise ValueError('All radial factors need the same rbead and rho_bead')
+    rbead, rho_bead = bead.pop()
+
+    return np.array(kinds, dtype=np.int64), np.array(params, dtype=float), \
+                float(rbead), float(rho_bead)
+
+
+
+### The fused kernel behind backend='numba'. For each bead position, in
+### parallel, it loops over the point masses, evaluating the same
+### expressions as the radial functions above with scalars (through the
+### same _powerlaw_shape, and with the Yukawa sphere factors passed in as
+### funcs) and accumulating the components directly into the output. Both
+### functions are defined at module level and take the kinds of the radial
+### factors and their parameters as arguments, so that numba compiles them
+### once and loads them from the on-disk cache (in __pycache__) afterwards
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _radial_value(kind, param, func, r, rbead, rho_bead):
+        ### func is the position independent part of the Yukawa term
+        if kind == 0:
+            prefac = -1.0 * ((2. * G * rho_bead * math.pi) / (3. * r**2))
+            return prefac * 2. * rbead**3
+        elif kind == 1:
+            prefac = -1.0 * ((2. * G * rho_bead * math.pi) / (3. * r**2))
+            return prefac * 3 * param**2 * (r + param) * func * math.exp( - (r - rbead) / param)
+        dim = int(param)
+        x = rbead / r
+        shape = _powerlaw_shape(x, dim, (dim == 1 or dim == 3) and x < _powerlaw_series_max)
+        return -1.0 * G * rho_bead * math.pi * rbead**(3 - dim) * shape / (r*r)
+
+    @numba.njit(parallel=True, cache=True)
+    def _fused_force_basis(positions, points, volumes, labels, kinds, params, funcs, \
+                           rbead, rho_bead, n_materials):
+        forces = np.zeros((len(kinds), n_materials, 3, len(positions)))
+        for ind in numba.prange(len(positions)):
+            for pt in range(len(points)):
+                xsep = positions[ind,0] - points[pt,0]
+                ysep = positions[ind,1] - points[pt,1]
+                zsep = positions[ind,2] - points[pt,2]
+                full_sep = math.sqrt(xsep**2 + ysep**2 + zsep**2)
+                for rad_ind in range(len(kinds)):
+                    ### Skip Yukawa terms whose exponential underflows to 0
+                    if kinds[rad_ind] == 1 and full_sep - rbead > 746. * params[rad_ind]:
+                        continue
+                    proj = _radial_value(kinds[rad_ind], params[rad_ind], funcs[rad_ind], \
+                                         full_sep, rbead, rho_bead) * volumes[pt] / full_sep
+                    forces[rad_ind,labels[pt],0,ind] += proj * xsep
+                    forces[rad_ind,labels[pt],1,ind] += proj * ysep
+                    forces[rad_ind,labels[pt],2,ind] += proj * zsep
+        return forces
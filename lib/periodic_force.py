@@ -0,0 +1,525 @@
+import numpy as np
+import scipy.interpolate as interp
+
+import build_attractor_v2_density as density
+import prism_force
+import fft_force
+import force_kernels
+
+
+### Force curves of the periodic attractor, shared by the simulation
+### scripts. The attractor is split into a unit cell (the central gold
+### finger and half of each neighbouring silicon finger), whose curves
+### are computed once and superposed for every finger, and the outer
+### silicon edge. attractor_model sets up the voxels, point masses and
+### boxes of both regions, along with the settings of the engines, in a
+### dictionary that every other function here takes as its first
+### argument. It only holds arrays and plain values, so it can be handed
+### to joblib workers as an argument, which memory maps the large arrays,
+### and the workers don't depend on the (re-imported) density module
+### having the attractor parameters of the script.
+
+
+
+def attractor_model(xx, yy, zz, labels, beadposvec, beadposvec2, standoff, \
+                    include_edge=True, voxelization='uniform', adaptive_eta=0.5, \
+                    adaptive_scale=None, memory_budget=None, batch_memory=2**28, \
+                    kernel_backend='numpy', pyramid_theta=None, tree_tolerance=1e-4, \
+                    use_symmetry=False, edge_sum='strip', fft_refine=2, \
+                    periodic_sum='spline', material_basis=False):
+    '''Unit cell and outer silicon edge of the attractor described by
+       density.attractor_params, as set when this is called.
+
+           INPUTS: xx, yy, zz, labels, voxel grid of the whole attractor,
+                       as from density.build_label_array, or with labels
+                       None to generate the voxels when needed (with a
+                       memory_budget)
+                   beadposvec, bead positions along y of the output
+                   beadposvec2, positions along y at which the unit cell
+                       curves are computed, covering beadposvec displaced
+                       by every finger. With periodic_sum = 'exact', it's
+                       replaced by a grid with the step of beadposvec
+                   standoff, smallest separation of the bead surface from
+                       the attractor, for the 'adaptive' voxelization
+
+                   The others are the settings of the simulation scripts,
+                   documented there
+
+           OUTPUTS: model, dictionary of the regions and settings
+    '''
+
+    params = dict(density.attractor_params)
+    n_goldfinger = params['n_goldfinger']
+    full_period = params['width_goldfinger'] + params['width_siliconfinger']
+    finger_length = params['finger_length'] + params['include_bridge'] * params['silicon_bridge']
+
+    model = {'attractor_params': params, 'full_period': full_period, \
+             'voxelization': voxelization, \
+             'batch_memory': batch_memory, 'kernel_backend': kernel_backend, \
+             'pyramid_theta': pyramid_theta, 'tree_tolerance': tree_tolerance, \
+             'fft_refine': fft_refine, 'periodic_sum': periodic_sum, \
+             'material_basis': material_basis, 'beadposvec': beadposvec, \
+             'material_densities': density.material_density_table()}
+    model['n_materials'] = len(model['material_densities'])
+
+    ### For the exact periodic sum, the single-period curves are computed on the
+    ### grid of beadposvec extended by the displacement of the outermost fingers
+    if periodic_sum == 'exact':
+        bead_step = beadposvec[1] - beadposvec[0]
+        period_steps = int(round(full_period / bead_step))
+        if np.abs(full_period / bead_step - period_steps) > 1e-6:
+            raise ValueError('The step of beadposvec has to divide the finger period ' \
+                             + 'for the exact periodic sum')
+        n_side = int(0.5*n_goldfinger) * period_steps
+        beadposvec2 = beadposvec[0] + bead_step * np.arange(-n_side, len(beadposvec) + n_side)
+    model['beadposvec2'] = beadposvec2
+
+    ### Define indices for the central gold finger and half of each of
+    ### the neighboring silicon fingers to take advantage of periodicity,
+    ### and the ones outside of the repeated unit cell structure, for the
+    ### outer silicon edge
+    xinds2 = np.abs(xx) <= finger_length
+    yinds2 = np.abs(yy) <= 0.5 * full_period
+    zinds2 = np.abs(zz) <= 0.5 * params['height'] + params['include_black'] * params['black_height']
+    yinds3 = np.abs(yy) >= 0.5 * n_goldfinger * full_period
+
+    xx2, yy2, zz2, yy3 = xx[xinds2], yy[yinds2], zz[zinds2], yy[yinds3]
+    dx, dy, dz = np.abs(xx[1] - xx[0]), np.abs(yy[1] - yy[0]), np.abs(zz[1] - zz[0])
+    model.update({'xx2': xx2, 'yy2': yy2, 'zz2': zz2, 'yy3': yy3, 'spacing': (dx, dy, dz), \
+                  'labels2': None, 'labels3': None})
+    if labels is not None:
+        model['labels2'] = labels[xinds2,:,:][:,yinds2,:][:,:,zinds2]
+        model['labels3'] = labels[xinds2,:,:][:,yinds3,:][:,:,zinds2]
+
+    ### Mirror symmetries of the unit cell and edge regions, and the first of
+    ### the bead positions that are computed for each of them
+    y_symmetric = density.mirror_symmetric(yy2) and density.mirror_symmetric(yy3)
+    y_mirror = use_symmetry and y_symmetric
+    model['z_mirror'] = use_symmetry and density.mirror_symmetric(zz2)
+    model['unit_start'] = force_kernels.mirror_half_start(beadposvec2) if y_mirror else 0
+    model['edge_start'] = force_kernels.mirror_half_start(beadposvec) if y_mirror else 0
+
+    ### With voxel centers on the boundaries of the unit cell, as for a grid
+    ### with its faces on the material boundaries, the selections above take
+    ### the boundary voxels on one side only, which shifts the fingers by half
+    ### a voxel. If the whole grid and the bead positions are mirror symmetric,
+    ### the curves are then averaged with their mirror images, which splits
+    ### the boundary voxels evenly between the neighbouring regions (see
+    ### combine_materials)
+    model['y_average'] = not y_symmetric and density.mirror_symmetric(yy) \
+                            and force_kernels.mirror_half_start(beadposvec2) > 0 \
+                            and force_kernels.mirror_half_start(beadposvec) > 0
+
+    ### The same unit cell and outer silicon edge as exact boxes, for the
+    ### analytic engines and the adaptive voxels. They span the same x range
+    ### as the voxels, and as the attractor has no back face, its boxes run
+    ### as deep as the grid
+    x_lim2 = (np.min(xx2) - 0.5*dx, np.max(xx2) + 0.5*dx)
+    boxes = density.attractor_boxes(depth=-x_lim2[0], params=params)
+    model['boxes'] = { \
+        'unitcell': density.clip_boxes(boxes, x_lim=x_lim2, \
+                                       y_lim=(-0.5*full_period, 0.5*full_period)), \
+        'edge': np.concatenate( \
+            (density.clip_boxes(boxes, x_lim=x_lim2, \
+                                y_lim=(0.5 * n_goldfinger * full_period, np.inf)), \
+             density.clip_boxes(boxes, x_lim=x_lim2, \
+                                y_lim=(-np.inf, -0.5 * n_goldfinger * full_period))))}
+
+    ### Largest number of voxels generated at once, if there is a memory budget
+    model['max_slab_voxels'] = None
+    if memory_budget is not None:
+        model['max_slab_voxels'] = int(memory_budget // force_kernels.point_mass_bytes)
+
+    ### The point masses for the unit cell and outer silicon edge, given as
+    ### chunks of positions, volumes and material labels. The masses themselves
+    ### are the material densities, indexed by the labels, times the volumes.
+    ### With a memory budget, uniform voxels aren't stored at all. The edge
+    ### strips on either side of the fingers are disjoint in y, so they get a
+    ### mass pyramid each, as those need contiguous voxels
+    edge_sides = [yy3 < 0, yy3 >= 0]
+    model['edge_sides'] = edge_sides
+    stored_masses = {}
+    if voxelization == 'adaptive':
+        edge_boxes = model['boxes']['edge']
+        stored_masses['unitcell'] = \
+                [density.adaptive_point_masses(model['boxes']['unitcell'], eta=adaptive_eta, \
+                                               standoff=standoff, length_scale=adaptive_scale)]
+        stored_masses['edge'] = \
+                [[np.concatenate(arrs) for arrs in zip( \
+                    *[density.adaptive_point_masses(edge_boxes[side], eta=adaptive_eta, \
+                                                    standoff=standoff, \
+                                                    length_scale=adaptive_scale) \
+                      for side in [edge_boxes[:,2] >= 0, edge_boxes[:,2] < 0]])]]
+    elif memory_budget is None and pyramid_theta is not None:
+        stored_masses['unitcell'] = [density.build_mass_pyramid(xx2, yy2, zz2, model['labels2'])]
+        stored_masses['edge'] = [density.build_mass_pyramid(xx2, yy3[side], zz2, \
+                                                            model['labels3'][:,side,:]) \
+                                 for side in edge_sides]
+    elif memory_budget is None:
+        stored_masses['unitcell'] = [density.grid_point_masses(xx2, yy2, zz2, model['labels2'])]
+        stored_masses['edge'] = [density.grid_point_masses(xx2, yy3, zz2, model['labels3'])]
+    model['stored_masses'] = stored_masses
+
+    ### For edge_sum = 'strip', the first layer of voxels of each edge strip,
+    ### as point masses, with the number of layers in the strip, provided that
+    ### every layer has the same labels as the first
+    model['edge_layers'] = None
+    model['edge_step'] = beadposvec[1] - beadposvec[0]
+    model['layer_steps'] = int(round(dy / model['edge_step']))
+    if include_edge and edge_sum == 'strip' and voxelization == 'uniform' \
+            and pyramid_theta is None \
+            and np.abs(dy / model['edge_step'] - model['layer_steps']) < 1e-6:
+        edge_layers = []
+        for side in edge_sides:
+            side_yy = yy3[side]
+            layers = [density.material_label_vec(xx2[:,None], side_y, zz2[None,:], \
+                                                 params=params) for side_y in side_yy]
+            if any(np.any(layer != layers[0]) for layer in layers[1:]):
+                edge_layers = None
+                break
+            edge_layers.append((density.grid_point_masses(xx2, side_yy[:1], zz2, \
+                                                          layers[0][:,None,:], \
+                                                          cell_volume=dx*dy*dz), len(side_yy)))
+        model['edge_layers'] = edge_layers
+
+    ### Assuming n_goldfinger is an odd integer, these are the indices of the
+    ### fingers, and for each point in beadposvec, the finger it's in front
+    ### of and the equivalent position in front of the center finger. The
+    ### samples of the single-period curves are then at these positions
+    ### displaced by each finger, with shape (len(beadposvec), n_goldfinger).
+    ### For the exact sum, the copy of each finger starts that many periods
+    ### into beadposvec2
+    finger_inds = np.linspace(-1.0 * int(0.5*n_goldfinger), 1.0 * int(0.5*n_goldfinger), \
+                              n_goldfinger)
+    finger_ind, newypos = find_ind(model, beadposvec)
+    model['finger_samples'] = newypos[:,None] \
+                                + (finger_inds[None,:] + finger_ind[:,None]) * full_period
+    if periodic_sum == 'exact':
+        model['finger_shifts'] = [int(finger - finger_inds[0]) * period_steps \
+                                  for finger in finger_inds]
+
+    return model
+
+
+
+def iter_point_masses(model, region):
+    '''Chunks of point masses for the 'unitcell' or the 'edge' region,
+       either the stored ones or x-slabs of voxels generated on the fly.
+       With pyramid_theta, the uniform chunks are mass pyramids instead,
+       to be resolved for each bead position by point_masses_near.'''
+    if region in model['stored_masses']:
+        return model['stored_masses'][region]
+    xx2, yy2, zz2, yy3 = model['xx2'], model['yy2'], model['zz2'], model['yy3']
+    region_yy = {'unitcell': yy2, 'edge': yy3}[region]
+    if model['pyramid_theta'] is not None:
+        region_yys = {'unitcell': [yy2], 'edge': [yy3[side] for side in model['edge_sides']]}[region]
+        return (density.build_mass_pyramid(*slab, spacing=model['spacing']) \
+                for region_yy in region_yys \
+                for slab in density.iter_label_slabs(xx2, region_yy, zz2, \
+                                                     max_voxels=model['max_slab_voxels'], \
+                                                     params=model['attractor_params']))
+    return density.iter_point_mass_slabs(xx2, region_yy, zz2, max_voxels=model['max_slab_voxels'], \
+                                         params=model['attractor_params'])
+
+
+
+def point_masses_near(model, chunk, beadpos, theta=None, length_scale=None):
+    '''Positions, volumes and labels of the point masses of a chunk from
+       iter_point_masses, as seen from a bead at beadpos, with the blocks of
+       mass pyramids smaller than theta (by default pyramid_theta) times
+       their distance, and times length_scale, if given.'''
+    if model['pyramid_theta'] is None or model['voxelization'] == 'adaptive':
+        return chunk
+    return density.pyramid_point_masses(chunk, beadpos, \
+                                        theta=model['pyramid_theta'] if theta is None else theta, \
+                                        length_scale=length_scale)
+
+
+
+def opening_groups(pyramid, openings, theta):
+    '''Indices of the radial factors with the given openings (see
+       force_kernels.radial_opening), grouped by their factor on the
+       opening angle theta and the number of levels of the pyramid that
+       their length scale allows, as {(factor, n_levels): indices}, so that
+       each group resolves the pyramid once per position.'''
+    groups = {}
+    for rad_ind, (factor, scale) in enumerate(openings):
+        n_levels = len(pyramid) if scale is None \
+                    else sum(np.max(lev['size']) < factor * theta * scale for lev in pyramid)
+        groups.setdefault((factor, n_levels), []).append(rad_ind)
+    return groups
+
+
+
+def fold_point_masses(chunk):
+    '''Uniform voxels of a chunk folded onto z >= 0, for beads at z = 0 (see
+       density.mirror_fold_weights).'''
+    points, volumes, chunk_labels = chunk
+    weights = density.mirror_fold_weights(points[:,2])
+    keep = weights > 0
+    return points[keep], volumes[keep] * weights[keep], chunk_labels[keep]
+
+
+
+def voxel_force_basis(model, region, positions, radials):
+    '''Forces from the point masses of the 'unitcell' or the 'edge' region
+       on the bead at each of the positions, for each of the radial force
+       factors, with shape (len(radials), n_materials, 3, N). Positions
+       are batched against each chunk of point masses, except for mass
+       pyramids, whose point masses depend on the position, and on the
+       length scale of each radial factor (see opening_groups). For beads
+       at z = 0, uniform voxels are folded onto z >= 0 if the grid is
+       mirror symmetric in z.'''
+    if region == 'edge' and model['edge_layers'] is not None:
+        return edge_strip_force_basis(model, positions, radials)
+    n_materials, pyramid_theta = model['n_materials'], model['pyramid_theta']
+    coarsen = pyramid_theta is not None and model['voxelization'] != 'adaptive'
+    z_fold = model['z_mirror'] and model['voxelization'] == 'uniform' \
+                and np.all(positions[:,2] == 0.0)
+    openings = [force_kernels.radial_opening(radial) for radial in radials]
+    forces = np.zeros((len(radials), n_materials, 3, len(positions)))
+    for chunk in iter_point_masses(model, region):
+        if not coarsen:
+            if z_fold:
+                chunk = fold_point_masses(chunk)
+            forces += force_kernels.point_mass_force_basis(positions, *chunk, radials, \
+                                                           n_materials, \
+                                                           max_bytes=model['batch_memory'], \
+                                                           backend=model['kernel_backend'])
+            continue
+        for (factor, n_levels), rad_inds in opening_groups(chunk, openings, pyramid_theta).items():
+            group_radials = [radials[rad_ind] for rad_ind in rad_inds]
+            group_scales = [openings[rad_ind][1] for rad_ind in rad_inds]
+            length_scale = None if None in group_scales else min(group_scales)
+            if n_levels <= 1:
+                ### No blocks are small enough, so the voxels themselves are
+                ### batched over the positions
+                voxels = point_masses_near(model, chunk, positions[0], 0.0)
+                forces[rad_inds] += force_kernels.point_mass_force_basis(positions, *voxels, \
+                                                                         group_radials, n_materials, \
+                                                                         max_bytes=model['batch_memory'], \
+                                                                         backend=model['kernel_backend'])
+                continue
+            for ind, beadpos in enumerate(positions):
+                near = point_masses_near(model, chunk, beadpos, factor * pyramid_theta, length_scale)
+                forces[rad_inds,...,ind:ind+1] += \
+                        force_kernels.point_mass_force_basis(beadpos, *near, group_radials, \
+                                                             n_materials, \
+                                                             max_bytes=model['batch_memory'], \
+                                                             backend=model['kernel_backend'])
+    return forces
+
+
+
+def edge_strip_force_basis(model, positions, radials):
+    '''Same as voxel_force_basis for the 'edge' region, at bead positions
+       along beadposvec (with fixed x and z), from edge_layers. The layer j
+       of a strip acts on a bead at y as the first layer does on one at
+       y - j*dy, so the forces of the first layer are computed once for all
+       of these shifted positions, and the strip sums one slice of them for
+       each layer.'''
+    n_pos = len(positions)
+    dy, layer_steps = model['spacing'][1], model['layer_steps']
+    forces = np.zeros((len(radials), model['n_materials'], 3, n_pos))
+    for chunk, n_layers in model['edge_layers']:
+        if model['z_mirror'] and np.all(positions[:,2] == 0.0):
+            chunk = fold_point_masses(chunk)
+        lattice = positions[0,1] - (n_layers - 1) * dy \
+                    + model['edge_step'] * np.arange(n_pos + (n_layers - 1) * layer_steps)
+        lattice_xyz = np.column_stack((np.full(len(lattice), positions[0,0]), lattice, \
+                                       np.full(len(lattice), positions[0,2])))
+        layer_forces = force_kernels.point_mass_force_basis(lattice_xyz, *chunk, radials, \
+                                                            model['n_materials'], \
+                                                            max_bytes=model['batch_memory'], \
+                                                            backend=model['kernel_backend'])
+        forces += np.sum([layer_forces[...,shift:shift+n_pos] \
+                          for shift in range(0, n_layers * layer_steps, layer_steps)], axis=0)
+    return forces
+
+
+
+def iter_label_chunks(model, region):
+    '''Contiguous blocks (xx, yy, zz, labels) of the voxels of the 'unitcell'
+       or the 'edge' region, the stored ones or x-slabs generated on the fly.'''
+    region_yy = {'unitcell': model['yy2'], 'edge': model['yy3']}[region]
+    sides = [np.ones(len(region_yy), dtype=bool)] if region == 'unitcell' else model['edge_sides']
+    for side in sides:
+        if model['labels2'] is not None:
+            region_labels = {'unitcell': model['labels2'], 'edge': model['labels3']}[region]
+            yield model['xx2'], region_yy[side], model['zz2'], region_labels[:,side,:]
+        else:
+            yield from density.iter_label_slabs(model['xx2'], region_yy[side], model['zz2'], \
+                                                max_voxels=model['max_slab_voxels'], \
+                                                params=model['attractor_params'])
+
+
+
+def iter_tree_chunks(model, region):
+    '''Mass pyramids with second moments for the 'tree' engines, along with
+       the voxels themselves as point masses for the direct sum, for each
+       chunk of iter_label_chunks.'''
+    dx, dy, dz = model['spacing']
+    for chunk in iter_label_chunks(model, region):
+        yield density.build_mass_pyramid(*chunk, spacing=(dx, dy, dz), order=2), \
+              density.grid_point_masses(*chunk, cell_volume=dx*dy*dz)
+
+
+
+def tree_force_basis(model, region, positions, radials):
+    '''Same as voxel_force_basis, through the pyramids of iter_tree_chunks,
+       each resolved for each bead position by density.pyramid_point_masses.
+       The opening angle theta = 2.7 * tree_tolerance**(1/4) gives errors of
+       about tree_tolerance relative to the largest component, with the
+       second moments of the blocks. Radial factors are grouped by their
+       opening angle and the levels of the pyramid that their length scale
+       allows (see opening_groups), so that each group resolves the
+       pyramid once per position.'''
+    tree_tolerance = model['tree_tolerance']
+    theta = min(0.5, 2.7 * tree_tolerance**0.25)
+    openings = [force_kernels.radial_opening(radial) for radial in radials]
+    forces = np.zeros((len(radials), model['n_materials'], 3, len(positions)))
+    for pyramid, direct in iter_tree_chunks(model, region):
+        groups = opening_groups(pyramid, openings, theta)
+        box_lo = pyramid[0]['origin']
+        box_hi = box_lo + np.array(pyramid[0]['weights'].shape[:3]) * pyramid[0]['size']
+        for ind, beadpos in enumerate(positions):
+            gaps = np.maximum(np.maximum(box_lo - beadpos, beadpos - box_hi), 0.0)
+            box_dist = np.sqrt(np.sum(gaps**2))
+            for (factor, _), rad_inds in groups.items():
+                group_scales = [openings[rad_ind][1] for rad_ind in rad_inds]
+                length_scale, cutoff = None, None
+                if None not in group_scales:
+                    length_scale = min(group_scales)
+                    cutoff = box_dist + max(group_scales) * np.log(1.0 / tree_tolerance)
+                chunk = density.pyramid_point_masses(pyramid, beadpos, theta=factor * theta, \
+                                                     length_scale=length_scale, cutoff=cutoff)
+                if len(chunk[0]) >= len(direct[0]):
+                    chunk = direct
+                forces[rad_inds,...,ind:ind+1] += \
+                        force_kernels.point_mass_force_basis(beadpos, *chunk, \
+                                                             [radials[rad_ind] for rad_ind in rad_inds], \
+                                                             model['n_materials'], \
+                                                             max_bytes=model['batch_memory'], \
+                                                             backend=model['kernel_backend'])
+    return forces
+
+
+
+def fft_force_curves(model, region, positions, radials, bead_x, bead_z):
+    '''Forces from the voxels of the 'unitcell' or the 'edge' region on the
+       bead at the given y positions, with shape (len(radials), n_materials,
+       3, N). The FFT convolution needs the bead on a lattice with a spacing
+       of dy / fft_refine, so it's computed on one covering the positions
+       and interpolated with cubic splines.'''
+    lattice = bead_lattice(positions, model['spacing'][1] / model['fft_refine'])
+    forces = np.zeros((len(radials), model['n_materials'], 3, len(lattice)))
+    for chunk in iter_label_chunks(model, region):
+        forces += fft_force.fft_force_basis(*chunk, radials, [bead_x], lattice, [bead_z], \
+                                            spacing=model['spacing'], \
+                                            n_materials=model['n_materials'])[...,0,:,0]
+    return interp.CubicSpline(lattice, forces, axis=-1)(positions)
+
+
+
+def bead_lattice(positions, step):
+    '''Uniform lattice with the given step covering the positions, with two
+       extra points on either side for the splines.'''
+    n_lattice = int(np.ceil((np.max(positions) - np.min(positions)) / step)) + 5
+    return np.min(positions) - 2.0 * step + step * np.arange(n_lattice)
+
+
+
+def radial_force_basis(model, engine, region, positions, radials, rbead):
+    '''Forces from the voxels of the 'unitcell' or the 'edge' region on the
+       bead at the positions, shape (N, 3), for any radial force factors,
+       with one of the engines that take them: 'voxel', 'tree', 'fft' or
+       'cubature'. All the factors share a single pass of the engine, except
+       that 'cubature' refines separately for each of their length scales
+       (see force_kernels.radial_opening).'''
+    if engine == 'tree':
+        return tree_force_basis(model, region, positions, radials)
+    if engine == 'fft':
+        return fft_force_curves(model, region, positions[:,1], radials, positions[0,0], \
+                                positions[0,2])
+    if engine == 'cubature':
+        n_materials = model['n_materials']
+        scales = [force_kernels.radial_opening(radial)[1] for radial in radials]
+        forces = np.zeros((len(radials), n_materials, 3, len(positions)))
+        for scale in set(scales):
+            rad_inds = [rad_ind for rad_ind in range(len(radials)) if scales[rad_ind] == scale]
+            forces[rad_inds] = prism_force.cubature_force_basis(positions, model['boxes'][region], \
+                                                                [radials[rad_ind] for rad_ind in rad_inds], \
+                                                                rbead, length_scale=scale, \
+                                                                n_materials=n_materials)
+        return forces
+    return voxel_force_basis(model, region, positions, radials)
+
+
+
+def lattice_engine(model, engine, region):
+    '''Whether an engine computes the 'unitcell' or the 'edge' region on a
+       lattice of bead positions, rather than position by position, i.e.
+       'fft', and 'voxel' for the edge strips of edge_sum = 'strip'.'''
+    return engine == 'fft' \
+            or (engine == 'voxel' and region == 'edge' and model['edge_layers'] is not None)
+
+
+
+### Function to determine which finger you're in front of, and then
+### compute the equivalent coordinate assuming you're in front of the
+### central finger. Part of the perdicity. Works on single positions or
+### arrays of them
+def find_ind(model, ypos):
+    full_period = model['full_period']
+    extrapos = np.abs(ypos) - 0.5*full_period
+    ind = np.where(extrapos <= 0.0, 0.0, \
+                   np.sign(ypos) * (np.floor(extrapos / full_period) + 1))
+
+    newypos = ypos - ind * full_period
+
+    return ind, newypos
+
+
+
+### Take force curves from a single period of the fingers, sampled along
+### beadposvec2 with shape (..., 3, len(beadposvec2)), and sum the properly
+### displaced copies to build the force from the full finger array at
+### each point in beadposvec. All the components (and materials, etc.)
+### share a single interpolating spline, evaluated at every sample at once,
+### or for the exact sum, the copies are slices of the curves
+def superpose_fingers(model, forcecurves):
+    if model['periodic_sum'] == 'exact':
+        return np.sum([forcecurves[...,shift:shift+len(model['beadposvec'])] \
+                       for shift in model['finger_shifts']], axis=0)
+
+    spline = interp.interp1d(model['beadposvec2'], forcecurves, kind='cubic', axis=-1)
+    return np.sum(spline(model['finger_samples']), axis=-1)
+
+
+
+### Combine per-material curves from the unit cell and the edge strip,
+### each with shape (n_materials, 3, N), into the full-attractor force.
+### If material_basis is set, also return the per-material full-attractor
+### curves for unit density. Curves computed only from unit_start and
+### edge_start on are mirrored to the rest of the positions first, with
+### the z forces set to 0 if zero_z, and averaged with their mirror images
+### for y_average (see attractor_model)
+def combine_materials(model, unitcell_basis, edge_basis, zero_z=False):
+
+    material_densities = model['material_densities']
+    unitcell_basis = force_kernels.unfold_mirror(unitcell_basis, len(model['beadposvec2']), zero_z)
+    edge_basis = force_kernels.unfold_mirror(edge_basis, len(model['beadposvec']), zero_z)
+    if model['y_average']:
+        unitcell_basis = force_kernels.mirror_average(unitcell_basis)
+        edge_basis = force_kernels.mirror_average(edge_basis)
+
+    if model['material_basis']:
+        basis = superpose_fingers(model, unitcell_basis) + edge_basis
+        return np.tensordot(material_densities, basis, axes=1), basis
+
+    else:
+        ### Superposition is linear, so weight by density before building
+        ### the interpolating functions to only do it once
+        newforces = superpose_fingers(model, np.tensordot(material_densities, unitcell_basis, axes=1)) \
+                        + np.tensordot(material_densities, edge_basis, axes=1)
+        return newforces, None
@@ -0,0 +1,256 @@
+import numpy as np
+
+import build_attractor_v2_density as density
+
+
+### Same value as used in the simulation scripts
+G = 6.67e-11       # m^3 / (kg s^2)
+
+
+def _xlog(a, b, rest_sq, r):
+    '''Computes a * ln(b + r) with r = sqrt(b^2 + rest_sq), returning 0
+       where a vanishes. For b < 0 the argument is rewritten as
+       rest_sq / (r - b) to avoid cancellation (and log(0) on the line
+       through a box edge).'''
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logterm = np.where(b >= 0, np.log(np.abs(b) + r), \
+                           np.log(rest_sq) - np.log(r - b))
+        return np.where(a == 0, 0.0, a * logterm)
+
+
+
+def _xatan(a, b, c, r):
+    '''Computes a * arctan(b * c / (a * r)), with the a -> 0 limit of 0.'''
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(a == 0, 0.0, a * np.arctan(b * c / (a * r)))
+
+
+
+def _corner_term(u, v, w):
+    '''Antiderivative over a box corner of the component of the inverse
+       square field along u, i.e. the function whose alternating sum
+       over the 8 corners gives the integral of u / r^3 over the box.'''
+
+    u2, v2, w2 = u**2, v**2, w**2
+    r = np.sqrt(u2 + v2 + w2)
+    return -1.0 * (_xlog(v, w, u2 + v2, r) + _xlog(w, v, u2 + w2, r) \
+                        - _xatan(u, v, w, r))
+
+
+
+def box_field_integrals(positions, boxes):
+    '''Closed-form integral of (r' - r) / |r' - r|^3 over each box, for
+       each position r. This is the Newtonian field of the box for unit
+       density, divided by G.
+
+           INPUTS: positions, array of shape (N, 3)
+                   boxes, array of shape (Nbox, >=6) as returned by
+                       density.attractor_boxes
+
+           OUTPUTS: array of shape (Nbox, 3, N)
+    '''
+
+    positions = np.atleast_2d(positions)
+    boxes = np.atleast_2d(boxes)
+
+    ### Corner coordinates relative to each position, shape (Nbox, N, 2)
+    rel = [boxes[:,None,2*axis:2*axis+2] - positions[None,:,axis,None] \
+            for axis in range(3)]
+
+    out = np.zeros((len(boxes), 3, len(positions)))
+    for i, j, k in np.ndindex(2, 2, 2):
+        sign = (-1.0)**(i + j + k + 1)
+        u, v, w = rel[0][:,:,i], rel[1][:,:,j], rel[2][:,:,k]
+        out[:,0,:] += sign * _corner_term(u, v, w)
+        out[:,1,:] += sign * _corner_term(v, w, u)
+        out[:,2,:] += sign * _corner_term(w, u, v)
+
+    return out
+
+
+
+def newton_force_basis(positions, boxes, rbead, rho_bead, \
+                       n_materials=len(density.material_names)):
+    '''Exact Newtonian force on a uniform sphere outside of the boxes,
+       split by the material label of the boxes, for unit density. There
+       is no voxelization, so the result is independent of any grid
+       spacing. Since the bead is a sphere, it acts as a point mass at
+       its center.
+
+           INPUTS: positions, bead centers, array of shape (N, 3)
+                   boxes, array of shape (Nbox, 7) from attractor_boxes
+                   rbead, rho_bead, bead radius and density
+
+           OUTPUTS: array of shape (n_materials, 3, N)
+    '''
+
+    mbead = 4.0 / 3.0 * np.pi * rbead**3 * rho_bead
+    per_box = G * mbead * box_field_integrals(positions, boxes)
+
+    out = np.zeros((n_materials, 3, per_box.shape[2]))
+    np.add.at(out, boxes[:,6].astype(int), per_box)
+
+    return out
+
+
+
+def newton_force_boxes(positions, boxes, rbead, rho_bead, densities=None):
+    '''Exact Newtonian force curves on the bead at each position, with
+       shape (3, N), the same quantity simulation() builds by summing
+       point masses. Densities are indexed by the box labels, and default
+       to density.material_density_table().'''
+
+    if densities is None:
+        densities = density.material_density_table()
+
+    basis = newton_force_basis(positions, boxes, rbead, rho_bead, \
+                               n_materials=len(densities))
+
+    return np.tensordot(densities, basis, axes=1)
+
+
+
+def box_distances(positions, boxes):
+    '''Distance from each position to the nearest point of each box,
+       with positions of shape (N, 3) and the output of shape (N, Nbox).
+       Boxes can also be given as one box per position, in which case
+       both have the same length and the output has shape (N,).'''
+
+    gaps = [np.maximum(np.maximum(boxes[...,2*axis] - positions[...,axis], \
+                                  positions[...,axis] - boxes[...,2*axis+1]), 0.0) \
+            for axis in range(3)]
+
+    return np.sqrt(gaps[0]**2 + gaps[1]**2 + gaps[2]**2)
+
+
+
+def _split_boxes(boxes, owners, split):
+    '''Halve each box flagged in split along every axis that is at least
+       half as long as its longest one. Returns the new boxes and the
+       index of the position each belongs to.'''
+
+    keep_boxes, keep_owners = [boxes[~split]], [owners[~split]]
+    boxes, owners = boxes[split], owners[split]
+
+    extents = boxes[:,1:6:2] - boxes[:,0:6:2]
+    longest = np.max(extents, axis=1)
+    for axis in range(3):
+        halve = extents[:,axis] >= 0.5 * longest
+        mid = 0.5 * (boxes[halve,2*axis] + boxes[halve,2*axis+1])
+
+        lower, upper = boxes[halve].copy(), boxes[halve].copy()
+        lower[:,2*axis+1] = mid
+        upper[:,2*axis] = mid
+
+        boxes = np.concatenate((boxes[~halve], lower, upper))
+        owners = np.concatenate((owners[~halve], owners[halve], owners[halve]))
+        extents = np.concatenate((extents[~halve], extents[halve], extents[halve]))
+        longest = np.concatenate((longest[~halve], longest[halve], longest[halve]))
+
+    return np.concatenate(keep_boxes + [boxes]), np.concatenate(keep_owners + [owners])
+
+
+
+def cubature_force_basis(positions, boxes, radials, rbead, length_scale=None, \
+                         eta=0.5, lambda_eta=4.0, cutoff=10.0, order=4, \
+                         max_depth=12, chunk_size=16, max_points=4000000, \
+                         n_materials=len(density.material_names)):
+    '''Integrate sphere-integrated radial force kernels (see the functions
+       in force_kernels) over the attractor boxes with adaptive, tensor
+       product Gauss-Legendre cubature. Instead of a midpoint sum over 
+       voxels of a fixed size, boxes are recursively halved for each bead
+       position until they are small compared to their distance from the
+       bead and, for kernels with a length scale like the Yukawa lambda,
+       small compared to that scale wherever the kernel hasn't decayed.
+       Far boxes thus stay coarse while the bead-facing surface is refined.
+
+           INPUTS: positions, bead centers, array of shape (N, 3)
+                   boxes, array of shape (Nbox, 7) from attractor_boxes
+                   radials, list of functions of r returning the radial
+                       factor, all evaluated on the same cubature points
+                       e.g. lambda r: yukawa_radial(r, rbead, rho_bead, lam)
+                   rbead, bead radius (the distances for cutoff are
+                       measured from the nearest box instead, so that they
+                       don't depend on it)
+                   length_scale, smallest length scale of the kernels 
+                       (e.g. yuklambda), or None for scale-free kernels
+                   eta, maximum ratio of box size to distance
+                   lambda_eta, maximum ratio of box size to length_scale
+                   cutoff, boxes further than cutoff*length_scale beyond
+                       the box nearest to the bead, where the kernel has
+                       decayed by exp(-cutoff) relative to its largest
+                       terms, are only refined geometrically
+                   order, number of Gauss-Legendre nodes per axis
+                   max_depth, maximum number of refinement passes
+                   chunk_size, number of positions refined together
+                   max_points, bound on the number of cubature points
+                       evaluated at once, to limit memory use
+
+           OUTPUTS: array of shape (len(radials), n_materials, 3, N), the
+                       force per unit density of each material
+    '''
+
+    positions = np.atleast_2d(positions)
+    boxes = np.atleast_2d(boxes)
+    npos = len(positions)
+
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    tx, ty, tz = np.meshgrid(nodes, nodes, nodes, indexing='ij')
+    node_offsets = np.stack((tx.ravel(), ty.ravel(), tz.ravel()), axis=1)
+    node_weights = np.einsum('i,j,k->ijk', weights, weights, weights).ravel() / 8.0
+
+    out = np.zeros((len(radials), n_materials, 3, npos))
+    for start in range(0, npos, chunk_size):
+        chunk = positions[start:start+chunk_size]
+
+        ### Every (position, box) pair starts as a leaf
+        owners = np.repeat(np.arange(len(chunk)), len(boxes))
+        leaves = np.tile(boxes, (len(chunk), 1))
+
+        ### Distance from each position to its nearest box, which splitting
+        ### doesn't change
+        nearest = np.min(box_distances(chunk[:,None,:], boxes[None,:,:]), axis=1)
+
+        for depth in range(max_depth):
+            size = np.max(leaves[:,1:6:2] - leaves[:,0:6:2], axis=1)
+            dist = box_distances(chunk[owners], leaves)
+
+            split = size > eta * dist
+            if length_scale is not None:
+                split |= (size > lambda_eta * length_scale) \
+                            & (dist - nearest[owners] < cutoff * length_scale)
+
+            if not np.any(split):
+                break
+            leaves, owners = _split_boxes(leaves, owners, split)
+
+        ### Integrate the leaves, in batches to bound the memory used by
+        ### the cubature points
+        batch = max(1, int(max_points // len(node_weights)))
+        for lstart in range(0, len(leaves), batch):
+            lbox = leaves[lstart:lstart+batch]
+            lown = owners[lstart:lstart+batch]
+
+            centers = 0.5 * (lbox[:,0:6:2] + lbox[:,1:6:2])
+            halfs = 0.5 * (lbox[:,1:6:2] - lbox[:,0:6:2])
+            volume = 8.0 * np.prod(halfs, axis=1)
+
+            ### Separation vectors (bead - point), shape (Nleaf, Nnode, 3)
+            seps = chunk[lown][:,None,:] - (centers[:,None,:] \
+                        + halfs[:,None,:] * node_offsets[None,:,:])
+            r = np.sqrt(np.sum(seps**2, axis=2))
+            w = node_weights[None,:] * volume[:,None]
+
+            ### Accumulate into (material, position) bins
+            bins = lbox[:,6].astype(int) * len(chunk) + lown
+            for kind, radial in enumerate(radials):
+                weighted = w * radial(r) / r
+                for comp in range(3):
+                    sums = np.bincount(bins, weights=np.sum(weighted * seps[:,:,comp], axis=1), \
+                                       minlength=n_materials*len(chunk))
+                    out[kind,:,comp,start:start+len(chunk)] += \
+                                    sums.reshape(n_materials, len(chunk))
+
+    return out
@@ -7,10 +7,16 @@ import pickle as pickle
 import scipy.interpolate as interp
 import scipy.signal as signal
 import scipy.optimize as opti
-import scipy, sys, time, os, itertools
+import scipy, sys, time, os, itertools, functools
 
 import build_attractor_v2_density as density
 import bead_util as bu
+import prism_force
+import column_force
+import fft_force
+import force_kernels
+import periodic_force
+import collect_util
 
 from numba import jit
 from datetime import date
@@ -52,10 +58,146 @@ density.attractor_params['total_height'] = \
 
 ### Whether or not to include the outer silicon edge at the limits
 ### of y (I think it amounts to a 12um wide strip of silicon) so it
-### shouldn't change too much. It does increase computation time by 
-### a factor of a few, but is more complete to include
+### shouldn't change too much. Summed directly over the voxels, it
+### increases computation time by a factor of a few, but is more complete
+### to include, and costs little with edge_sum = 'strip' below
 include_edge = False
 
+### Whether to also save one force curve per material (for unit density),
+### so that any other assignment of densities is just a weighted sum of
+### these, done at collection time (see collect_util.recombine_materials)
+material_basis = False
+
+### How to compute the Newtonian force curves. 'voxel' sums the point
+### masses of the voxel grid, while 'prism' uses the closed-form field of
+### the rectangular boxes making up the attractor, which is exact (no
+### dependence on dxyz) and much faster. 'columns' merges the voxels into
+### x-uniform line segments integrated in closed form along x, so only
+### the (y, z) sum remains (see column_force). That is less accurate than
+### 'voxel' on the same grid though, as the midpoint sum in y and z no
+### longer cancels against the one in x: with the 1um voxels below, it's
+### off from 'prism' by about 2e-4 relative to the peak. 'voxel' is off by
+### about 2e-7 with include_edge, and 1.3e-4 without it, as the voxels at
+### the outer ends of the fingers are then split in half (see
+### periodic_force.attractor_model). 'prism' is the better choice for the
+### Newtonian term. 'fft' convolves the voxel grid with the kernel over a
+### lattice of bead positions, see periodic_force.fft_force_curves. 'unit'
+### computes FFT fields that don't depend on the bead radius once, for all
+### of rbeads and seps, so that simulation() only interpolates and scales
+### them (see fft_force.bead_force_curves). 'tree' sums the voxels with
+### far-field blocks, to tree_tolerance below
+newton_engine = 'voxel'
+
+### How to compute the Yukawa force curves. 'voxel' uses the midpoint sum
+### over the voxel grid, which is badly under-resolved when lambda or the
+### separation are only a few dxyz. 'cubature' integrates the kernel over
+### the attractor boxes with adaptive Gauss-Legendre cubature, refining
+### only near the bead (see prism_force.cubature_force_basis). 'columns'
+### integrates along x-uniform line segments of the voxel grid, exactly
+### for the x component and with 1D quadrature for the others, which is
+### within 3e-3 of 'cubature' for lambda from 0.2 to 3 um, where 'voxel'
+### is off by up to 60% (see column_force.yukawa_column_basis). 'fft' gives
+### the same as 'voxel', through FFT convolutions, and 'unit' and 'tree'
+### as for the Newtonian term
+yukawa_engine = 'voxel'
+
+### How to compute the power laws of the multidimension script, if
+### 'powerlaw' is in extra_kernels below. Any of the engines that take
+### arbitrary radial factors: 'voxel', 'tree', 'fft' or 'cubature'
+powerlaw_engine = 'voxel'
+
+### Other kernel plugins to compute along with the Newtonian and Yukawa
+### terms (see force_kernels.kernel_plugins). All the terms that use the
+### same one of the engines above that take arbitrary radial factors are
+### summed in a single pass over the voxels and bead positions, so e.g.
+### ['powerlaw'] adds the power laws for little more than the cost of
+### evaluating their kernels. Their curves are saved in results_dic under
+### the plugin name and then the parameter, e.g. results_dic['powerlaw'][1]
+### for dim = 1, per unit r0**dim, as (Fx, Fy, Fz)
+extra_kernels = []
+
+### Bead positions per voxel along y for the 'fft' engines, and along x and
+### y for the 'unit' engines. Their results are splined from that lattice
+### to the actual bead positions
+fft_refine = 2
+
+### Point masses used by the 'voxel' engines. 'uniform' takes the voxels
+### of the grid built below with spacing dxyz, while 'adaptive' builds an
+### octree that is fine near the bead-facing surface and coarse deep in
+### the bulk, with cell sizes at most adaptive_eta times their distance
+### from the bead (see density.adaptive_point_masses). Within 10 lambdas
+### of that surface, cells are also refined below each of the Yukawa
+### lambdas. For 0.5, the Newtonian curves are off by about 3e-5 relative
+### to their peak (the 1um 'uniform' voxels with include_edge by about
+### 2e-7), and the Yukawa curves by about 1.6e-2 for lambda = 0.2um, 6e-3
+### for 3.4um and 1e-4 above 50um, as cells near the surface are only
+### refined down to about lambda. Small lambdas also make the octree much
+### larger, so 'cubature' is the better choice for the Yukawa terms
+voxelization = 'uniform'
+adaptive_eta = 0.5
+
+### Memory budget in bytes for the 'uniform' voxels, or None. If set, the
+### full grid is never built. Instead, slabs of voxels are generated when
+### needed, and forces are accumulated slab by slab, so that peak memory
+### stays bounded for arbitrarily small dxyz
+memory_budget = None
+
+### Memory in bytes for the temporaries of each batch of bead positions
+### evaluated at once against the voxels (see the docstring of
+### force_kernels.point_mass_force_basis)
+batch_memory = 2**28 if memory_budget is None else memory_budget
+
+### 'numpy' or 'numba' for the voxel sums. The numba kernel is a single
+### fused loop over the point masses, parallel over bead positions, and is
+### compiled once and cached on disk (in __pycache__), so that the workers
+### only load it
+kernel_backend = 'numpy'
+
+### Opening angle for far-field coarsening of the 'uniform' voxels, or
+### None to sum every voxel. If set, the voxels are summed into a pyramid
+### of 2x2x2 blocks, and each bead position uses the coarsest blocks that
+### are smaller than pyramid_theta times their distance from the bead
+### (see density.pyramid_point_masses). For 0.1, the curves are off by
+### about 1.5e-4 relative to their peak, with 10-100x fewer point masses
+### per position. Yukawa terms also keep the blocks smaller than
+### pyramid_theta times lambda (see periodic_force.opening_groups), which
+### holds them to the same level, but leaves the voxels as they are for
+### lambdas below about 1/pyramid_theta voxels
+pyramid_theta = None
+
+### Relative accuracy of the 'tree' engines, which sum the voxels through a
+### mass pyramid that also keeps the second moments of the blocks (see
+### density.build_mass_pyramid). Seen from each bead position, blocks are
+### resolved down to an opening angle set by the tolerance, and for Yukawa
+### terms, down to a fraction of lambda as well, while voxels that are
+### ln(1/tree_tolerance) lambdas farther than the nearest ones are left out.
+### Positions where that takes more point masses than the voxels themselves
+### fall back to the direct sum (see periodic_force.tree_force_basis)
+tree_tolerance = 1e-4
+
+### Whether to use the mirror symmetry of the attractor in y and z, if the
+### voxel grid has it (see density.mirror_symmetric). The curves are then
+### only computed at the bead positions with y >= 0, and mirrored to the
+### others (see force_kernels.unfold_mirror). For beads at z = 0, the z
+### forces are exactly 0, and the 'uniform' voxel sums only take the voxels
+### with z >= 0, with doubled masses off the z = 0 plane. The grid below has
+### voxel centers on the boundaries of the unit cell, whose voxels are then
+### split between neighbouring cells instead (see
+### periodic_force.attractor_model), so only the z symmetry applies to it.
+### Off by default, so that the curves don't depend on how the voxels are
+### summed; on the grid below it only changes them by rounding (2e-13)
+use_symmetry = False
+
+### How the 'voxel' engines sum the outer silicon edge. Each of the two edge
+### strips is the same layer of voxels repeated along y, so with 'strip',
+### the forces of a single layer are computed once, on a lattice of bead
+### positions with the step of beadposvec, and those of the strip are sums
+### of copies shifted by dy (see periodic_force.edge_strip_force_basis).
+### 'direct' sums all of the voxels for every bead position, as for the
+### unit cell. 'strip' needs uniform voxels without a pyramid, and a step
+### of beadposvec that divides dy, and otherwise falls back to 'direct'
+edge_sum = 'strip'
+
 ### End values for the ranges are very important, see the function
 ### docstring (and consider how to define the CENTERS of cubic unit
 ### cells, such that the unit cells themselves actually span the 
@@ -67,11 +209,21 @@ dxyz = (1)*1e-6
 x_range = (-200*1e-6+dxyz/2, 0e-6)
 y_range = ((-density.attractor_params['total_width']/2+dxyz/2), density.attractor_params['total_width']/2)
 z_range = (-density.attractor_params['total_height']/2+dxyz/2, density.attractor_params['total_height']/2)
-xx, yy, zz, rho = \
-    density.build_3d_array(x_range=x_range, dx=dxyz, \
-                           y_range=y_range, dy=dxyz, \
-                           z_range=z_range, dz=dxyz, \
-                           verbose=verbose, manualadjust=False)
+### Voxels are stored as compact uint8 material labels, which are only
+### expanded to point masses inside each simulation() call. With a memory
+### budget, only the coordinates are kept
+if memory_budget is None:
+    xx, yy, zz, labels = \
+        density.build_3d_array_cached(x_range=x_range, dx=dxyz, \
+                                      y_range=y_range, dy=dxyz, \
+                                      z_range=z_range, dz=dxyz, \
+                                      verbose=verbose, manualadjust=False, \
+                                      labels=True)
+else:
+    xx, yy, zz = density.grid_coordinates(x_range=x_range, dx=dxyz, \
+                                          y_range=y_range, dy=dxyz, \
+                                          z_range=z_range, dz=dxyz)
+    labels = None
 
 # x_range = (-200*1e-6+dx/2, 0e-6)
 # y_range = ((-density.attractor_params['total_width']/2+dy/2), density.attractor_params['total_width']/2)
@@ -98,6 +250,21 @@ lambdas = np.logspace(-6.7, -3, 15)
 #lambdas = [2e-6]
 lambdas = lambdas[::-1]
 
+### Adaptive lambda grid. If lambda_tolerance is set, lambdas above is only
+### the starting grid: simulation() adds the midpoint (in log lambda) of two
+### neighbouring values, and then refines on either side of it, wherever the
+### curves there differ from the spline through the values so far (see
+### collect_util.lambda_spline) by more than lambda_tolerance relative to
+### their peak, for up to lambda_refine rounds. Every value computed is
+### saved, and collect_results splines the curves of each file onto a common
+### grid. Not available with yukawa_engine = 'unit', whose fields are only
+### computed for the starting grid
+lambda_tolerance = None
+lambda_refine = 8
+if lambda_tolerance is not None and (yukawa_engine == 'unit' or len(lambdas) < 2):
+    raise ValueError("The adaptive lambda grid needs at least two starting lambdas, " \
+                     + "and doesn't work with yukawa_engine = 'unit'")
+
 ### Y-points over which to compute the result
 travel = 500.0e-6
 cent = 0.0e-6
@@ -109,6 +276,28 @@ beadposvec = np.linspace(cent - 0.5*travel + bead_dx, \
 beadposvec2 = np.linspace(-1.0*travel + bead_dx, \
                           1.0*travel - bead_dx, 2*Npoints-1)
 
+### How the copies of the single-period force curves are summed over the
+### fingers: 'spline' samples cubic splines of the curves along beadposvec2
+### at each displaced position, while 'exact' replaces beadposvec2 with a
+### grid with the step of beadposvec, just wide enough for every copy, so
+### that the displacements are index shifts. The step of beadposvec then
+### has to divide the finger period
+periodic_sum = 'spline'
+
+### Adaptive sampling of the bead positions along y. If position_tolerance
+### is set, the engines that compute each bead position on its own ('voxel',
+### 'tree', 'cubature', 'prism' and 'columns') start from every
+### position_step-th position of unit_ypos and edge_ypos (see simulation), and
+### add positions wherever the cubic spline through the ones computed so far
+### is off by more than position_tolerance relative to the peak of each term
+### (see force_kernels.adaptive_position_curves). The other positions are
+### sampled from the splines, so that the curves are still saved on
+### beadposvec. Smooth curves, at large separations, then take a fraction of
+### the positions. The 'fft' and 'unit' engines, and the edge strips of
+### edge_sum = 'strip', work on lattices of positions and sample them all
+position_tolerance = None
+position_step = 16
+
 
 
 
@@ -118,52 +307,54 @@ beadposvec2 = np.linspace(-1.0*travel + bead_dx, \
 #######  periodicity in the attractor                    ########
 #################################################################
 
-n_goldfinger = density.attractor_params['n_goldfinger']
-width_goldfinger = density.attractor_params['width_goldfinger']
-width_siliconfinger = density.attractor_params['width_siliconfinger']
-
-include_bridge = density.attractor_params['include_bridge']
-silicon_bridge = density.attractor_params['silicon_bridge']
-
-finger_length = density.attractor_params['finger_length']
-attractor_height = density.attractor_params['height']
-
-black_height = density.attractor_params['black_height']
-include_black = density.attractor_params['include_black']
-
-full_period = width_goldfinger + width_siliconfinger
-
-### Define indices for the central gold finger and half of each of 
-### the neighboring silicon fingers to take advantage of periodicity
-xinds2 = np.abs(xx) <= finger_length + \
-                        include_bridge*silicon_bridge
-yinds2 = np.abs(yy) <= 0.5 * full_period
-zinds2 = np.abs(zz) <= 0.5 * attractor_height + include_black * black_height
-
-### Define the indices outside of the repeated unit cell structure
-### to be used if include_edge=True
-yinds3 = np.abs(yy) >= 0.5 * n_goldfinger * full_period
-
-### Cut the coordinate vectors and density arrays for the repeating 
-### structure and the outer silicon edge
-xx2 = xx[xinds2]
-yy2 = yy[yinds2]
-zz2 = zz[zinds2]
-rho2 = rho[xinds2,:,:][:,yinds2,:][:,:,zinds2]
-
-yy3 = yy[yinds3]
-rho3 = rho[xinds2,:,:][:,yinds3,:][:,:,zinds2]
-
-dx = np.abs(xx[1] - xx[0])
-dy = np.abs(yy[1] - yy[0])
-dz = np.abs(zz[1] - zz[0])
-
-### Assuming rectangular volume elements, convert the density grid
-### to a grid of point masses
-cell_volume = dx * dy * dz
-m = rho * cell_volume
-m2 = rho2 * cell_volume
-m3 = rho3 * cell_volume
+### The unit cell and outer silicon edge of the attractor, as voxels, point
+### masses and boxes, along with the settings of the engines above (see
+### periodic_force.attractor_model). The model is handed to simulation() as
+### an argument, so that the workers get the attractor set up here, with its
+### large arrays memory mapped by joblib
+model = periodic_force.attractor_model(xx, yy, zz, labels, beadposvec, beadposvec2, np.min(seps), \
+                                       include_edge=include_edge, voxelization=voxelization, \
+                                       adaptive_eta=adaptive_eta, adaptive_scale=lambdas, \
+                                       memory_budget=memory_budget, batch_memory=batch_memory, \
+                                       kernel_backend=kernel_backend, pyramid_theta=pyramid_theta, \
+                                       tree_tolerance=tree_tolerance, use_symmetry=use_symmetry, \
+                                       edge_sum=edge_sum, fft_refine=fft_refine, \
+                                       periodic_sum=periodic_sum, material_basis=material_basis)
+dx, dy, dz = model['spacing']
+
+### Bead radius independent fields for the 'unit' engines, for each region,
+### on lattices of bead centers covering all of rbeads and seps along x and
+### the bead positions along y, at each of the heights. They're handed to
+### simulation() as an argument, which joblib memory maps for the workers
+### instead of copying them
+unit_fields = None
+if 'unit' in (newton_engine, yukawa_engine):
+    unit_x = periodic_force.bead_lattice(np.add.outer(rbeads, seps), dx / fft_refine)
+    unit_lattices = {'unitcell': (unit_x, periodic_force.bead_lattice(model['beadposvec2'], \
+                                                                      dy / fft_refine), heights), \
+                     'edge': (unit_x, periodic_force.bead_lattice(beadposvec, dy / fft_refine), \
+                              heights)}
+    unit_fields = {}
+    for region in ['unitcell', 'edge'][:1 + include_edge]:
+        unit_fields[region] = sum(fft_force.unit_force_fields(*chunk, rhobead, lambdas, \
+                                                              *unit_lattices[region], \
+                                                              spacing=model['spacing'], \
+                                                              n_materials=model['n_materials']) \
+                                  for chunk in periodic_force.iter_label_chunks(model, region))
+
+### The same voxels merged into line segments along x, for the 'columns'
+### engines, only if they're used, and handed to simulation() as well. The
+### grid is classified in y-tiles, so that the memory budget also holds here
+column_area = dy * dz
+columns = None
+if 'columns' in (newton_engine, yukawa_engine):
+    columns = {region: np.concatenate([column_force.extrude_columns(*tile, \
+                                                                    spacing=model['spacing'])[0] \
+                                       for tile in density.iter_label_slabs(model['xx2'], region_yy, \
+                                                                            model['zz2'], \
+                                                                            model['max_slab_voxels'], \
+                                                                            axis=1)]) \
+               for region, region_yy in [('unitcell', model['yy2']), ('edge', model['yy3'])]}
 
 ### Establish a path to save the data, and create the directory if it
 ### isn't already there
@@ -175,32 +366,12 @@ results_path = f"/home/kmkohn/2024-2025/Thesis_analysis/FEA/Data/rawdata_yukawa_
 test_filename = os.path.join(results_path, 'test.p')
 bu.make_all_pardirs(test_filename)
 
-### Assuming n_goldfinger is an odd integer, this just sets up some indices
-### of the fingers for use in the periodic sampling part
-finger_inds = np.linspace(-1.0 * int( 0.5*n_goldfinger ), \
-                           1.0 * int( 0.5*n_goldfinger ), \
-                           n_goldfinger)
-
-
-### Function to determine which finger you're in front of, and then
-### compute the equivalent coordinate assuming you're in front of the 
-### central finger. Part of the perdicity
-def find_ind(ypos):
-    if np.abs(ypos) <= 0.5*full_period:
-        ind = 0
-    else:
-        extrapos = np.abs(ypos) - 0.5*full_period
-        ind = np.sign(ypos) * (int(extrapos / full_period) + 1)
-
-    newypos = ypos - ind * full_period
-
-    return ind, newypos
-
-
 
-def simulation(params):
-    '''Simulation function taking one argument and returning one object,
-       for use with joblib parallelization.'''
+def simulation(params, model, unit_fields=None, columns=None):
+    '''Simulation function taking one argument (plus the attractor model,
+       and the fields of the 'unit' engines and the segments of the
+       'columns' engines, if used) and returning one object, for use with
+       joblib parallelization.'''
 
     ### Parse the parameters
     rbead, sep, height = params
@@ -218,85 +389,153 @@ def simulation(params):
     results_dic[rbead] = {}
     results_dic[rbead][sep] = {}
     results_dic[rbead][sep][height] = {}
+    if material_basis:
+        results_dic['materials'] = density.material_names
+        results_dic['basis'] = {}
 
     ### Some timing stuff
     all_start = time.time()
     calc_times = []
 
-    ### A thing that needs to be in every term (POSSIBLE SIGN AMBIGUITY)
-    Gterm = 2. * rbead**3
+    ### Bead positions along y at which the unit cell and edge curves are
+    ### computed, i.e. only the ones with y >= 0 with the y mirror symmetry,
+    ### and the z forces vanish at z = 0 with the z mirror symmetry
+    unit_ypos = model['beadposvec2'][model['unit_start']:]
+    edge_ypos = beadposvec[model['edge_start']:]
+    zero_z = model['z_mirror'] and height == 0
+    n_materials = model['n_materials']
+
+    ### Bead center coordinates for both position vectors, shape (N, 3)
+    beadposvec_xyz = np.column_stack((np.full(len(edge_ypos), sep+rbead), \
+                                      edge_ypos, np.full(len(edge_ypos), height)))
+    beadposvec2_xyz = np.column_stack((np.full(len(unit_ypos), sep+rbead), \
+                                       unit_ypos, np.full(len(unit_ypos), height)))
+
+    ### Radial force factors of the Newtonian term, every Yukawa lambda and
+    ### the extra kernel plugins, as (name, parameter, radial)
+    kernels = force_kernels.kernel_plugins(['newton', 'yukawa'] + extra_kernels, rbead, \
+                                           rhobead, lambdas=lambdas)
+    kernel_engines = {'newton': newton_engine, 'yukawa': yukawa_engine, \
+                      'powerlaw': powerlaw_engine}
 
     ### Loop over the long array of bead positions and compute the force from
     ### only the central finger. This can be sampled and added up to build the
-    ### force curve from the entire attractor
-    Gforcecurves = [[], [], []]
-    for ind, ypos in enumerate(beadposvec2):
-        beadpos = [sep+rbead, ypos, height]
-
-        ### These are used to compute projections and thus need to maintain sign.
-        ### Use the xx2, yy2, and zz2 arrays which are a subselections of the full
-        ### attractor covering only a single period of the fingers
-        xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                       beadpos[1] - yy2, \
-                                       beadpos[2] - zz2, indexing='ij')
-
-        ### Compute the separation between each point mass and the center 
-        ### of the microsphere
-        full_sep = np.sqrt(xsep**2 + ysep**2 + zsep**2)
-
-        ### Refer to a soon-to-exist document expanding on Alex R's
-        prefac = -1.0 * ((2. * G * m2 * rhobead * np.pi) / (3. * full_sep**2))
-
-        ### Append the computed values for the force from a single finger
-        Gforcecurves[0].append( np.sum(prefac * Gterm * xsep / full_sep) )
-        Gforcecurves[1].append( np.sum(prefac * Gterm * ysep / full_sep) )
-        Gforcecurves[2].append( np.sum(prefac * Gterm * zsep / full_sep) )
-
-    Gforcecurves = np.array(Gforcecurves)
-
-    ### Build interpolating functions from the long position vector
-    ### and the force due to a single period of the fingers
-    GX = interp.interp1d(beadposvec2, Gforcecurves[0], kind='cubic')
-    GY = interp.interp1d(beadposvec2, Gforcecurves[1], kind='cubic')
-    GZ = interp.interp1d(beadposvec2, Gforcecurves[2], kind='cubic')
-
-
-    ### Loop over the actual array of desired bead positions, and compute the
-    ### force from the full attractor at that position
-    newGs = np.zeros((3, len(beadposvec)))
-    for ind, ypos in enumerate(beadposvec):
-        start = time.time()
-
-        ### Compute the contribution from the points external to the 
-        ### periodicity, if desired
+    ### force curve from the entire attractor, with the curves over the actual
+    ### array of desired bead positions adding the points external to the 
+    ### periodicity, if desired. Everything is computed for unit density,
+    ### split by material, and weighted by the real densities later. Curves
+    ### are keyed by (name, parameter), each of shape (n_materials, 3, N)
+    curves, edges = {}, {}
+    def store(terms, unit_basis, edge_basis=None):
+        for term_ind, (name, param, _) in enumerate(terms):
+            curves[name, param] = unit_basis[term_ind]
+            edges[name, param] = np.zeros((n_materials, 3, len(edge_ypos))) \
+                                    if edge_basis is None else edge_basis[term_ind]
+
+    ### Curves of one of the engines at all of the positions, shape (N, 3),
+    ### from basis(positions) at any subset of them, which are refined along
+    ### y if position_tolerance is set, unless the engine needs a lattice
+    def sample_positions(basis, positions, lattice=False):
+        if position_tolerance is None or lattice:
+            return basis(positions)
+        return force_kernels.adaptive_position_curves(lambda inds: basis(positions[inds]), \
+                                                      positions[:,1], position_tolerance, \
+                                                      start_step=position_step)
+
+    ### Terms of the kernels given as (name, parameter, radial), computed by
+    ### the engines set for each of them
+    def compute_terms(kernels):
+        ### All the terms of each engine that takes arbitrary radial factors are
+        ### summed in a single pass, so that e.g. the separations are computed
+        ### only once per bead position
+        for engine in ['voxel', 'tree', 'fft', 'cubature']:
+            terms = [kernel for kernel in kernels if kernel_engines[kernel[0]] == engine]
+            if not len(terms):
+                continue
+            radials = [radial for _, _, radial in terms]
+            start = time.time()
+            unit_basis = sample_positions(lambda positions: \
+                                              periodic_force.radial_force_basis(model, engine, \
+                                                                                'unitcell', positions, \
+                                                                                radials, rbead), \
+                                          beadposvec2_xyz, \
+                                          lattice=periodic_force.lattice_engine(model, engine, \
+                                                                                'unitcell'))
+            stop = time.time()
+            calc_times.append((stop - start) / len(unit_ypos))
+            edge_basis = None
+            if include_edge:
+                start = time.time()
+                edge_basis = sample_positions(lambda positions: \
+                                                  periodic_force.radial_force_basis(model, engine, 'edge', \
+                                                                                    positions, radials, \
+                                                                                    rbead), \
+                                              beadposvec_xyz, \
+                                              lattice=periodic_force.lattice_engine(model, engine, 'edge'))
+                stop = time.time()
+                calc_times.append((stop - start) / len(edge_ypos))
+            store(terms, unit_basis, edge_basis)
+
+        ### The closed-form Newtonian engines
+        if newton_engine == 'prism' and kernels[0][0] == 'newton':
+            store(kernels[:1], [sample_positions(lambda positions: \
+                                    prism_force.newton_force_basis(positions, model['boxes']['unitcell'], \
+                                                                   rbead, rhobead, n_materials), \
+                                                 beadposvec2_xyz)], \
+                  [sample_positions(lambda positions: \
+                       prism_force.newton_force_basis(positions, model['boxes']['edge'], \
+                                                      rbead, rhobead, n_materials), \
+                                    beadposvec_xyz)] \
+                        if include_edge else None)
+
+        elif newton_engine == 'columns' and kernels[0][0] == 'newton':
+            store(kernels[:1], [sample_positions(lambda positions: \
+                                    column_force.newton_column_basis(positions, columns['unitcell'], \
+                                                                     column_area, rbead, rhobead, \
+                                                                     n_materials), \
+                                                 beadposvec2_xyz)], \
+                  [sample_positions(lambda positions: \
+                       column_force.newton_column_basis(positions, columns['edge'], \
+                                                        column_area, rbead, rhobead, n_materials), \
+                                    beadposvec_xyz)] \
+                        if include_edge else None)
+
+        ### And the Yukawa line-segment engine, one lambda at a time
+        if yukawa_engine == 'columns':
+            for term in [kernel for kernel in kernels if kernel[0] == 'yukawa']:
+                yuklambda = term[1]
+                store([term], [sample_positions(lambda positions: \
+                                   column_force.yukawa_column_basis(positions, columns['unitcell'], \
+                                                                    column_area, rbead, rhobead, \
+                                                                    yuklambda, n_materials=n_materials), \
+                                                beadposvec2_xyz)], \
+                      [sample_positions(lambda positions: \
+                           column_force.yukawa_column_basis(positions, columns['edge'], \
+                                                            column_area, rbead, rhobead, \
+                                                            yuklambda, n_materials=n_materials), \
+                                        beadposvec_xyz)] \
+                            if include_edge else None)
+
+    compute_terms(kernels)
+
+    ### The 'unit' engines only interpolate and scale their fields, which
+    ### have the Newtonian term first and then every lambda, as in kernels
+    if unit_fields is not None:
+        unit_inds = [term_ind for term_ind, (name, _, _) in enumerate(kernels[:1 + len(lambdas)]) \
+                     if kernel_engines[name] == 'unit']
+        unit_basis = fft_force.bead_force_curves(unit_fields['unitcell'], \
+                                                 unit_lattices['unitcell'], lambdas, rbead, \
+                                                 sep+rbead, unit_ypos, height)[unit_inds,:,:,0,:,0]
+        edge_basis = None
         if include_edge:
+            edge_basis = fft_force.bead_force_curves(unit_fields['edge'], unit_lattices['edge'], \
+                                                     lambdas, rbead, sep+rbead, edge_ypos, \
+                                                     height)[unit_inds,:,:,0,:,0]
+        store([kernels[term_ind] for term_ind in unit_inds], unit_basis, edge_basis)
 
-            ### sep parameter is assumed to be face to face
-            beadpos = [sep+rbead, ypos, height]
-
-            ### These are used to compute projections and thus need to maintain sign
-            xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                           beadpos[1] - yy3, \
-                                           beadpos[2] - zz2, indexing='ij')
-            full_sep = np.sqrt(xsep**2 + ysep**2 + zsep**2)
-
-            prefac = -1.0 * ((2. * G * m3 * rhobead * np.pi) / (3. * full_sep**2))
-
-            newGs[0][ind] += np.sum(prefac * Gterm * xsep / full_sep) 
-            newGs[1][ind] += np.sum(prefac * Gterm * ysep / full_sep) 
-            newGs[2][ind] += np.sum(prefac * Gterm * zsep / full_sep)
-
-        ### Find the finger in which we're in front of, and compute an 
-        ### equivalent position as if we're in front of the center finger
-        finger_ind, newypos = find_ind(ypos)
-
-        ### Sample the interpolating functions we built before, with one sample
-        ### for each finger, properly displaced
-        newGs[0][ind] += np.sum(GX(newypos + (finger_inds+finger_ind) * full_period))
-        newGs[1][ind] += np.sum(GY(newypos + (finger_inds+finger_ind) * full_period))
-        newGs[2][ind] += np.sum(GZ(newypos + (finger_inds+finger_ind) * full_period))  
-        stop = time.time()
-        calc_times.append(stop - start)
+    ### Build the force from the full attractor at each desired position
+    newGs, newGs_basis = periodic_force.combine_materials(model, curves['newton', None], \
+                                                          edges['newton', None], zero_z)
 
     if verbose:
         print('Computed normal grav.')
@@ -304,103 +543,65 @@ def simulation(params):
         sys.stdout.flush()
 
 
-    ### Loop over the desired values of the Yukawa lambda parameter, simulating
-    ### the force for each one
-    nlambda = len(lambdas)
-    for yukind, yuklambda in enumerate(lambdas):
-        if verbose:
-            bu.progress_bar(yukind, nlambda)
-
-        ### Refer to the non-existent LaTeX document in ../documents/ to explain this.
-        ### It's a term necessary for every position
-        func = np.exp(-2. * rbead / yuklambda) * (1. + rbead / yuklambda) + rbead / yuklambda - 1.
-
-        ### Loop over the long array of values computing the force from a single finger
-        yukforcecurves = [[], [], []]
-        for ind, ypos in enumerate(beadposvec2):
-
-            ### sep parameter is assumed to be face to face
-            beadpos = [sep+rbead, ypos, height]
-
-            #### These are used to compute projections and thus need to maintain sign
-            xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                           beadpos[1] - yy2, \
-                                           beadpos[2] - zz2, indexing='ij')
-
-            ### This isn't the full sep this time, because the Yukawa term depends on 
-            ### the distance between the point mass and the surface of the MS
-            s = np.sqrt(xsep**2 + ysep**2 + zsep**2) - rbead
-
-            ### Refer to the non-existent LaTeX document in ../documents/ to explain this.
-            ### Two position dependent terms
-            prefac = -1.0 * ((2. * G * m2 * rhobead * np.pi) / (3. * (s + rbead)**2))
-            yukterm = 3 * yuklambda**2 * (s + rbead + yuklambda) * func * np.exp( - s / yuklambda )
-
-            ### Build up the force curve at this point in the bead's position
-            yukforcecurves[0].append( np.sum(prefac * yukterm * xsep / (s + rbead)) ) 
-            yukforcecurves[1].append( np.sum(prefac * yukterm * ysep / (s + rbead)) )
-            yukforcecurves[2].append( np.sum(prefac * yukterm * zsep / (s + rbead)) )
-
-        yukforcecurves = np.array(yukforcecurves)
-
-        ### Construct interpolating functions for the yukawa modified force term 
-        ### from only the central finger
-        yukX = interp.interp1d(beadposvec2, yukforcecurves[0], kind='cubic')
-        yukY = interp.interp1d(beadposvec2, yukforcecurves[1], kind='cubic')
-        yukZ = interp.interp1d(beadposvec2, yukforcecurves[2], kind='cubic')
-
-
-        ### Loop over the actual array of desired bead positions, and compute the
-        ### force from the full attractor at that position
-        newyuks = np.zeros((3, len(beadposvec)))
-        for ind, ypos in enumerate(beadposvec):
-            start = time.time()
-
-            ### Compute the contribution from the points external to the 
-            ### periodicity, if desired
-            if include_edge:
-
-                beadpos = [sep+rbead, ypos, height]
-
-                #### These are used to compute projections and thus need to maintain sign
-                xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                               beadpos[1] - yy3, \
-                                               beadpos[2] - zz2, indexing='ij')
-
-                ### This isn't the full sep this time, because the Yukawa term depends on 
-                ### the distance between the point mass and the surface of the MS
-                s = np.sqrt(xsep**2 + ysep**2 + zsep**2) - rbead
-
-                ### Refer to the non-existent LaTeX document in ../documents/ to explain this.
-                ### Two position dependent terms
-                prefac = -1.0 * ((2. * G * m3 * rhobead * np.pi) / (3. * (rbead + s)**2))
-                yukterm = 3 * yuklambda**2 * (rbead + s + yuklambda) * func * np.exp( - s / yuklambda )
-
-                newyuks[0][ind] += np.sum(prefac * yukterm * xsep / (s + rbead))
-                newyuks[1][ind] += np.sum(prefac * yukterm * ysep / (s + rbead)) 
-                newyuks[2][ind] += np.sum(prefac * yukterm * zsep / (s + rbead)) 
-
-            ### Find the finger in which we're in front of, and compute an 
-            ### equivalent position as if we're in front of the center finger
-            finger_ind, newypos = find_ind(ypos)
-
-            ### Sample the interpolating functions we built before, with one sample 
-            ### for each finger, properly displaced
-            newyuks[0][ind] += np.sum(yukX(newypos + (finger_inds+finger_ind) * full_period))
-            newyuks[1][ind] += np.sum(yukY(newypos + (finger_inds+finger_ind) * full_period))
-            newyuks[2][ind] += np.sum(yukZ(newypos + (finger_inds+finger_ind) * full_period))
-            stop = time.time()
-            calc_times.append(stop - start)
-
-        results_dic[rbead][sep][height][yuklambda] = \
-                    (newGs[0], newGs[1], newGs[2], newyuks[0], newyuks[1], newyuks[2])
+    ### Build the yukawa modified force from the full attractor at each
+    ### desired position, for each of the values of the Yukawa lambda parameter
+    def combine_yukawa(yuk_lambdas):
+        for yukind, yuklambda in enumerate(yuk_lambdas):
+            if verbose:
+                bu.progress_bar(yukind, len(yuk_lambdas))
+
+            newyuks, newyuks_basis = \
+                    periodic_force.combine_materials(model, curves['yukawa', yuklambda], \
+                                                     edges['yukawa', yuklambda], zero_z)
+
+            results_dic[rbead][sep][height][yuklambda] = \
+                        (newGs[0], newGs[1], newGs[2], newyuks[0], newyuks[1], newyuks[2])
+
+            ### Per-material curves for unit density, with the same ordering of 
+            ### components, shape (n_materials, 6, len(beadposvec))
+            if material_basis:
+                results_dic['basis'][yuklambda] = \
+                        np.concatenate((newGs_basis, newyuks_basis), axis=1)
+
+    combine_yukawa(lambdas)
+
+    ### Refine the lambda grid between neighbouring values, as long as the
+    ### curves at their midpoint in log lambda aren't predicted to within
+    ### lambda_tolerance by the spline through the values so far
+    if lambda_tolerance is not None:
+        yukcurves = results_dic[rbead][sep][height]
+        intervals = list(zip(np.sort(lambdas)[:-1], np.sort(lambdas)[1:]))
+        for refine in range(lambda_refine):
+            if not len(intervals):
+                break
+            nodes = list(yukcurves.keys())
+            spline = collect_util.lambda_spline(nodes, [yukcurves[lam][3:] for lam in nodes])
+            midpoints = np.sqrt(np.prod(intervals, axis=1))
+
+            compute_terms(force_kernels.kernel_plugins(['yukawa'], rbead, rhobead, \
+                                                       lambdas=midpoints))
+            combine_yukawa(midpoints)
+
+            actual = np.array([yukcurves[lam][3:] for lam in midpoints])
+            peaks = np.maximum(np.max(np.abs(actual), axis=(1, 2)), np.finfo(float).tiny)
+            errors = np.max(np.abs(spline(midpoints) - actual), axis=(1, 2)) / peaks
+            intervals = [new_interval for (lo, hi), mid, error in zip(intervals, midpoints, errors) \
+                         if error > lambda_tolerance for new_interval in ((lo, mid), (mid, hi))]
+
+    ### Curves of the extra kernel plugins
+    for name, param, _ in kernels[1 + len(lambdas):]:
+        newforces = periodic_force.combine_materials(model, curves[name, param], \
+                                                     edges[name, param], zero_z)[0]
+        results_dic.setdefault(name, {})[param] = (newforces[0], newforces[1], newforces[2])
 
     all_stop = time.time()
 
     if verbose:
         print("100% Done!")
-        print( 'Mean: {:0.3g} ms, Std.: {:0.3g} ms    per bead-position'\
-                .format(np.mean(calc_times)*1e3, np.std(calc_times)*1e3) )
+        ### Only the engines that take radial factors are timed
+        if len(calc_times):
+            print( 'Mean: {:0.3g} ms, Std.: {:0.3g} ms    per bead-position'\
+                    .format(np.mean(calc_times)*1e3, np.std(calc_times)*1e3) )
         print()
         print('Total Computation Time: {:0.1f}'.format(all_stop-all_start))
 
@@ -422,5 +623,6 @@ def simulation(params):
 
 ### Do the sim, yo
 param_list = list(itertools.product(rbeads, seps, heights))
-results = Parallel(n_jobs=ncore)(delayed(simulation)(param) for param in tqdm(param_list))
+results = Parallel(n_jobs=ncore)(delayed(simulation)(param, model, unit_fields, columns) \
+                                 for param in tqdm(param_list))
 
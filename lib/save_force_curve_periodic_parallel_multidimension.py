@@ -7,10 +7,13 @@ import pickle as pickle
 import scipy.interpolate as interp
 import scipy.signal as signal
 import scipy.optimize as opti
-import scipy, sys, time, os, itertools
+import scipy, sys, time, os, itertools, functools
 
 import build_attractor_v2_density as density
 import bead_util as bu
+import prism_force
+import force_kernels
+import periodic_force
 
 from numba import jit
 from datetime import date
@@ -53,10 +56,107 @@ density.attractor_params['total_height'] = \
 
 ### Whether or not to include the outer silicon edge at the limits
 ### of y (I think it amounts to a 12um wide strip of silicon) so it
-### shouldn't change too much. It does increase computation time by 
-### a factor of a few, but is more complete to include
+### shouldn't change too much. Summed directly over the voxels, it
+### increases computation time by a factor of a few, but is more complete
+### to include, and costs little with edge_sum = 'strip' below
 include_edge = True
 
+### Whether to also save one force curve per material (for unit density),
+### so that any other assignment of densities is just a weighted sum of
+### these, done at collection time (see collect_util.recombine_materials)
+material_basis = False
+
+### How to compute the Newtonian and power-law force curves. 'voxel' uses
+### the midpoint sum over the voxel grid, while 'cubature' integrates the
+### kernels over the attractor boxes with adaptive Gauss-Legendre cubature,
+### refining only near the bead (see prism_force.cubature_force_basis).
+### 'tree' sums the voxels with far-field blocks, to tree_tolerance below
+powerlaw_engine = 'voxel'
+
+### Other kernel plugins to compute along with the Newtonian term and the
+### power laws (see force_kernels.kernel_plugins), with powerlaw_engine as
+### well. All the terms are summed in a single pass over the voxels and
+### bead positions, so e.g. ['yukawa'] adds the Yukawa term for each of
+### lambdas below for little more than the cost of evaluating its kernel.
+### Their curves are saved in results_dic under the plugin name and then
+### the parameter, e.g. results_dic['yukawa'][yuklambda], as (Fx, Fy, Fz)
+extra_kernels = []
+
+### Point masses used by the 'voxel' engines. 'uniform' takes the voxels
+### of the grid built below with spacing dxyz, while 'adaptive' builds an
+### octree that is fine near the bead-facing surface and coarse deep in
+### the bulk, with cell sizes at most adaptive_eta times their distance
+### from the bead (see density.adaptive_point_masses). If 'yukawa' is in
+### extra_kernels, cells within 10 lambdas of that surface are also refined
+### below each of lambdas. For 0.5, the Newtonian curves are off by about
+### 3e-5 relative to their peak (the 1um 'uniform' voxels by about 2e-7
+### with include_edge, and 1.3e-4 without), and the Yukawa curves by up to
+### about 1.6e-2 for the smallest lambdas, for which 'cubature' is the
+### better choice
+voxelization = 'uniform'
+adaptive_eta = 0.5
+
+### Memory budget in bytes for the 'uniform' voxels, or None. If set, the
+### full grid is never built. Instead, slabs of voxels are generated when
+### needed, and forces are accumulated slab by slab, so that peak memory
+### stays bounded for arbitrarily small dxyz
+memory_budget = None
+
+### Memory in bytes for the temporaries of each batch of bead positions
+### evaluated at once against the voxels (see the docstring of
+### force_kernels.point_mass_force_basis)
+batch_memory = 2**28 if memory_budget is None else memory_budget
+
+### 'numpy' or 'numba' for the voxel sums. The numba kernel is a single
+### fused loop over the point masses, parallel over bead positions, and is
+### compiled once and cached on disk (in __pycache__), so that the workers
+### only load it
+kernel_backend = 'numpy'
+
+### Opening angle for far-field coarsening of the 'uniform' voxels, or
+### None to sum every voxel. If set, the voxels are summed into a pyramid
+### of 2x2x2 blocks, and each bead position uses the coarsest blocks that
+### are smaller than pyramid_theta times their distance from the bead
+### (see density.pyramid_point_masses). For 0.1, the Newtonian curves
+### are off by about 1.5e-4 relative to their peak, with 10-100x fewer
+### point masses per position. The power laws use a third of the angle,
+### and Yukawa terms keep the blocks smaller than pyramid_theta times
+### lambda as well (see periodic_force.opening_groups)
+pyramid_theta = None
+
+### Relative accuracy of the 'tree' engines, which sum the voxels through a
+### mass pyramid that also keeps the second moments of the blocks (see
+### density.build_mass_pyramid). Seen from each bead position, blocks are
+### resolved down to an opening angle set by the tolerance, and for Yukawa
+### terms, down to a fraction of lambda as well, while voxels that are
+### ln(1/tree_tolerance) lambdas farther than the nearest ones are left out.
+### Positions where that takes more point masses than the voxels themselves
+### fall back to the direct sum (see periodic_force.tree_force_basis)
+tree_tolerance = 1e-4
+
+### Whether to use the mirror symmetry of the attractor in y and z, if the
+### voxel grid has it (see density.mirror_symmetric). The curves are then
+### only computed at the bead positions with y >= 0, and mirrored to the
+### others (see force_kernels.unfold_mirror). For beads at z = 0, the z
+### forces are exactly 0, and the 'uniform' voxel sums only take the voxels
+### with z >= 0, with doubled masses off the z = 0 plane. The grid below has
+### voxel centers on the boundaries of the unit cell, whose voxels are then
+### split between neighbouring cells instead (see
+### periodic_force.attractor_model), so only the z symmetry applies to it.
+### Off by default, so that the curves don't depend on how the voxels are
+### summed; on the grid below it only changes them by rounding (2e-13)
+use_symmetry = False
+
+### How the 'voxel' engines sum the outer silicon edge. Each of the two edge
+### strips is the same layer of voxels repeated along y, so with 'strip',
+### the forces of a single layer are computed once, on a lattice of bead
+### positions with the step of beadposvec, and those of the strip are sums
+### of copies shifted by dy (see periodic_force.edge_strip_force_basis).
+### 'direct' sums all of the voxels for every bead position, as for the
+### unit cell. 'strip' needs uniform voxels without a pyramid, and a step
+### of beadposvec that divides dy, and otherwise falls back to 'direct'
+edge_sum = 'strip'
+
 ### End values for the ranges are very important, see the function
 ### docstring (and consider how to define the CENTERS of cubic unit
 ### cells, such that the unit cells themselves actually span the 
@@ -68,11 +168,21 @@ dxyz = (1)*1e-6
 x_range = (-200*1e-6+dxyz/2, 0e-6)
 y_range = ((-density.attractor_params['total_width']/2+dxyz/2), density.attractor_params['total_width']/2)
 z_range = (-density.attractor_params['total_height']/2+dxyz/2, density.attractor_params['total_height']/2)
-xx, yy, zz, rho = \
-    density.build_3d_array(x_range=x_range, dx=dxyz, \
-                           y_range=y_range, dy=dxyz, \
-                           z_range=z_range, dz=dxyz, \
-                           verbose=verbose, manualadjust=False)
+### Voxels are stored as compact uint8 material labels, which are only
+### expanded to point masses inside each simulation() call. With a memory
+### budget, only the coordinates are kept
+if memory_budget is None:
+    xx, yy, zz, labels = \
+        density.build_3d_array_cached(x_range=x_range, dx=dxyz, \
+                                      y_range=y_range, dy=dxyz, \
+                                      z_range=z_range, dz=dxyz, \
+                                      verbose=verbose, manualadjust=False, \
+                                      labels=True)
+else:
+    xx, yy, zz = density.grid_coordinates(x_range=x_range, dx=dxyz, \
+                                          y_range=y_range, dy=dxyz, \
+                                          z_range=z_range, dz=dxyz)
+    labels = None
 
 # x_range = (-200*1e-6+dx/2, 0e-6)
 # y_range = ((-density.attractor_params['total_width']/2+dy/2), density.attractor_params['total_width']/2)
@@ -96,6 +206,10 @@ rhobead = 1850.0
 r0s = np.logspace(-6.7, -3, 30)
 r0s = r0s[::-1]
 
+### Values of the Yukawa lambda parameter, if 'yukawa' is in extra_kernels
+lambdas = np.logspace(-6.7, -3, 15)
+lambdas = lambdas[::-1]
+
 ### Y-points over which to compute the result
 travel = 500.0e-6
 cent = 0.0e-6
@@ -107,6 +221,26 @@ beadposvec = np.linspace(cent - 0.5*travel + bead_dx, \
 beadposvec2 = np.linspace(-1.0*travel + bead_dx, \
                           1.0*travel - bead_dx, 2*Npoints-1)
 
+### How the copies of the single-period force curves are summed over the
+### fingers: 'spline' samples cubic splines of the curves along beadposvec2
+### at each displaced position, while 'exact' replaces beadposvec2 with a
+### grid with the step of beadposvec, just wide enough for every copy, so
+### that the displacements are index shifts. The step of beadposvec then
+### has to divide the finger period
+periodic_sum = 'spline'
+
+### Adaptive sampling of the bead positions along y. If position_tolerance
+### is set, the curves start from every position_step-th position of
+### unit_ypos and edge_ypos (see simulation), and add positions wherever the
+### cubic spline through the ones computed so far is off by more than
+### position_tolerance relative to the peak of each kernel (see
+### force_kernels.adaptive_position_curves). The other positions are sampled
+### from the splines, so that smooth curves, at large separations, take a
+### fraction of the positions. The edge strips of edge_sum = 'strip' work on
+### a lattice of positions and sample them all
+position_tolerance = None
+position_step = 16
+
 
 
 
@@ -116,52 +250,21 @@ beadposvec2 = np.linspace(-1.0*travel + bead_dx, \
 #######  periodicity in the attractor                    ########
 #################################################################
 
-n_goldfinger = density.attractor_params['n_goldfinger']
-width_goldfinger = density.attractor_params['width_goldfinger']
-width_siliconfinger = density.attractor_params['width_siliconfinger']
-
-include_bridge = density.attractor_params['include_bridge']
-silicon_bridge = density.attractor_params['silicon_bridge']
-
-finger_length = density.attractor_params['finger_length']
-attractor_height = density.attractor_params['height']
-
-black_height = density.attractor_params['black_height']
-include_black = density.attractor_params['include_black']
-
-full_period = width_goldfinger + width_siliconfinger
-
-### Define indices for the central gold finger and half of each of 
-### the neighboring silicon fingers to take advantage of periodicity
-xinds2 = np.abs(xx) <= finger_length + \
-                        include_bridge*silicon_bridge
-yinds2 = np.abs(yy) <= 0.5 * full_period
-zinds2 = np.abs(zz) <= 0.5 * attractor_height + include_black * black_height
-
-### Define the indices outside of the repeated unit cell structure
-### to be used if include_edge=True
-yinds3 = np.abs(yy) >= 0.5 * n_goldfinger * full_period
-
-### Cut the coordinate vectors and density arrays for the repeating 
-### structure and the outer silicon edge
-xx2 = xx[xinds2]
-yy2 = yy[yinds2]
-zz2 = zz[zinds2]
-rho2 = rho[xinds2,:,:][:,yinds2,:][:,:,zinds2]
-
-yy3 = yy[yinds3]
-rho3 = rho[xinds2,:,:][:,yinds3,:][:,:,zinds2]
-
-dx = np.abs(xx[1] - xx[0])
-dy = np.abs(yy[1] - yy[0])
-dz = np.abs(zz[1] - zz[0])
-
-### Assuming rectangular volume elements, convert the density grid
-### to a grid of point masses
-cell_volume = dx * dy * dz
-m = rho * cell_volume
-m2 = rho2 * cell_volume
-m3 = rho3 * cell_volume
+### The unit cell and outer silicon edge of the attractor, as voxels, point
+### masses and boxes, along with the settings of the engines above (see
+### periodic_force.attractor_model). The model is handed to simulation() as
+### an argument, so that the workers get the attractor set up here, with its
+### large arrays memory mapped by joblib. The adaptive voxels are refined to
+### the Yukawa lambdas if that term is computed
+adaptive_scale = lambdas if 'yukawa' in extra_kernels else None
+model = periodic_force.attractor_model(xx, yy, zz, labels, beadposvec, beadposvec2, np.min(seps), \
+                                       include_edge=include_edge, voxelization=voxelization, \
+                                       adaptive_eta=adaptive_eta, adaptive_scale=adaptive_scale, \
+                                       memory_budget=memory_budget, batch_memory=batch_memory, \
+                                       kernel_backend=kernel_backend, pyramid_theta=pyramid_theta, \
+                                       tree_tolerance=tree_tolerance, use_symmetry=use_symmetry, \
+                                       edge_sum=edge_sum, periodic_sum=periodic_sum, \
+                                       material_basis=material_basis)
 
 ### Establish a path to save the data, and create the directory if it
 ### isn't already there
@@ -172,32 +275,10 @@ results_path = "/home/kmkohn/2024-2025/Thesis_analysis/FEA/Data/rawdata_polynomi
 test_filename = os.path.join(results_path, 'test.p')
 bu.make_all_pardirs(test_filename)
 
-### Assuming n_goldfinger is an odd integer, this just sets up some indices
-### of the fingers for use in the periodic sampling part
-finger_inds = np.linspace(-1.0 * int( 0.5*n_goldfinger ), \
-                           1.0 * int( 0.5*n_goldfinger ), \
-                           n_goldfinger)
-
-
-### Function to determine which finger you're in front of, and then
-### compute the equivalent coordinate assuming you're in front of the 
-### central finger. Part of the perdicity
-def find_ind(ypos):
-    if np.abs(ypos) <= 0.5*full_period:
-        ind = 0
-    else:
-        extrapos = np.abs(ypos) - 0.5*full_period
-        ind = np.sign(ypos) * (int(extrapos / full_period) + 1)
-
-    newypos = ypos - ind * full_period
-
-    return ind, newypos
-
-
 
-def simulation(params):
-    '''Simulation function taking one argument and returning one object,
-       for use with joblib parallelization.'''
+def simulation(params, model):
+    '''Simulation function taking one argument (plus the attractor model)
+       and returning one object, for use with joblib parallelization.'''
 
     ### Parse the parameters
     rbead, sep, height = params
@@ -211,195 +292,113 @@ def simulation(params):
 
     ### Instantiate a dictionary that will be populated with results
     results_dic = {}
-    results_dic['order'] = 'Rbead, Sep, Height, r0'
+    results_dic['order'] = 'Rbead, Sep, Height'
+    results_dic['r0s'] = r0s
     results_dic[rbead] = {}
     results_dic[rbead][sep] = {}
-    results_dic[rbead][sep][height] = {}
+    if material_basis:
+        results_dic['materials'] = density.material_names
 
     ### Some timing stuff
     all_start = time.time()
     calc_times = []
 
+    ### Bead positions along y at which the unit cell and edge curves are
+    ### computed, i.e. only the ones with y >= 0 with the y mirror symmetry,
+    ### and the z forces vanish at z = 0 with the z mirror symmetry
+    unit_ypos = model['beadposvec2'][model['unit_start']:]
+    edge_ypos = beadposvec[model['edge_start']:]
+    zero_z = model['z_mirror'] and height == 0
+
+    ### Bead center coordinates for both position vectors, shape (N, 3)
+    beadposvec_xyz = np.column_stack((np.full(len(edge_ypos), sep+rbead), \
+                                      edge_ypos, np.full(len(edge_ypos), height)))
+    beadposvec2_xyz = np.column_stack((np.full(len(unit_ypos), sep+rbead), \
+                                       unit_ypos, np.full(len(unit_ypos), height)))
+
+    ### Radial force factors of the Newtonian term, the four power laws and
+    ### the extra kernel plugins, as (name, parameter, radial)
+    kernels = force_kernels.kernel_plugins(['newton', 'powerlaw'] + extra_kernels, rbead, \
+                                           rhobead, lambdas=lambdas)
+    radials = [radial for _, _, radial in kernels]
+
     ### Loop over the long array of bead positions and compute the force from
     ### only the central finger. This can be sampled and added up to build the
-    ### force curve from the entire attractor
-    Gforcecurves = [[], [], []]
-    Gforcecurves_dim1 = [[], [], []]
-    Gforcecurves_dim2 = [[], [], []]
-    Gforcecurves_dim3 = [[], [], []]
-    Gforcecurves_dim4 = [[], [], []]
-    for ind, ypos in enumerate(beadposvec2):
-        beadpos = [sep+rbead, ypos, height]
-
-        ### These are used to compute projections and thus need to maintain sign.
-        ### Use the xx2, yy2, and zz2 arrays which are a subselections of the full
-        ### attractor covering only a single period of the fingers
-        xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                       beadpos[1] - yy2, \
-                                       beadpos[2] - zz2, indexing='ij')
-
-        ### Compute the separation between each point mass and the center 
-        ### of the microsphere
-        full_sep = np.sqrt(xsep**2 + ysep**2 + zsep**2)
-
-        gravfac = 4*rbead**3/3
-        dim1fac = -2*(rbead*full_sep-np.arctanh(rbead/full_sep)*(rbead**2+np.square(full_sep)))
-        dim2fac = -4*rbead**3/(rbead**2-np.square(full_sep))
-        dim3fac = 2*((rbead*full_sep*(rbead**2+full_sep**2))/(rbead**2-full_sep**2)**2-np.arctanh(rbead/full_sep))
-        dim4fac = 4*rbead**3*(rbead**2-5*full_sep**2)/(3*(rbead**2-full_sep**2)**3)
-        
-
-        ### Refer to a soon-to-exist document expanding on Alex R's
-        prefac = -1.0 * (G * m2 * rhobead * np.pi)/np.square(full_sep)
-
-        ### Append the computed values for the force from a single finger
-        Gforcecurves[0].append( np.sum(prefac * gravfac * xsep / full_sep) )
-        Gforcecurves[1].append( np.sum(prefac * gravfac * ysep / full_sep) )
-        Gforcecurves[2].append( np.sum(prefac * gravfac * zsep / full_sep) )
-
-        Gforcecurves_dim1[0].append( np.sum(prefac * dim1fac * xsep / full_sep) )
-        Gforcecurves_dim1[1].append( np.sum(prefac * dim1fac * ysep / full_sep) )
-        Gforcecurves_dim1[2].append( np.sum(prefac * dim1fac * zsep / full_sep) )
-
-        Gforcecurves_dim2[0].append( np.sum(prefac * dim2fac * xsep / full_sep) )
-        Gforcecurves_dim2[1].append( np.sum(prefac * dim2fac * ysep / full_sep) )
-        Gforcecurves_dim2[2].append( np.sum(prefac * dim2fac * zsep / full_sep) )
-        
-        Gforcecurves_dim3[0].append( np.sum(prefac * dim3fac * xsep / full_sep) )
-        Gforcecurves_dim3[1].append( np.sum(prefac * dim3fac * ysep / full_sep) )
-        Gforcecurves_dim3[2].append( np.sum(prefac * dim3fac * zsep / full_sep) )
-        
-        Gforcecurves_dim4[0].append( np.sum(prefac * dim4fac * xsep / full_sep) )
-        Gforcecurves_dim4[1].append( np.sum(prefac * dim4fac * ysep / full_sep) )
-        Gforcecurves_dim4[2].append( np.sum(prefac * dim4fac * zsep / full_sep) )
-
-    Gforcecurves = np.array(Gforcecurves)
-    Gforcecurves_dim1 = np.array(Gforcecurves_dim1)
-    Gforcecurves_dim2 = np.array(Gforcecurves_dim2)
-    Gforcecurves_dim3 = np.array(Gforcecurves_dim3)
-    Gforcecurves_dim4 = np.array(Gforcecurves_dim4)
-
-    ### Build interpolating functions from the long position vector
-    ### and the force due to a single period of the fingers
-    GX = interp.interp1d(beadposvec2, Gforcecurves[0], kind='cubic')
-    GY = interp.interp1d(beadposvec2, Gforcecurves[1], kind='cubic')
-    GZ = interp.interp1d(beadposvec2, Gforcecurves[2], kind='cubic')
-
-    GX_dim1 = interp.interp1d(beadposvec2, Gforcecurves_dim1[0], kind='cubic')
-    GY_dim1 = interp.interp1d(beadposvec2, Gforcecurves_dim1[1], kind='cubic')
-    GZ_dim1 = interp.interp1d(beadposvec2, Gforcecurves_dim1[2], kind='cubic')
-
-    GX_dim2 = interp.interp1d(beadposvec2, Gforcecurves_dim2[0], kind='cubic')
-    GY_dim2 = interp.interp1d(beadposvec2, Gforcecurves_dim2[1], kind='cubic')
-    GZ_dim2 = interp.interp1d(beadposvec2, Gforcecurves_dim2[2], kind='cubic')
-    
-    GX_dim3 = interp.interp1d(beadposvec2, Gforcecurves_dim3[0], kind='cubic')
-    GY_dim3 = interp.interp1d(beadposvec2, Gforcecurves_dim3[1], kind='cubic')
-    GZ_dim3 = interp.interp1d(beadposvec2, Gforcecurves_dim3[2], kind='cubic')
-    
-    GX_dim4 = interp.interp1d(beadposvec2, Gforcecurves_dim4[0], kind='cubic')
-    GY_dim4 = interp.interp1d(beadposvec2, Gforcecurves_dim4[1], kind='cubic')
-    GZ_dim4 = interp.interp1d(beadposvec2, Gforcecurves_dim4[2], kind='cubic')
-
+    ### force curve from the entire attractor. Everything is computed for unit
+    ### density, split by material, and weighted by the real densities later.
+    ### The first index runs over the kernels, with the Newtonian term and the
+    ### four power laws first. If position_tolerance is set, only some of the
+    ### positions are computed and the rest are splined, unless the engine
+    ### needs a lattice
+    def sample_positions(region, positions, lattice=False):
+        if position_tolerance is None or lattice:
+            return periodic_force.radial_force_basis(model, powerlaw_engine, region, positions, \
+                                                     radials, rbead)
+        return force_kernels.adaptive_position_curves( \
+                    lambda inds: periodic_force.radial_force_basis(model, powerlaw_engine, region, \
+                                                                   positions[inds], radials, rbead), \
+                    positions[:,1], position_tolerance, start_step=position_step)
+
+    start = time.time()
+    forcecurves = sample_positions('unitcell', beadposvec2_xyz)
+    stop = time.time()
+    calc_times.append((stop - start) / len(unit_ypos))
 
     ### Loop over the actual array of desired bead positions, and compute the
-    ### force from the full attractor at that position
-    newGs = np.zeros((3, len(beadposvec)))
-    newGs_dim1 = np.zeros((3, len(beadposvec)))
-    newGs_dim2 = np.zeros((3, len(beadposvec)))
-    newGs_dim3 = np.zeros((3, len(beadposvec)))
-    newGs_dim4 = np.zeros((3, len(beadposvec)))
-    for ind, ypos in enumerate(beadposvec):
+    ### contribution from the points external to the periodicity, if desired
+    edgecurves = np.zeros((len(kernels), model['n_materials'], 3, len(edge_ypos)))
+    if include_edge:
         start = time.time()
-
-        ### Compute the contribution from the points external to the 
-        ### periodicity, if desired
-        if include_edge:
-
-            ### sep parameter is assumed to be face to face
-            beadpos = [sep+rbead, ypos, height]
-
-            ### These are used to compute projections and thus need to maintain sign
-            xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                           beadpos[1] - yy3, \
-                                           beadpos[2] - zz2, indexing='ij')
-            full_sep = np.sqrt(xsep**2 + ysep**2 + zsep**2)
-
-            gravfac = 4*rbead**3/3
-            dim1fac = -(2*rbead*full_sep+np.log((-rbead+full_sep)/(rbead+full_sep))*(rbead**2+np.square(full_sep)))
-            dim2fac = -4*rbead**3/(rbead**2-np.square(full_sep))
-            dim3fac = 2*((rbead*full_sep*(rbead**2+full_sep**2))/(rbead**2-full_sep**2)**2-np.arctanh(rbead/full_sep))
-            dim4fac = 4*rbead**3*(rbead**2-5*full_sep**2)/(3*(rbead**2-full_sep**2)**3)
-
-
-
-            ### Refer to a soon-to-exist document expanding on Alex R's
-            prefac = -1.0 * (G * m3 * rhobead * np.pi)/np.square(full_sep)
-
-            newGs[0][ind] += np.sum(prefac * gravfac * xsep / full_sep) 
-            newGs[1][ind] += np.sum(prefac * gravfac * ysep / full_sep) 
-            newGs[2][ind] += np.sum(prefac * gravfac * zsep / full_sep)
-
-            newGs_dim1[0][ind] += np.sum(prefac * dim1fac * xsep / full_sep) 
-            newGs_dim1[1][ind] += np.sum(prefac * dim1fac * ysep / full_sep) 
-            newGs_dim1[2][ind] += np.sum(prefac * dim1fac * zsep / full_sep)
-
-            newGs_dim2[0][ind] += np.sum(prefac * dim2fac * xsep / full_sep) 
-            newGs_dim2[1][ind] += np.sum(prefac * dim2fac * ysep / full_sep) 
-            newGs_dim2[2][ind] += np.sum(prefac * dim2fac * zsep / full_sep)
-            
-            newGs_dim3[0][ind] += np.sum(prefac * dim3fac * xsep / full_sep) 
-            newGs_dim3[1][ind] += np.sum(prefac * dim3fac * ysep / full_sep) 
-            newGs_dim3[2][ind] += np.sum(prefac * dim3fac * zsep / full_sep)
-            
-            newGs_dim4[0][ind] += np.sum(prefac * dim4fac * xsep / full_sep) 
-            newGs_dim4[1][ind] += np.sum(prefac * dim4fac * ysep / full_sep) 
-            newGs_dim4[2][ind] += np.sum(prefac * dim4fac * zsep / full_sep)
-
-        ### Find the finger in which we're in front of, and compute an 
-        ### equivalent position as if we're in front of the center finger
-        finger_ind, newypos = find_ind(ypos)
-
-        ### Sample the interpolating functions we built before, with one sample
-        ### for each finger, properly displaced
-        newGs[0][ind] += np.sum(GX(newypos + (finger_inds+finger_ind) * full_period))
-        newGs[1][ind] += np.sum(GY(newypos + (finger_inds+finger_ind) * full_period))
-        newGs[2][ind] += np.sum(GZ(newypos + (finger_inds+finger_ind) * full_period))  
-
-        newGs_dim1[0][ind] += np.sum(GX_dim1(newypos + (finger_inds+finger_ind) * full_period))
-        newGs_dim1[1][ind] += np.sum(GY_dim1(newypos + (finger_inds+finger_ind) * full_period))
-        newGs_dim1[2][ind] += np.sum(GZ_dim1(newypos + (finger_inds+finger_ind) * full_period))  
-
-        newGs_dim2[0][ind] += np.sum(GX_dim2(newypos + (finger_inds+finger_ind) * full_period))
-        newGs_dim2[1][ind] += np.sum(GY_dim2(newypos + (finger_inds+finger_ind) * full_period))
-        newGs_dim2[2][ind] += np.sum(GZ_dim2(newypos + (finger_inds+finger_ind) * full_period)) 
-        
-        newGs_dim3[0][ind] += np.sum(GX_dim3(newypos + (finger_inds+finger_ind) * full_period))
-        newGs_dim3[1][ind] += np.sum(GY_dim3(newypos + (finger_inds+finger_ind) * full_period))
-        newGs_dim3[2][ind] += np.sum(GZ_dim3(newypos + (finger_inds+finger_ind) * full_period)) 
-        
-        newGs_dim4[0][ind] += np.sum(GX_dim4(newypos + (finger_inds+finger_ind) * full_period))
-        newGs_dim4[1][ind] += np.sum(GY_dim4(newypos + (finger_inds+finger_ind) * full_period))
-        newGs_dim4[2][ind] += np.sum(GZ_dim4(newypos + (finger_inds+finger_ind) * full_period)) 
-
-
+        edgecurves = sample_positions('edge', beadposvec_xyz, \
+                                      lattice=periodic_force.lattice_engine(model, powerlaw_engine, \
+                                                                            'edge'))
         stop = time.time()
-        calc_times.append(stop - start)
-
-    for r0 in r0s:
-        results_dic[rbead][sep][height][r0] = \
-                        (newGs[0], newGs[1], newGs[2], \
-                        newGs_dim1[0]*r0, newGs_dim1[1]*r0, newGs_dim1[2]*r0, \
-                        newGs_dim2[0]*r0**2, newGs_dim2[1]*r0**2, newGs_dim2[2]*r0**2, \
-                        newGs_dim3[0]*r0**3, newGs_dim3[1]*r0**3, newGs_dim3[2]*r0**3, \
-                        newGs_dim4[0]*r0**4, newGs_dim4[1]*r0**4, newGs_dim4[2]*r0**4)
+        calc_times.append((stop - start) / len(edge_ypos))
+
+    ### Build the force from the full attractor at each desired position, for
+    ### the Newtonian term and each power law
+    newGs, newGs_basis = \
+            periodic_force.combine_materials(model, forcecurves[0], edgecurves[0], zero_z)
+    newGs_dim1, newGs_dim1_basis = \
+            periodic_force.combine_materials(model, forcecurves[1], edgecurves[1], zero_z)
+    newGs_dim2, newGs_dim2_basis = \
+            periodic_force.combine_materials(model, forcecurves[2], edgecurves[2], zero_z)
+    newGs_dim3, newGs_dim3_basis = \
+            periodic_force.combine_materials(model, forcecurves[3], edgecurves[3], zero_z)
+    newGs_dim4, newGs_dim4_basis = \
+            periodic_force.combine_materials(model, forcecurves[4], edgecurves[4], zero_z)
+
+    ### And for the extra kernel plugins
+    for kernel_ind, (name, param, _) in enumerate(kernels[5:], start=5):
+        newforces = periodic_force.combine_materials(model, forcecurves[kernel_ind], \
+                                                     edgecurves[kernel_ind], zero_z)[0]
+        results_dic.setdefault(name, {})[param] = (newforces[0], newforces[1], newforces[2])
+
+    ### The power laws only depend on r0 through their factors of r0**dim,
+    ### so only the curves per unit r0**dim are saved, along with r0s, and
+    ### the scaling is left to collection time (see collect_util.R0Scaling)
+    results_dic[rbead][sep][height] = \
+                    (newGs[0], newGs[1], newGs[2], \
+                    newGs_dim1[0], newGs_dim1[1], newGs_dim1[2], \
+                    newGs_dim2[0], newGs_dim2[1], newGs_dim2[2], \
+                    newGs_dim3[0], newGs_dim3[1], newGs_dim3[2], \
+                    newGs_dim4[0], newGs_dim4[1], newGs_dim4[2])
+
+    ### Per-material curves for unit density, with the same ordering of 
+    ### components, shape (n_materials, 15, len(beadposvec))
+    if material_basis:
+        results_dic['basis'] = \
+                np.concatenate((newGs_basis, newGs_dim1_basis, newGs_dim2_basis, \
+                                newGs_dim3_basis, newGs_dim4_basis), axis=1)
 
     all_stop = time.time()
 
     if verbose:
         print("100% Done!")
-        print( 'Mean: {:0.3g} ms, Std.: {:0.3g} ms    per bead-position'\
-                .format(np.mean(calc_times)*1e3, np.std(calc_times)*1e3) )
+        ### Only the engines that take radial factors are timed
+        if len(calc_times):
+            print( 'Mean: {:0.3g} ms, Std.: {:0.3g} ms    per bead-position'\
+                    .format(np.mean(calc_times)*1e3, np.std(calc_times)*1e3) )
         print()
         print('Total Computation Time: {:0.1f}'.format(all_stop-all_start))
 
@@ -421,5 +420,6 @@ def simulation(params):
 
 ### Do the sim, yo
 param_list = list(itertools.product(rbeads, seps, heights))
-results = Parallel(n_jobs=ncore)(delayed(simulation)(param) for param in tqdm(param_list))
+results = Parallel(n_jobs=ncore)(delayed(simulation)(param, model) \
+                                 for param in tqdm(param_list))
 #simulation(param_list)
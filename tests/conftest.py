@@ -0,0 +1,4 @@
+import os, sys
+
+### The modules in lib/ import each other by name, as in the scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
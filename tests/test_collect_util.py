@@ -0,0 +1,112 @@
+import functools
+
+import numpy as np
+import pytest
+
+import collect_util
+import force_kernels
+
+
+rbead = 4.99e-6
+rho_bead = 1850.0
+
+
+def random_point_masses(n_points, seed=0):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform([-20.0e-6, -10.0e-6, -5.0e-6], [0.0, 10.0e-6, 5.0e-6], (n_points, 3))
+    volumes = rng.uniform(0.5e-18, 1.0e-18, n_points)
+    return points, volumes, np.zeros(n_points, dtype=int)
+
+
+### Bead positions for each of two separations, shape (2, N, 3)
+ypos = np.linspace(-20.0e-6, 20.0e-6, 21)
+bead_positions = np.array([np.column_stack((np.full(len(ypos), sep + rbead), ypos, \
+                                            np.full(len(ypos), 1.0e-6))) \
+                           for sep in [2.0e-6, 10.0e-6]])
+
+
+def force_curves(radials, points, volumes, labels):
+    '''Curves from the point masses with shape (len(radials), seps, positions, 3).'''
+    return np.moveaxis([force_kernels.point_mass_force_basis(positions, points, volumes, labels, \
+                                                             radials, 1)[:,0] \
+                        for positions in bead_positions], 0, 1).swapaxes(-1, -2)
+
+
+@pytest.mark.parametrize('dim', [1, 2, 3, 4])
+def test_r0_scaling_matches_r0_loop(dim):
+    '''Scaling the curves per unit r0**dim on access gives the curves that
+       were computed for each r0 with the factor of r0**dim in the kernel.'''
+
+    points, volumes, labels = random_point_masses(100)
+    r0s = np.logspace(-6.7, -3, 5)
+    radial = functools.partial(force_kernels.powerlaw_radial, rbead=rbead, rho_bead=rho_bead, \
+                               dim=dim)
+
+    base = force_curves([radial], points, volumes, labels)[0]
+    reference = np.array([force_curves([lambda r, r0=r0: r0**dim * radial(r)], \
+                                       points, volumes, labels)[0] for r0 in r0s])
+    curves = collect_util.R0Scaling(base, r0s, dim)
+
+    def close(arr, ref):
+        return arr.shape == ref.shape and np.allclose(arr, ref, rtol=1e-12, atol=0.0)
+
+    assert len(curves) == len(r0s) and curves.shape == reference.shape
+    assert close(np.asarray(curves), reference)
+    assert close(curves[3], reference[3])
+    assert close(curves[3, 1], reference[3, 1])
+    assert close(curves[:, 1], reference[:, 1])
+    assert close(curves[1:4, :, 5:9], reference[1:4, :, 5:9])
+    assert close(curves[..., 2], reference[..., 2])
+    assert close(curves.at(r0s[2]), reference[2])
+
+
+def test_load_powerlaw_curves(tmp_path):
+    '''Collected curves per unit r0**dim load as an R0Scaling, and older
+       full arrays as they are.'''
+
+    rng = np.random.default_rng(2)
+    base = rng.normal(size=(2, 21, 1, 3))
+    r0s = np.logspace(-6.7, -3, 4)
+    np.save(tmp_path / 'Dim2data_base.npy', base)
+    np.save(tmp_path / 'r0s.npy', r0s)
+    np.save(tmp_path / 'Dim3data.npy', np.multiply.outer(r0s**3, base))
+
+    curves = collect_util.load_powerlaw_curves(tmp_path, 2)
+    assert isinstance(curves, collect_util.R0Scaling)
+    assert np.allclose(np.asarray(curves), np.multiply.outer(r0s**2, base), rtol=1e-15, atol=0.0)
+    assert np.array_equal(collect_util.load_powerlaw_curves(tmp_path, 3), \
+                          np.multiply.outer(r0s**3, base))
+
+
+def yukawa_curves(lambdas, points, volumes, labels):
+    radials = [functools.partial(force_kernels.yukawa_radial, rbead=rbead, rho_bead=rho_bead, \
+                                 yuklambda=yuklambda) for yuklambda in lambdas]
+    return force_curves(radials, points, volumes, labels)
+
+
+def test_lambda_spline_matches_direct_curves():
+    '''The spline reproduces the curves at the lambdas it's given, and the
+       curves computed directly between them, with 25 lambdas from 0.2 um
+       to 1 mm, to 1.5% of their peak for lambda below 0.5 um, where they
+       fall the fastest, and 1e-3 above.'''
+
+    points, volumes, labels = random_point_masses(100)
+    lambdas = np.logspace(-6.7, -3, 25)
+    mids = np.sqrt(lambdas[1:] * lambdas[:-1])
+    curves = yukawa_curves(lambdas, points, volumes, labels)
+    reference = yukawa_curves(mids, points, volumes, labels)
+
+    ### Given in any order, and with the lambda axis anywhere
+    order = np.random.default_rng(3).permutation(len(lambdas))
+    spline = collect_util.lambda_spline(lambdas[order], np.moveaxis(curves[order], 0, 2), \
+                                        axis=2, peak_axes=(-1, 1))
+
+    def errors(out, ref):
+        return np.max(np.abs(out - ref), axis=(2, 3)) / np.max(np.abs(ref), axis=(2, 3))
+
+    assert np.all(errors(np.moveaxis(spline(lambdas), 2, 0), curves) < 1e-12)
+    assert np.all(errors(spline(lambdas[7])[None], curves[7:8]) < 1e-12)
+
+    mid_errors = errors(np.moveaxis(spline(mids), 2, 0), reference)
+    assert np.all(mid_errors < 1.5e-2)
+    assert np.all(mid_errors[mids > 0.5e-6] < 1e-3)
@@ -0,0 +1,55 @@
+import functools
+
+import numpy as np
+import pytest
+
+import column_force
+import force_kernels
+
+
+rbead = 4.99e-6
+rho_bead = 1850.0
+
+
+def fine_point_masses(segments, area, n_sub):
+    '''Each segment split into n_sub point masses along x.'''
+    steps = (segments[:,1] - segments[:,0]) / n_sub
+    x = segments[:,0,None] + steps[:,None] * (np.arange(n_sub) + 0.5)
+    points = np.stack((x, np.repeat(segments[:,2,None], n_sub, axis=1), \
+                       np.repeat(segments[:,3,None], n_sub, axis=1)), axis=-1).reshape(-1, 3)
+    return points, np.repeat(area * steps, n_sub), np.repeat(segments[:,4].astype(int), n_sub)
+
+
+@pytest.mark.parametrize('yuklambda, sep', [(0.2e-6, 0.5e-6), (0.2e-6, 2.0e-6), \
+                                            (1.0e-6, 0.5e-6)])
+def test_yukawa_columns_match_fine_voxels(yuklambda, sep):
+    '''The fixed Gauss-Legendre rule for the transverse components, and the
+       closed form for the x component, agree with the point mass sum over
+       the same segments split finely along x (extrapolated in the step),
+       to about 1e-8 of the peak force for small lambda.'''
+
+    xx = np.arange(-9.5e-6, 0.0, 1.0e-6)
+    yy = np.arange(-2.5e-6, 3.0e-6, 1.0e-6)
+    zz = np.arange(-1.5e-6, 2.0e-6, 1.0e-6)
+    labels = np.ones((len(xx), len(yy), len(zz)), dtype=np.uint8)
+    labels[:4] = 2
+    segments, area = column_force.extrude_columns(xx, yy, zz, labels)
+    positions = np.column_stack((np.full(9, sep + rbead), np.linspace(-4.0e-6, 4.0e-6, 9), \
+                                 np.full(9, 0.7e-6)))
+
+    forces = column_force.yukawa_column_basis(positions, segments, area, rbead, rho_bead, \
+                                              yuklambda)
+
+    radials = [functools.partial(force_kernels.yukawa_radial, rbead=rbead, rho_bead=rho_bead, \
+                                 yuklambda=yuklambda)]
+    n_sub = int(np.ceil(20.0 * (xx[-1] - xx[0]) / yuklambda))
+    coarse, fine = [force_kernels.point_mass_force_basis(positions, \
+                                                         *fine_point_masses(segments, area, n), \
+                                                         radials, forces.shape[0])[0] \
+                    for n in [n_sub, 2 * n_sub]]
+    reference = (4.0 * fine - coarse) / 3.0
+
+    peaks = np.max(np.abs(reference), axis=(1, 2))
+    errors = np.max(np.abs(forces - reference), axis=(1, 2))
+    assert np.all(errors[1:3] < 5e-8 * peaks[1:3])
+    assert np.all(forces[[0, 3]] == 0.0)
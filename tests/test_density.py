@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+import pytest
+
+import build_attractor_v2_density as density
+
+
+def attractor_extent():
+    params = density.attractor_params
+    return np.array([[-250.0e-6, 10.0e-6], \
+                     [-0.6 * params['total_width'], 0.6 * params['total_width']], \
+                     [-0.6 * params['total_height'], 0.6 * params['total_height']]])
+
+
+@pytest.mark.parametrize('just_black, include_bridge', [(True, False), (False, False), \
+                                                        (False, True)])
+def test_density_symmetric_vec_matches_scalar(monkeypatch, just_black, include_bridge):
+    '''The vectorized densities are those of density_symmetric, both at
+       random points and on a grid with points on the material boundaries.'''
+
+    monkeypatch.setitem(density.attractor_params, 'just_black', just_black)
+    monkeypatch.setitem(density.attractor_params, 'include_bridge', include_bridge)
+    extent = attractor_extent()
+
+    rng = np.random.default_rng(1)
+    points = rng.uniform(extent[:,0], extent[:,1], (5000, 3))
+    edges = np.stack(np.meshgrid(*[np.arange(lo, hi, 0.5e-6) for lo, hi \
+                                   in [(-90.0e-6, 1.0e-6), extent[1], (-6.0e-6, 7.0e-6)]], \
+                                 indexing='ij'), axis=-1).reshape(-1, 3)[::97]
+    points = np.concatenate((points, edges))
+
+    densities = density.density_symmetric_vec(points[:,0], points[:,1], points[:,2])
+    reference = np.array([density.density_symmetric(*point) for point in points])
+
+    assert np.array_equal(densities, reference)
+    assert set(np.unique(reference)) > {0.0}
+
+
+def test_material_label_vec_broadcasts():
+    '''Labels on a grid from broadcast coordinates are those of the points.'''
+
+    xx = np.linspace(-100.0e-6, 0.0, 11)
+    yy = np.linspace(-150.0e-6, 150.0e-6, 13)
+    zz = np.linspace(-7.0e-6, 7.0e-6, 5)
+
+    labels = density.material_label_vec(xx[:,None,None], yy[None,:,None], zz[None,None,:])
+    xg, yg, zg = np.meshgrid(xx, yy, zz, indexing='ij')
+
+    assert labels.shape == (len(xx), len(yy), len(zz))
+    assert labels.dtype == np.uint8
+    assert np.array_equal(labels, density.material_label_vec(xg.ravel(), yg.ravel(), \
+                                                             zg.ravel()).reshape(xg.shape))
+
+
+### A small grid, so the cache tests only voxelize a few thousand voxels
+small_grid = dict(x_range=(-9.5e-6, 0.0), dx=1.0e-6, y_range=(-29.5e-6, 30.0e-6), dy=1.0e-6, \
+                  z_range=(-6.5e-6, 7.0e-6), dz=1.0e-6)
+
+
+def counting_builds(monkeypatch):
+    '''Counts the calls of build_label_array, i.e. the cache misses.'''
+
+    calls = []
+    build_label_array = density.build_label_array
+    def counted(*args, **kwargs):
+        calls.append(kwargs)
+        return build_label_array(*args, **kwargs)
+    monkeypatch.setattr(density, 'build_label_array', counted)
+    return calls
+
+
+def test_build_3d_array_cached_hit_and_miss(monkeypatch, tmp_path):
+    '''The first call voxelizes the grid and the second one maps it from
+       the cache, for densities and labels alike, while a different grid
+       or different attractor parameters miss.'''
+
+    xx, yy, zz, rho = density.build_3d_array(**small_grid)
+    calls = counting_builds(monkeypatch)
+
+    first = density.build_3d_array_cached(**small_grid, cache_dir=tmp_path)
+    second = density.build_3d_array_cached(**small_grid, cache_dir=tmp_path)
+    labels = density.build_3d_array_cached(**small_grid, cache_dir=tmp_path, labels=True)
+
+    assert len(calls) == 1
+    assert isinstance(second[3], np.memmap)
+    for arrays in (first, second):
+        for arr, ref in zip(arrays, (xx, yy, zz, rho)):
+            assert np.array_equal(arr, ref)
+    assert np.array_equal(density.material_density_table()[labels[3]], rho)
+
+    density.build_3d_array_cached(**dict(small_grid, dx=0.5e-6), cache_dir=tmp_path)
+    assert len(calls) == 2
+
+    monkeypatch.setitem(density.attractor_params, 'rho_gold', 2.0 * density.attractor_params['rho_gold'])
+    density.build_3d_array_cached(**small_grid, cache_dir=tmp_path)
+    assert len(calls) == 3
+    assert len(os.listdir(tmp_path)) == 3
+
+
+def test_density_cache_key_follows_params():
+    '''The key changes with any of the attractor parameters or the grid,
+       and not with the order the parameters were set in.'''
+
+    grid = [small_grid[name] for name in ['x_range', 'dx', 'y_range', 'dy', 'z_range', 'dz']]
+    params = dict(density.attractor_params)
+    key = density.density_cache_key(*grid, params=params)
+
+    assert key == density.density_cache_key(*grid)
+    assert key == density.density_cache_key(*grid, params=dict(reversed(list(params.items()))))
+    assert key != density.density_cache_key(*grid, manualadjust=True, params=params)
+    assert key != density.density_cache_key(*grid[:-1], 0.5e-6, params=params)
+    for name in ['rho_gold', 'finger_length', 'just_black']:
+        changed = dict(params, **{name: params[name] + 1})
+        assert key != density.density_cache_key(*grid, params=changed)
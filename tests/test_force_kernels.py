@@ -0,0 +1,126 @@
+import os, subprocess, sys
+
+import numpy as np
+import pytest
+
+import force_kernels
+
+
+rbead = 4.99e-6
+rho_bead = 1850.0
+
+lib_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+
+### Runs the numba backend once in a fresh interpreter
+numba_script = '''
+import numpy as np
+import force_kernels
+
+kernels = force_kernels.kernel_plugins(['newton', 'yukawa', 'powerlaw'], 4.99e-6, 1850.0, \\
+                                       lambdas=[1.0e-6])
+points = np.array([[-2.0e-6, 1.0e-6, 0.0], [-5.0e-6, -3.0e-6, 2.0e-6]])
+force_kernels.point_mass_force_basis(np.array([[8.0e-6, 0.0, 0.0]]), points, np.ones(2), \\
+                                     np.zeros(2, dtype=int), [k[2] for k in kernels], 1, \\
+                                     backend='numba')
+'''
+
+
+def random_point_masses(n_points, n_materials, seed=0):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform([-20.0e-6, -10.0e-6, -5.0e-6], [0.0, 10.0e-6, 5.0e-6], (n_points, 3))
+    volumes = rng.uniform(0.5e-18, 1.0e-18, n_points)
+    labels = rng.integers(0, n_materials, n_points)
+    return points, volumes, labels
+
+
+def test_numba_backend_matches_numpy():
+    pytest.importorskip('numba')
+    kernels = force_kernels.kernel_plugins(['newton', 'yukawa', 'powerlaw'], rbead, rho_bead, \
+                                           lambdas=[0.5e-6, 5.0e-6, 50.0e-6])
+    radials = [radial for _, _, radial in kernels]
+    points, volumes, labels = random_point_masses(200, 3)
+    positions = np.array([[rbead + 2.0e-6, y, 0.5e-6] for y in np.linspace(-5e-6, 5e-6, 7)])
+
+    forces = force_kernels.point_mass_force_basis(positions, points, volumes, labels, \
+                                                  radials, 3, backend='numba')
+    reference = force_kernels.point_mass_force_basis(positions, points, volumes, labels, \
+                                                     radials, 3)
+
+    peaks = np.max(np.abs(reference), axis=(1, 2, 3))
+    assert np.all(np.max(np.abs(forces - reference), axis=(1, 2, 3)) <= 1e-12 * peaks)
+
+
+def test_numba_backend_loads_from_cache(tmp_path):
+    '''The fused kernel is compiled by the first process only, and every
+       later one loads it from the on-disk cache.'''
+
+    pytest.importorskip('numba')
+    env = dict(os.environ, NUMBA_CACHE_DIR=str(tmp_path), NUMBA_DEBUG_CACHE='1', \
+               PYTHONPATH=os.pathsep.join([lib_path, os.environ.get('PYTHONPATH', '')]))
+
+    logs = [subprocess.run([sys.executable, '-c', numba_script], env=env, check=True, \
+                           capture_output=True, text=True).stdout for _ in range(2)]
+
+    assert '[cache] data saved' in logs[0]
+    assert '[cache] data loaded' in logs[1]
+    assert '[cache] data saved' not in logs[1]
+
+
+def test_mirror_average_splits_masses():
+    '''Averaging curves with their mirror images in y gives the forces of
+       the masses split evenly between their positions and mirror images.'''
+
+    kernels = force_kernels.kernel_plugins(['newton', 'yukawa'], rbead, rho_bead, \
+                                           lambdas=[2.0e-6])
+    radials = [radial for _, _, radial in kernels]
+    points, volumes, labels = random_point_masses(50, 2)
+    ypos = np.linspace(-20.0e-6, 20.0e-6, 41)
+    positions = np.column_stack((np.full(len(ypos), rbead + 3.0e-6), ypos, \
+                                 np.full(len(ypos), 1.0e-6)))
+
+    forces = force_kernels.mirror_average(force_kernels.point_mass_force_basis( \
+                                              positions, points, volumes, labels, radials, 2))
+
+    mirrored = points * np.array([1.0, -1.0, 1.0])
+    reference = force_kernels.point_mass_force_basis(positions, np.concatenate((points, mirrored)), \
+                                                     0.5 * np.concatenate((volumes, volumes)), \
+                                                     np.concatenate((labels, labels)), radials, 2)
+
+    assert np.allclose(forces, reference, rtol=1e-12, atol=1e-12 * np.max(np.abs(reference)))
+
+
+def test_unfold_mirror_round_trip():
+    '''Forces of masses that are mirror symmetric in y (and z) are
+       recovered at all the positions from those computed from
+       mirror_half_start on.'''
+
+    kernels = force_kernels.kernel_plugins(['newton', 'yukawa'], rbead, rho_bead, \
+                                           lambdas=[2.0e-6])
+    radials = [radial for _, _, radial in kernels]
+    points, volumes, labels = random_point_masses(50, 2)
+    for axis in [1, 2]:
+        mirrored = points.copy()
+        mirrored[:,axis] *= -1.0
+        points = np.concatenate((points, mirrored))
+        volumes, labels = np.tile(volumes, 2), np.tile(labels, 2)
+
+    ypos = np.linspace(-20.0e-6, 20.0e-6, 41)
+    start = force_kernels.mirror_half_start(ypos)
+    assert start == 20
+    assert force_kernels.mirror_half_start(ypos + 0.5e-6) == 0
+    assert force_kernels.mirror_half_start(ypos[::-1]) == 0
+
+    positions = np.column_stack((np.full(len(ypos), rbead + 3.0e-6), ypos, np.zeros(len(ypos))))
+    full = force_kernels.point_mass_force_basis(positions, points, volumes, labels, radials, 2)
+    atol = 1e-12 * np.max(np.abs(full))
+
+    unfolded = force_kernels.unfold_mirror(full[...,start:], len(ypos), zero_z=True)
+    assert np.array_equal(unfolded[...,start:][...,:2,:], full[...,start:][...,:2,:])
+    assert np.all(unfolded[...,2,:] == 0.0)
+    assert np.allclose(unfolded, full, rtol=0.0, atol=atol)
+
+    ### With the positions and components along other axes
+    moved = force_kernels.unfold_mirror(np.moveaxis(full[...,start:], (-2, -1), (0, 1)), \
+                                        len(ypos), pos_axis=1, comp_axis=0)
+    assert np.array_equal(np.moveaxis(moved, (0, 1), (-2, -1)), \
+                          force_kernels.unfold_mirror(full[...,start:], len(ypos)))
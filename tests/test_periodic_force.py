@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+import build_attractor_v2_density as density
+import force_kernels
+import periodic_force
+
+
+rbead = 4.99e-6
+rho_bead = 1850.0
+
+
+def small_attractor_grid(monkeypatch, width_outersilicon=4.0e-6):
+    '''Three fingers with a period of 8 um, and a grid with 1 um voxels
+       whose faces fall on the boundaries of the unit cell and the edge.'''
+
+    params = dict(density.attractor_params, n_goldfinger=3, width_goldfinger=4.0e-6, \
+                  width_siliconfinger=4.0e-6, width_outersilicon=width_outersilicon, \
+                  finger_length=6.0e-6, height=2.0e-6, black_height=1.0e-6, just_black=False)
+    params['total_width'] = 3 * 4.0e-6 + 2 * 4.0e-6 + 2 * width_outersilicon
+    params['total_height'] = params['height'] + 2 * params['black_height']
+    monkeypatch.setattr(density, 'attractor_params', params)
+
+    half_width = 0.5 * params['total_width']
+    xx, yy, zz = density.grid_coordinates(x_range=(-5.5e-6, 0.0), \
+                                          y_range=(-half_width + 0.5e-6, half_width), \
+                                          z_range=(-1.5e-6, 2.0e-6))
+    labels = density.material_label_vec(xx[:,None,None], yy[None,:,None], zz[None,None,:])
+    return xx, yy, zz, labels
+
+
+@pytest.fixture
+def small_attractor(monkeypatch):
+    return small_attractor_grid(monkeypatch)
+
+
+def brute_force(positions, xx, yy, zz, labels, radials):
+    '''Forces from every voxel of the grid, weighted by density.'''
+    forces = force_kernels.point_mass_force_basis(positions, \
+                                                  *density.grid_point_masses(xx, yy, zz, labels), \
+                                                  radials, len(density.material_names))
+    return np.tensordot(density.material_density_table(), forces, axes=(0, 1))
+
+
+@pytest.mark.parametrize('height', [0.0, 1.0e-6])
+def test_exact_periodic_sum_matches_brute_force(small_attractor, height):
+    '''The unit cell curves on the extended grid, shifted by every finger,
+       plus the edge strips, are the forces of all of the voxels.'''
+
+    xx, yy, zz, labels = small_attractor
+    beadposvec = np.arange(-20.0e-6, 20.25e-6, 0.5e-6)
+    radials = [radial for _, _, radial in force_kernels.kernel_plugins( \
+                   ['newton', 'yukawa'], rbead, rho_bead, lambdas=[1.0e-6, 10.0e-6])]
+    model = periodic_force.attractor_model(xx, yy, zz, labels, beadposvec, beadposvec, 1.0e-6, \
+                                           periodic_sum='exact')
+
+    def bead_positions(ypos):
+        return np.column_stack((np.full(len(ypos), 2.0e-6 + rbead), ypos, \
+                                np.full(len(ypos), height)))
+
+    positions = bead_positions(beadposvec)
+    unitcell = periodic_force.voxel_force_basis(model, 'unitcell', \
+                                                bead_positions(model['beadposvec2']), radials)
+    edge = periodic_force.voxel_force_basis(model, 'edge', positions, radials)
+    forces = np.array([periodic_force.combine_materials(model, unitcell[ind], edge[ind])[0] \
+                       for ind in range(len(radials))])
+
+    reference = brute_force(positions, xx, yy, zz, labels, radials)
+    assert np.allclose(forces, reference, rtol=0.0, atol=1e-12 * np.max(np.abs(reference)))
+
+
+@pytest.mark.parametrize('height, bead_step', [(0.0, 0.5e-6), (1.0e-6, 0.25e-6)])
+def test_edge_strip_matches_brute_force(monkeypatch, height, bead_step):
+    '''The edge strips summed as shifted copies of their first layer give
+       the forces of all of their voxels.'''
+
+    xx, yy, zz, labels = small_attractor_grid(monkeypatch, width_outersilicon=8.0e-6)
+    beadposvec = np.arange(-25.0e-6, 25.0e-6 + 0.5*bead_step, bead_step)
+    radials = [radial for _, _, radial in force_kernels.kernel_plugins( \
+                   ['newton', 'yukawa'], rbead, rho_bead, lambdas=[1.0e-6, 10.0e-6])]
+    model = periodic_force.attractor_model(xx, yy, zz, labels, beadposvec, beadposvec, 1.0e-6)
+    assert [n_layers for _, n_layers in model['edge_layers']] == [6, 6]
+
+    positions = np.column_stack((np.full(len(beadposvec), 2.0e-6 + rbead), beadposvec, \
+                                 np.full(len(beadposvec), height)))
+    forces = periodic_force.voxel_force_basis(model, 'edge', positions, radials)
+    reference = force_kernels.point_mass_force_basis(positions, \
+                                                     *model['stored_masses']['edge'][0], \
+                                                     radials, model['n_materials'])
+
+    assert np.allclose(forces, reference, rtol=0.0, atol=1e-12 * np.max(np.abs(reference)))
+
+
+def test_edge_strip_needs_uniform_layers(monkeypatch):
+    '''Edge strips whose layers differ, here with vacuum beyond the
+       attractor, are summed voxel by voxel.'''
+
+    xx, yy, zz, labels = small_attractor_grid(monkeypatch)
+    yy = np.arange(-16.5e-6, 17.0e-6, 1.0e-6)
+    labels = density.material_label_vec(xx[:,None,None], yy[None,:,None], zz[None,None,:])
+    beadposvec = np.arange(-20.0e-6, 20.25e-6, 0.5e-6)
+    model = periodic_force.attractor_model(xx, yy, zz, labels, beadposvec, beadposvec, 1.0e-6)
+
+    assert model['edge_layers'] is None
+    assert not periodic_force.lattice_engine(model, 'voxel', 'edge')
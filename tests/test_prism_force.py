@@ -0,0 +1,34 @@
+import functools
+
+import numpy as np
+import pytest
+
+import force_kernels
+import prism_force
+
+
+rbead = 4.99e-6
+rho_bead = 1850.0
+
+### A single gold box, with its front face at x = 0
+box = np.array([[-20.0e-6, 0.0, -15.0e-6, 15.0e-6, -5.0e-6, 5.0e-6, 1]])
+
+
+@pytest.mark.parametrize('yuklambda, sep', [(0.2e-6, 1.0e-6), (0.2e-6, 3.0e-6), \
+                                            (1.0e-6, 12.0e-6), (1.0e-6, 20.0e-6)])
+def test_cubature_yukawa_far_from_bead(yuklambda, sep):
+    '''The refinement to the Yukawa length scale has to follow the box
+       nearest to the bead, also for separations of many lambdas.'''
+
+    radials = [functools.partial(force_kernels.yukawa_radial, rbead=rbead, \
+                                 rho_bead=rho_bead, yuklambda=yuklambda)]
+    positions = np.array([[sep + rbead, 3.0e-6, 1.0e-6]])
+
+    forces = prism_force.cubature_force_basis(positions, box, radials, rbead, \
+                                              length_scale=yuklambda)[0,1,:,0]
+    reference = prism_force.cubature_force_basis(positions, box, radials, rbead, \
+                                                 length_scale=yuklambda, eta=0.3, \
+                                                 lambda_eta=2.0, cutoff=30.0, order=6, \
+                                                 max_depth=20, chunk_size=1)[0,1,:,0]
+
+    assert np.max(np.abs(forces - reference)) < 1e-5 * np.max(np.abs(reference))